@@ -67,7 +67,7 @@ if [ $PIPELINE == "bidsify" ];then
 
 		echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"
 		echo "Which heuristic do you want to apply?"
-		echo "Choose from" $(ls $ENV_DIR/bidsify/heudiconv_*.py | xargs -n 1 basename)
+		echo "Choose from" $(ls $ENV_DIR/bidsify/heudiconv_*.{json,py} 2>/dev/null | xargs -n 1 basename)
 		read HEURISTIC; export HEURISTIC
 
 		echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"	
@@ -360,6 +360,11 @@ elif [ $PIPELINE == "tbss" ];then
 		ls $DATA_DIR/${PIPELINE}_${TBSS_PIPELINE}/code/merge* | cut -d "_" -f 2 | cut -d "." -f 1
 		read TBSS_MERGE_LIST; export TBSS_MERGE_LIST
 
+		echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"	
+		echo "Do you want to update a previous merge incrementally (append new and rewrite changed subjects only)? (y/n)"
+		echo "Note: merged skeletons are only rewritten if subjects were added or changed. Default: n"
+		read MODIFIER; [ -z $MODIFIER ] && MODIFIER=n; export MODIFIER
+
 		export SUBJS_PER_NODE=$subj_array_length
 		export ANALYSIS_LEVEL=group
 		batch_time_default="4:00:00"
@@ -474,6 +479,12 @@ elif [ $PIPELINE == "psmd" ];then
 		echo "Which input data do you want to use? (preprocessed/fitted)"
 		read MODIFIER; export MODIFIER
 	
+	elif [ $PSMD_PIPE == csi ]; then
+
+		echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"	
+		echo "Which skeleton projection do you want to use? (fsl/engine) Default is fsl (TBSS, per subject); engine projects all subjects at group level and is not yet validated against fsl."
+		read PSMD_PROJECTION; [ -z $PSMD_PROJECTION ] && PSMD_PROJECTION=fsl; export PSMD_PROJECTION
+
 	fi
 
 	if [ $PSMD_LEVEL == "subject" ]; then
@@ -521,7 +532,7 @@ elif [ $PIPELINE == "wmh" ];then
 	export ANALYSIS_LEVEL=subject
 	partition_default="std"
 
-	echo "Which ANALYSIS PART do you want to perform? currently available are: 01_prep / 02_segment / 03_combine / 04_postproc_define_subs / 04_postproc / eval / determine_thresh / threshold_finder_01 / threshold_finder_02 "
+	echo "Which ANALYSIS PART do you want to perform? currently available are: 01_prep / 02_segment / 03_combine / 04_postproc / eval / determine_thresh / threshold_finder_01 / threshold_finder_02 "
 	read WMH_LEVEL
 	export PIPELINE_SUFFIX=_${WMH_LEVEL}
 
@@ -614,44 +625,25 @@ elif [ $PIPELINE == "wmh" ];then
 		
 		[ $ALGORITHM1 == $ALGORITHM2 ] && echo "$ALGORITHM1 == $ALGORITHM2 ... stupid" && exit 1
 
-	elif [ $WMH_LEVEL == "04_postproc_define_subs" ]; then 
-
-		INTERACTIVE==y
-		SUBJS_PER_NODE=100 # DO NOT CHANGE !
-		length=($(ls $BIDS_DIR/sub-* -d | xargs -n 1 basename | wc -l))
-		number_of_scripts=$(echo "scale=2; $length/$SUBJS_PER_NODE" | bc)
-		number_of_scripts_rounded=$(echo $number_of_scripts | awk '{print ($0-int($0)>0)?int($0)+1:int($0)}')
-		DERIVATIVE_dir=$DATA_DIR/$PIPELINE/derivatives
-		[ ! -d $DERIVATIVE_dir ] && mkdir $DERIVATIVE_dir
-
-		for num in $(seq 1 $number_of_scripts_rounded); do
-    		start=$(($num * $SUBJS_PER_NODE))
-    		[ $start == 1 ] && echo $(ls $BIDS_DIR/sub-* -d -1 | xargs -n 1 basename | head -n $start ) > $DERIVATIVE_dir/sublist_${num}.csv
-    		[ $start != 1 ] && echo $(ls $BIDS_DIR/sub-* -d -1 | xargs -n 1 basename | head -n $start | tail -n $SUBJS_PER_NODE) > $DERIVATIVE_dir/sublist_${num}.csv
-
-		done
-
-		exit 1
-
 	elif [ $WMH_LEVEL == "04_postproc" ]; then 
 
-		export sublist=${subj_array[@]}
-		export SUBJS_PER_NODE=100 # DO NOT CHANGE!
-		export ANALYSIS_LEVEL=group
-		batch_time_default="2-00:00:00"
-
-		[ $subj_array_length -gt $SUBJS_PER_NODE ] && echo "please define a subject list! subject lists are in $PIPELINE/derivatives or can be created with the option: 04_postproc_define_subs"
-		[ $subj_array_length -gt $SUBJS_PER_NODE ] && exit 1
-
-		echo "Which algorithm do you want to evaluate?"
+		echo "Which algorithm do you want to postprocess?"
 		#echo "Choose from: $(ls $DATA_DIR/$PIPELINE/sub-*/ses-$SESSION/anat/*/ -d | xargs -n 1 basename | sort | uniq)"
 		read ALGORITHM; export ALGORITHM
+
+		echo "which analysis level you want to perform? possible answers: subject / group. subject writes masks and volumes per subject, group combines the volumes of all subjects. Please execute subject before group."
+		read ANALYSIS_LEVEL; export ANALYSIS_LEVEL
+
+		export SUBJS_PER_NODE=8
+		batch_time_default="04:00:00"
+		[ $ANALYSIS_LEVEL == "group" ] && export SUBJS_PER_NODE=$subj_array_length
+		[ $ANALYSIS_LEVEL == "group" ] && batch_time_default="00:30:00"
 		
 	elif [ $WMH_LEVEL == "eval" ]; then 
 
 		export SUBJS_PER_NODE=$subj_array_length
 		export ANALYSIS_LEVEL=group
-		batch_time_default="01:00:00"
+		batch_time_default="00:15:00"
 
 		echo "This script evaluates the segmented masks of different algorithms."
 		echo "Which algorithm do you want to evaluate? Choose from: $(ls $DATA_DIR/$PIPELINE/sub-*/ses-$SESSION/anat/*/ -d | xargs -n 1 basename | sort | uniq)"
@@ -692,7 +684,7 @@ elif [ $PIPELINE == "wmh" ];then
 
 		export ANALYSIS_LEVEL=group
 		[ $ALGORITHM_COMBI == "single" ] && batch_time_default="01:00:00"
-		[ $ALGORITHM_COMBI == "multiple" ] && batch_time_default="02:30:00"
+		[ $ALGORITHM_COMBI == "multiple" ] && batch_time_default="01:00:00"
 		export SUBJS_PER_NODE=8
 
 	elif [ $WMH_LEVEL == "threshold_finder_02" ]; then 
@@ -829,6 +821,28 @@ elif [ $PIPELINE == "statistics" ];then
 
 	fi
 
+	echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"		
+	echo "How many permutations? Default is 5000"
+	read NSHUFFLES; [ -z $NSHUFFLES ] && NSHUFFLES=5000; export NSHUFFLES
+
+	# Sharding needs job arrays, interactive sessions run the whole test
+	if [ $INTERACTIVE != y ]; then
+		echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"		
+		echo "In how many shards (nodes) do you want to split the permutations? Default is 1 (one job)"
+		echo "Shards are submitted as job array and merged by a dependent job; allocate time per shard"
+		[ $STAT_METHOD == tfce_tbss ] && echo "tfce_tbss only runs the tests if split into shards, otherwise results of previous runs are visualized"
+		read PERM_SHARDS
+
+		if [ "${PERM_SHARDS:-1}" -gt 1 ]; then
+			echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"
+			echo "How much time do you want to allocate for merging the shards? Default is 02:00:00"
+			echo "Leave empty to choose default"
+			read PERM_MERGE_TIME
+		fi
+	fi
+	[ -z $PERM_SHARDS ] && PERM_SHARDS=1; export PERM_SHARDS
+	[ -z $PERM_MERGE_TIME ] && PERM_MERGE_TIME="02:00:00"
+
 elif [ $PIPELINE == "pvs_frangi" ] ;then
 
 	echo "Which ANALYSIS PART do you want to perform? currently available are: postproc, summary"
@@ -854,15 +868,27 @@ elif [ $PIPELINE == "pvs_frangi" ] ;then
 
 elif [ $PIPELINE == "pvs_rorpo" ] ;then
 
-	export SUBJS_PER_NODE=120
-	export ANALYSIS_LEVEL=subject
-	partition_default="std"
-	batch_time_default="01:00:00"
-
-	echo "Which ANALYSIS PART do you want to perform? currently available are: postproc"
+	echo "Which ANALYSIS PART do you want to perform? currently available are: postproc, summary"
 	read ANALYSIS_PART
 	export PIPELINE_SUFFIX=_${ANALYSIS_PART}
 
+	if [ $ANALYSIS_PART == postproc ];then
+
+		export ANALYSIS_LEVEL=subject
+		export SUBJS_PER_NODE=120
+		partition_default="std"
+		batch_time_default="01:00:00"
+
+	elif [ $ANALYSIS_PART == summary ];then
+
+		export ANALYSIS_LEVEL=group
+		export SUBJS_PER_NODE=$subj_array_length
+		partition_default="std"
+		batch_time_default="00:10:00"
+		export sublist=${subj_array[@]}
+
+	fi
+
 elif [ $PIPELINE == "registration" ];then
 
 	echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"		
@@ -959,9 +985,9 @@ if [ $INTERACTIVE != y ]; then
 	# Set batch time to allocate and partition
 	echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"
 	echo "How much time do you want to allocate? Default is $(echo $batch_time_default)"
+	echo "For subject level processing the default is estimated per job from runtimes of previous runs, if available"
 	echo "Leave empty to choose default"
 	read batch_time
-	[ -z $batch_time ] && batch_time=$batch_time_default
 
 	echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"
 	echo "Which partition do you want to submit to? Default is $(echo $partition_default)"
@@ -971,11 +997,26 @@ if [ $INTERACTIVE != y ]; then
 
 	echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"
 	echo "Do you want to provide additional flags for sbatch submission? e.g. '--hold' or '--dependency=afterok:job_id' or '--begin=16:00'"
+	echo "To submit a pipeline together with all stages it depends on (chained per subject) use utils/pipeline_dag.py instead"
+	echo "To submit several pipelines and sessions non-interactively as job arrays use utils/submit_runs.py with a run spec"
 	echo "Leave empty to choose default"
 	read optional_slurm_flags
 
 fi
 
+# Drop subjects whose outputs are current, i.e. whose inputs, containers and parameters did not change since processing
+if [ "$SKIP_CURRENT" != "n" ]; then
+	subj_filtered=$(python3 $CODE_DIR/utils/provenance.py filter -s ${subj_array[@]})
+	if [ $? != 0 ]; then
+		echo "Filtering current subjects failed; submitting all $subj_array_length subjects"
+	else
+		subj_array=($subj_filtered)
+		subj_array_length=${#subj_array[@]}
+		[ $subj_array_length == 0 ] && echo "Outputs of all subjects are current. Set SKIP_CURRENT=n to reprocess them." && exit 0
+		[ "$ANALYSIS_LEVEL" == group ] && export SUBJS_PER_NODE=$subj_array_length
+	fi
+fi
+
 # Define batch script
 script_name="02_pipelines_batch.sh"
 SCRIPT_PATH=$CODE_DIR/$script_name
@@ -985,27 +1026,44 @@ SCRIPT_PATH=$CODE_DIR/$script_name
 echo "◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️◼️"	
 echo Submitting $subj_array_length subjects for $PIPELINE processing
 
-batch_amount=$(($subj_array_length / $SUBJS_PER_NODE))
 export ITER=0
 
-# If modulo of subject array length and subjects per node is not 0 -> add one iteration to make sure all subjects will be submitted
-[ ! $(( $subj_array_length % $SUBJS_PER_NODE )) -eq 0 ] && batch_amount=$(($batch_amount + 1))
+# Submit one batch of subjects; arg1 - time to allocate, arg2... - subjects
+submit_batch() {
 
-# Loop through subject batches for submission
-for batch in $(seq $batch_amount);do
-
-	# Slice subj array from index $ITER for the amount of $SUBJS_PER_NODE subjects
-	subj_batch_array=${subj_array[@]:$ITER:$SUBJS_PER_NODE}
+	job_time=$1; shift
+	subj_batch_array=($@)
 
 	# In case of interactive session run $SCRIPT_PATH directly
 	if [ $INTERACTIVE == y ]; then
 
 		srun $SCRIPT_PATH "${subj_batch_array[@]}"
 
+	elif [ $INTERACTIVE == n ] && [ "${PERM_SHARDS:-1}" -gt 1 ]; then
+
+		# Permutation shards as job array, merged once all shards succeeded
+		log=$CODE_DIR/log/"%A-${PIPELINE}-$ITER-$(date +%d%m%Y)"
+		shard_job=$(PERM_STEP=shard sbatch --parsable --array=0-$(($PERM_SHARDS - 1)) \
+			--job-name ${PIPELINE}${PIPELINE_SUFFIX} \
+			--time ${job_time} \
+			--partition $partition $optional_slurm_flags \
+			--output ${log}-%a.out \
+			--error ${log}-%a.err \
+			$SCRIPT_PATH "${subj_batch_array[@]}")
+		echo "Submitted permutation shards as job array $shard_job"
+
+		PERM_STEP=merge sbatch --job-name ${PIPELINE}${PIPELINE_SUFFIX}_merge \
+			--time $PERM_MERGE_TIME \
+			--partition $partition $optional_slurm_flags \
+			--dependency=afterok:$shard_job --kill-on-invalid-dep=yes \
+			--output ${log}-merge.out \
+			--error ${log}-merge.err \
+			$SCRIPT_PATH "${subj_batch_array[@]}"
+
 	elif [ $INTERACTIVE == n ]; then
 
 	    CMD="sbatch --job-name ${PIPELINE}${PIPELINE_SUFFIX} \
-	        --time ${batch_time} \
+	        --time ${job_time} \
 	        --partition $partition $optional_slurm_flags \
 	        --output $CODE_DIR/log/"%A-${PIPELINE}-$ITER-$(date +%d%m%Y).out" \
 	        --error $CODE_DIR/log/"%A-${PIPELINE}-$ITER-$(date +%d%m%Y).err" \
@@ -1018,7 +1076,45 @@ for batch in $(seq $batch_amount);do
 		exit 1
 	fi
 
-	# Increase ITER by SUBJS_PER_NODE
-	export ITER=$(($ITER+$SUBJS_PER_NODE))
+	# Increase ITER by number of submitted subjects
+	export ITER=$(($ITER+${#subj_batch_array[@]}))
+}
+
+# Pack subjects into jobs by runtime and memory of previous runs (telemetry table, GNU parallel joblog and SLURM accounting)
+if [ $INTERACTIVE == n ] && [ "$ANALYSIS_LEVEL" == subject ]; then
+	PACKING_FILE=$CODE_DIR/log/$(date +%d%m%Y%H%M%S)-${PIPELINE}${PIPELINE_SUFFIX}-packing.txt
+	python3 $CODE_DIR/utils/pack_jobs.py \
+		-p ${PIPELINE}${PIPELINE_SUFFIX} \
+		-s ${subj_array[@]} \
+		-n $SUBJS_PER_NODE \
+		--mem $HPC_MEM \
+		-t $CODE_DIR/log/telemetry.csv \
+		-j $CODE_DIR/log/parallel_runtask.log \
+		-o $PACKING_FILE \
+		|| rm -f $PACKING_FILE
+fi
+
+if [ -f "$PACKING_FILE" ]; then
 
-done
+	# Loop through packed jobs; an explicitly provided time overrides the estimated one
+	while read job_time subj_batch; do
+		submit_batch ${batch_time:-$job_time} $subj_batch
+	done < $PACKING_FILE
+
+else
+
+	[ -z $batch_time ] && batch_time=$batch_time_default
+	batch_amount=$(($subj_array_length / $SUBJS_PER_NODE))
+
+	# If modulo of subject array length and subjects per node is not 0 -> add one iteration to make sure all subjects will be submitted
+	[ ! $(( $subj_array_length % $SUBJS_PER_NODE )) -eq 0 ] && batch_amount=$(($batch_amount + 1))
+
+	# Loop through subject batches for submission
+	for batch in $(seq $batch_amount);do
+
+		# Slice subj array from index $ITER for the amount of $SUBJS_PER_NODE subjects
+		submit_batch $batch_time ${subj_array[@]:$ITER:$SUBJS_PER_NODE}
+
+	done
+
+fi
@@ -1,7 +1,7 @@
 #!/usr/bin/env bash
 
 #SBATCH --nodes=1
-#SBATCH --export=SCRIPT_DIR,PIPELINE,PIPELINE_SUFFIX,SESSION,SUBJS_PER_NODE,ITER,ANALYSIS_LEVEL,OUTPUT_SPACES,BIDS_PIPE,HEURISTIC,METADATA_EXTRA,RECON,OUTPUT_RESOLUTION,MRIQC_LEVEL,TBSS_PIPELINE,TBSS_MERGE_LIST,MODIFIER,ALGORITHM,DESIGN,BIASCORR,ALGORITHM_MIX,ALGORITHM1,ALGORITHM2,BIASCORR1,BIASCORR2,ORIG_SPACE,TEMP_SPACE,LESION_DIR,READOUT_SPACE,ANAT_PREPROC,LOCATE_LEVEL,BIANCA_LEVEL,sublist,REGISTRATION_METHOD,REGISTRATION_TASK,TEMPLATE_WARP,MASKING,INTERPOLATION,INPUT_T1_HIPPUNFOLD,HIPPUNFOLD_OUTPUT_DENSITY
+#SBATCH --export=SCRIPT_DIR,PIPELINE,PIPELINE_SUFFIX,SESSION,SUBJS_PER_NODE,ITER,ANALYSIS_LEVEL,OUTPUT_SPACES,BIDS_PIPE,HEURISTIC,METADATA_EXTRA,RECON,OUTPUT_RESOLUTION,MRIQC_LEVEL,TBSS_PIPELINE,TBSS_MERGE_LIST,MODIFIER,ALGORITHM,DESIGN,BIASCORR,ALGORITHM_MIX,ALGORITHM1,ALGORITHM2,BIASCORR1,BIASCORR2,ORIG_SPACE,TEMP_SPACE,LESION_DIR,READOUT_SPACE,ANAT_PREPROC,LOCATE_LEVEL,BIANCA_LEVEL,sublist,REGISTRATION_METHOD,REGISTRATION_TASK,TEMPLATE_WARP,MASKING,INTERPOLATION,INPUT_T1_HIPPUNFOLD,HIPPUNFOLD_OUTPUT_DENSITY,CONTAINER_INSTANCES,CONTAINER_TIMING,PSMD_PIPE,PROVENANCE_CONTENT,MANIFEST,RUN_ENV,ASSET_CACHE,ASSET_CACHE_QUOTA_GB,NSHUFFLES,PERM_SHARDS,PERM_STEP,PSMD_PROJECTION
 
 ###################################################################################################################
 # Batch script to prepare and parallelize pipeline execution
@@ -24,6 +24,9 @@ umask u=rwx g=rwx
 # Do not dump core files
 ulimit -c 0
 
+# Job arrays of utils/submit_runs.py pass pipeline and parameters in the run's env file instead of --export
+[ -n "$RUN_ENV" ] && source $RUN_ENV
+
 # Source project environment
 set -o allexport
 source $SCRIPT_DIR/environment.conf
@@ -36,13 +39,32 @@ export SINGULARITY_CACHEDIR=$SCRATCH_DIR/singularity_cache; 	[ ! -d $SINGULARITY
 export SINGULARITY_TMPDIR=$SCRATCH_DIR/singularity_tmp; 		[ ! -d $SINGULARITY_TMPDIR ] && mkdir -p $SINGULARITY_TMPDIR
 export SINGULARITYENV_FS_LICENSE=$ENV_DIR/freesurfer_license.txt
 
+# Node-local cache of read-only assets (container images, templates, atlases) shared by all jobs on this node;
+# pipeline scripts resolve asset paths via $ASSET_PATH, entries used by this job are unpinned when the job ends
+export ASSET_PATH="python3 $CODE_DIR/utils/asset_cache.py path"
+asset_release="python3 $CODE_DIR/utils/asset_cache.py release"
+
+# Persistent container instances shared by all subjects on this node; stopped when the job ends
+export CONTAINER_RUN="$CODE_DIR/utils/container_instances.sh run"
+# With CONTAINER_TIMING=y the startup time saved by the instances is reported before teardown
+[ "$CONTAINER_TIMING" == "y" ] && trap "$CODE_DIR/utils/container_instances.sh report; $CODE_DIR/utils/container_instances.sh stop; $asset_release" EXIT
+[ "$CONTAINER_TIMING" != "y" ] && trap "$CODE_DIR/utils/container_instances.sh stop; $asset_release" EXIT
+
 if [ -z $ANALYSIS_LEVEL ];then
 	echo "Specify analysis level. (subject/group)"
 	read ANALYSIS_LEVEL; export ANALYSIS_LEVEL
 fi
 
-# Define subarray of subjects to process
-subj_batch_array=($@)
+# Define subarray of subjects to process; array tasks read their line of the run's manifest
+if [ -n "$SLURM_ARRAY_TASK_ID" ] && [ -n "$MANIFEST" ];then
+	subj_batch_array=($(sed -n "$(($SLURM_ARRAY_TASK_ID + 1))p" $MANIFEST))
+	export ITER=$SLURM_ARRAY_TASK_ID
+	[ -n "$BATCH_ENV" ] && export $BATCH_ENV="${subj_batch_array[*]}"
+else
+	subj_batch_array=($@)
+fi
+
+export SUBJ_BATCH="${subj_batch_array[*]}"
 
 # Provide feedback to user
 echo starting processing with $PIPELINE from index: $ITER ...
@@ -73,15 +95,36 @@ cd $PROJ_DIR
 # Run pipeline
 PROC_SCRIPT=$PIPELINE_DIR/${PIPELINE}${PIPELINE_SUFFIX}.sh
 
+# Fingerprint inputs, containers and parameters before processing; recorded for successfully processed subjects
+# so that later submissions skip subjects whose outputs are current (see utils/provenance.py)
+FINGERPRINTS=$CODE_DIR/log/provenance/${SLURM_JOBID}.tsv
+python3 $CODE_DIR/utils/provenance.py fingerprint -s ${subj_batch_array[@]} -o $FINGERPRINTS
+
+# Stage the container images of the processing script once, before all subjects start at the same time
+python3 $CODE_DIR/utils/asset_cache.py prefetch --script $PROC_SCRIPT
+
 if [ $ANALYSIS_LEVEL == subject ];then
 
+	# Each subject task is wrapped by telemetry.py recording wall/CPU time, peak RSS and scratch usage to a per-job file
+	TELEMETRY_RECORD=$CODE_DIR/log/telemetry/${SLURM_JOBID}.csv
+	telemetry="python3 $CODE_DIR/utils/telemetry.py run --record $TELEMETRY_RECORD --"
+
 	parallel="parallel --ungroup --delay 0.2 -j$SUBJS_PER_NODE --joblog $CODE_DIR/log/parallel_runtask.log"
-	echo -e "running:\n $parallel $proc_script {} ::: ${subj_batch_array[@]}"
-	$parallel $PROC_SCRIPT ::: ${subj_batch_array[@]}
+	echo -e "running:\n $parallel $telemetry $PROC_SCRIPT {} ::: ${subj_batch_array[@]}"
+	$parallel $telemetry $PROC_SCRIPT ::: ${subj_batch_array[@]}
+
+	# Merge records of this job into project-level table and summarize them
+	python3 $CODE_DIR/utils/telemetry.py merge --record $TELEMETRY_RECORD --table $CODE_DIR/log/telemetry.csv
+	python3 $CODE_DIR/utils/telemetry.py report --table $TELEMETRY_RECORD --top 3
+
+	python3 $CODE_DIR/utils/provenance.py record --fingerprints $FINGERPRINTS --telemetry $TELEMETRY_RECORD
 
 elif [ $ANALYSIS_LEVEL == group ];then
 
-	source $PROC_SCRIPT "${subj_batch_array[@]}"
+	# Subshell so that the status of the whole script is recorded (and an exit within it does not end this job script)
+	( source $PROC_SCRIPT "${subj_batch_array[@]}" ); rc=$?
+
+	python3 $CODE_DIR/utils/provenance.py record --fingerprints $FINGERPRINTS --exit-code $rc
 	
 fi
 
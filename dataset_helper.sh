@@ -298,32 +298,22 @@ elif [ $PIPELINE == missing_outputs ];then
 
 	[ -z $out_file ] && out_file=$default_out
 
+	# Subject directories and files are looked up in a cached index of data/ (only changed directories are read again)
 	if [ $file_or_subdir == subdir ];then
 
-		for ds in ${subds[@]};do
-			pushd $DATA_DIR/$subds
-			diff -q $DATA_DIR/$template_dir . | grep "Only in ${DATA_DIR}/${template_dir}: sub-" | cut -d' ' -f 4 > $out_file 
-			popd
-		done
-
-		echo "Finished writing to $out_file"
+		python3 $CODE_DIR/utils/completion_index.py missing --datasets ${subds[@]} --template $template_dir --output $out_file
 
 	elif [ $file_or_subdir == in_subdir ];then
 		echo "Please provide search term pattern you want to match; e.g. 'dwi.nii.gz' will match everything with that string."
 		read search
 
-		for ds in ${subds[@]};do
-			pushd $DATA_DIR/$ds
-			arr_search=($(find $DATA_DIR/$ds -type f | grep $search | grep sub | cut -d'/' -f 8))
-			arr_template=($(ls $DATA_DIR/$template_dir/sub-*/ -d | rev | cut -d '/' -f 2 | rev))
-			echo "#####################################"
-			echo ${arr_search[@]} ${arr_template[@]} | tr ' ' '\n' | sort | uniq -u
-			echo ${arr_search[@]} ${arr_template[@]} | tr ' ' '\n' | sort | uniq -u > $out_file
-			#find . -mindepth 1 -maxdepth 1 -type d '!' -exec test -e "{}/${search}" ';' -print | grep sub | cut -d"/" -f 2 > $out_file
-			popd
-		done
+		python3 $CODE_DIR/utils/completion_index.py missing --datasets ${subds[@]} --template $template_dir --search $search --output $out_file
+		cat $out_file
 	fi
 
+	echo "Finished writing to $out_file"
+	echo "Resubmit missing subjects e.g. via 'bash $CODE_DIR/01_pipelines_submission.sh \$(cat $out_file)'"
+
 elif [ $PIPELINE == if_in_s3 ];then
 
 	echo "Which S3 bucket do you want to look at?"
@@ -397,79 +387,14 @@ elif [ $PIPELINE == qa_missings ]; then
 	export DERIVATIVES_dir=$BIDS_DIR/derivatives
 	[ ! -d $DERIVATIVES_dir ] && mkdir -p $DERIVATIVES_dir
 
-	# set up the output file
+	# Completion of raw data and pipeline outputs from a cached index of data/ (only changed directories are read again)
+	# Writes $DERIVATIVES_dir/qa-raw_bids.csv and one subject list per missing output to $CODE_DIR/log/missing/
 	export OUTPUT_FILE=$DERIVATIVES_dir/qa-raw_bids.csv
-	echo "subjectID SESSION missing_flair missing_t1 missing_t2 missing_dwi missing_func missing_asl missing_m0 missing_aslprep missing_cat missing_conn_struc missing_conn_func missing_fba missing_fmriprep_struc missing_fmriprep_func missing_freesurfer missing_freewater missing_mriqcstruc missing_mriqcfunc missing_obseg missing_psmd missing_qsiprep missing_qsirecon missing_tbss missing_wmh missing_xcpengine" > $OUTPUT_FILE
-
-
-	for sub in $(cat $BIDS_DIR/sourcedata/participants.tsv); do
-
-		# raw_bids output
-		FLAIR=$BIDS_DIR/sub-${sub}/ses-${SESSION}/anat/sub-${sub}_ses-${SESSION}_FLAIR.nii.gz
-		T1=$BIDS_DIR/sub-${sub}/ses-${SESSION}/anat/sub-${sub}_ses-${SESSION}_T1w.nii.gz
-		T2=$BIDS_DIR/sub-${sub}/ses-${SESSION}/anat/sub-${sub}_ses-${SESSION}_T2w.nii.gz
-		DWI=$BIDS_DIR/sub-${sub}/ses-${SESSION}/dwi/sub-${sub}_ses-${SESSION}_acq-AP_dwi.nii.gz
-		FUNC=$BIDS_DIR/sub-${sub}/ses-${SESSION}/func/sub-${sub}_ses-${SESSION}_task-rest_bold.nii.gz
-		ASL=$BIDS_DIR/sub-${sub}/ses-${SESSION}/perf/sub-${sub}_ses-${SESSION}_asl.nii.gz
-		M0=$BIDS_DIR/sub-${sub}/ses-${SESSION}/perf/sub-${sub}_ses-${SESSION}_m0scan.nii.gz
-
-		# pipeline_specific output
-		ASLPREP=$DATA_DIR/aslprep/sub-${sub}/ses-${SESSION}/perf/sub-${sub}_ses-${SESSION}_space-MNI152NLin2009cAsym_desc-basil_cbf.nii.gz
-		CAT12=$DATA_DIR/cat12/sub-${sub}/surf/rh.thickness.T1
-		CONNECTOMICS_STRUC=$DATA_DIR/connectomics/sub-${sub}/ses-${SESSION}/dwi/sub-${sub}_ses-${SESSION}_*_sc_sift_connectomics.csv
-		CONNECTOMICS_FUNC=$DATA_DIR/connectomics/sub-${sub}/ses-${SESSION}/func/sub-${sub}_ses-${SESSION}_*_connectomics.csv
-		FBA=$DATA_DIR/fba/derivatives/fdc_smooth/sub-${sub}.mif
-		FMRIPREP_STRUC=$DATA_DIR/fmriprep/sub-${sub}/ses-${SESSION}/anat/sub-${sub}_ses-${SESSION}_desc-preproc_T1w.nii.gz
-		FMRIPREP_FUNC=$DATA_DIR/fmriprep/sub-${sub}/ses-${SESSION}/func/sub-${sub}_ses-${SESSION}_task-rest_desc-preproc_bold.nii.gz
-		FREESURFER=$DATA_DIR/freesurfer/sub-${sub}/stats/aseg.stats
-		FREEWATER=$DATA_DIR/freewater/sub-${sub}/ses-1/dwi/sub-${sub}_ses-${SESSION}_space-MNI_FW.nii.gz
-		MRIQC_STRUC=$DATA_DIR/mriqc/sub-${sub}/ses-${SESSION}/anat/sub-${sub}_ses-${SESSION}_T1w.json
-		MRIQC_FUNC=$DATA_DIR/mriqc/sub-${sub}/ses-${SESSION}/func/sub-${sub}_ses-${SESSION}_task-rest_bold.json
-		OBSEG=$DATA_DIR/obseg/sub-${sub}/stats/segmentation_stats.csv
-		PSMD=$DATA_DIR/psmd*/sub-${sub}/ses-${SESSION}/dwi/tbss/stats/MD_skeletonised_masked_R.nii.gz
-		QSIPREP=$DATA_DIR/qsiprep/sub-${sub}/ses-${SESSION}/dwi/sub-${sub}_ses-${SESSION}_acq-AP_space-T1w_desc-preproc_dwi.nii.gz
-		QSIRECON=$DATA_DIR/qsirecon/sub-${sub}/ses-${SESSION}/dwi/sub-${sub}_ses-${SESSION}_acq-AP_space-T1w_desc-preproc_space-T1w_dhollanderconnectome.mat
-		TBSS=$DATA_DIR/tbss_*/sub-${sub}/ses-${SESSION}/dwi/sub-${sub}_ses-${SESSION}_space-MNI_desc-eroded_desc-DTINoNeg_FA.nii.gz
-		WMH=$DATA_DIR/wmh/sub-${sub}/ses-${SESSION}/anat/sub-${sub}_ses-${SESSION}_space-FLAIR_desc-masked_desc-wmhperi_desc-*_mask.nii.gz
-		XCPENGINE=$DATA_DIR/xcpengine/sub-${sub}/fcon/schaefer400x7/sub-${sub}_schaefer400x7_network.txt
-
-		# editing
-		CONNECTOMICS_STRUC=$(echo $CONNECTOMICS_STRUC | awk '{print $1}')
-		CONNECTOMICS_FUNC=$(echo $CONNECTOMICS_FUNC | awk '{print $1}')
-		TBSS=$(echo $TBSS | awk '{print $1}')
-		WMH=$(echo $WMH | awk '{print $1}')
-
-		# check status
-		[ -f $FLAIR ] && missing_flair=0 || missing_flair=1 
-		[ -f $T1 ] && missing_t1=0 || missing_t1=1 
-		[ -f $T2 ] && missing_t2=0 || missing_t2=1 
-		[ -f $DWI ] && missing_dwi=0 || missing_dwi=1 
-		[ -f $FUNC ] && missing_func=0 || missing_func=1 
-		[ -f $ASL ] && missing_asl=0 || missing_asl=1 
-		[ -f $M0 ] && missing_m0=0 || missing_m0=1 
-		[ -f $ASLPREP ] && missing_aslprep=0 || missing_aslprep=1 
-		[ -f $CAT12 ] && missing_cat=0 || missing_cat=1 
-		[ -f $CONNECTOMICS_STRUC ] && missing_conn_struc=0 || missing_conn_struc=1
-		[ -f $CONNECTOMICS_FUNC ] && missing_conn_func=0 || missing_conn_func=1 
-		[ -f $FBA ] && missing_fba=0 || missing_fba=1 
-		[ -f $FMRIPREP_STRUC ] && missing_fmriprep_struc=0 || missing_fmriprep_struc=1 
-		[ -f $FMRIPREP_FUNC ] && missing_fmriprep_func=0 || missing_fmriprep_func=1 
-		[ -f $FREESURFER ] && missing_freesurfer=0 || missing_freesurfer=1 
-		[ -f $FREEWATER ] && missing_freewater=0 || missing_freewater=1 
-		[ -f $MRIQC_STRUC ] && missing_mriqcstruc=0 || missing_mriqcstruc=1 
-		[ -f $MRIQC_FUNC ] && missing_mriqcfunc=0 || missing_mriqcfunc=1 
-		[ -f $OBSEG ] && missing_obseg=0 || missing_obseg=1 
-		[ -f $PSMD ] && missing_psmd=0 || missing_psmd=1 
-		[ -f $QSIPREP ] && missing_qsiprep=0 || missing_qsiprep=1 
-		[ -f $QSIRECON ] && missing_qsirecon=0 || missing_qsirecon=1 
-		[ -f $TBSS ] && missing_tbss=0 || missing_tbss=1 
-		[ -f $WMH ] && missing_wmh=0 || missing_wmh=1 
-		[ -f $XCPENGINE ] && missing_xcpengine=0 || missing_xcpengine=1 
-
-		# write in output file
-		echo "sub-${sub} ses-${SESSION} $missing_flair $missing_t1 $missing_t2 $missing_dwi $missing_func $missing_asl $missing_m0 $missing_aslprep $missing_cat $missing_conn_struc $missing_conn_func $missing_fba $missing_fmriprep_struc $missing_fmriprep_func $missing_freesurfer $missing_freewater $missing_mriqcstruc $missing_mriqcfunc $missing_obseg $missing_psmd $missing_qsiprep $missing_qsirecon $missing_tbss $missing_wmh $missing_xcpengine" >> $OUTPUT_FILE
-
-	done
+	python3 $CODE_DIR/utils/completion_index.py qa \
+		--session $SESSION \
+		--participants $BIDS_DIR/sourcedata/participants.tsv \
+		--output $OUTPUT_FILE \
+		--missing-dir $CODE_DIR/log/missing
 
 	# example command for checking missing subjects on MASTER_NAS in the dicoms directory:
 	# for i in `cat /media/sda/PhD/hummel_marvin/projects/CSI_HCHS/data/raw_bids/derivatives/qa-raw_bids.csv`; do missing_flair=$(echo $i | awk '{print $3}'); sub=$(echo $i | awk '{print $1}' | tail -c 9); if [ $missing_flair == 1 ]; then echo $sub $missing_flair; fi; if [ $missing_flair == 1 ]; then ls /media/sda/MASTER_NAS/HCHS/DICOMS_HCHS/DICOMS_HCHS/ds_10000/out/$sub/ses-1/* -d ; fi; done
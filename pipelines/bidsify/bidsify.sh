@@ -19,7 +19,7 @@
 ########                                                                                                          #
 #                                                                                                                 #
 # The following files are dataset specific and must be present in $ENV_DIR/bidsify/                               #
-#  - heudiconv_*.py                                                                                               #
+#  - heudiconv_*.json (mapping, see heuristic_engine.py) or heudiconv_*.py (heuristic, loaded as configuration)    #
 #  - metadataextra_*.py                                                                                           #
 #                                                                                                                 #
 # In case of different acquisitions define subjects corresponding to heuristic/metadataextra during submission    #
@@ -78,6 +78,73 @@ singularity_fsl="singularity run --cleanenv --userns \
    -B $TMP_OUT:/tmp_out \
    $ENV_DIR/$container_fsl"
 
+# Stage DICOM tarballs on node scratch
+######################################
+
+# Session tarballs are copied from $DCM_DIR with large sequential reads and decompressed with pigz into the
+# uncompressed tarball $TMP_IN/<sub>/ses-<ses>.tar, which heudiconv reads instead of the compressed one. While a
+# session converts, the next session of the subject is copied in the background, as are the tarballs of the subject
+# which takes over this subject's slot of the parallel run (PARALLEL_SEQ + SUBJS_PER_NODE in $SUBJ_BATCH). Copies are
+# shared by all subjects on the node in $STAGING_DIR; a lock per tarball makes a subject wait for its running prefetch
+# instead of reading twice. The sha1 of a tarball, which identifies it in the seqinfo cache, is computed while copying.
+
+STAGING_DIR=$SCRATCH_DIR/dicom_staging;  [ ! -d $STAGING_DIR ] && mkdir -p $STAGING_DIR
+[ -n "$(command -v pigz)" ] && UNZIP="pigz -dc -p $SLURM_CPUS_PER_TASK" || UNZIP="gzip -dc"
+
+copy_tarball() {
+
+   # Copy $DCM_DIR/<sub>/ses-<ses>.tar.gz to $STAGING_DIR, unless it is already there
+   local sub=$1 ses=$2
+   local copy=$STAGING_DIR/${sub}_ses-${ses}.tar.gz
+   local tmp=$STAGING_DIR/.tmp_$$_${sub}_ses-${ses}.tar.gz
+   (
+      flock 9
+      set -o pipefail
+      if [ ! -f $copy ]; then
+         dd if=$DCM_DIR/$sub/ses-${ses}.tar.gz bs=64M status=none | tee $tmp | sha1sum | cut -d' ' -f 1 > $tmp.sha1 \
+            && mv $tmp.sha1 $copy.sha1 && mv $tmp $copy
+      fi
+   ) 9>$copy.lock
+}
+
+prefetch_subject() {
+
+   # Copy all session tarballs of the subject that runs next in this slot
+   local sub=$1
+   [ -d $DCM_DIR/$sub ] || return 0
+   for ses in $(ls $DCM_DIR/$sub/ses-*.tar.gz 2>/dev/null | xargs -n 1 basename | cut -d'.' -f 1 | cut -d'-' -f 2); do
+      copy_tarball $sub $ses
+   done
+}
+
+stage_session() {
+
+   # Decompress the (prefetched) copy into $TMP_IN/<sub>/ses-<ses>.tar, keep its sha1 in $TARBALL_SHA1 and remove the copy
+   local sub=$1 ses=$2
+   copy_tarball $sub $ses || return 1
+   mkdir -p $TMP_IN/$sub
+   $UNZIP $STAGING_DIR/${sub}_ses-${ses}.tar.gz > $TMP_IN/$sub/ses-${ses}.tar || return 1
+   TARBALL_SHA1=$(cat $STAGING_DIR/${sub}_ses-${ses}.tar.gz.sha1 2>/dev/null)
+   rm -f $STAGING_DIR/${sub}_ses-${ses}.tar.gz $STAGING_DIR/${sub}_ses-${ses}.tar.gz.sha1 $STAGING_DIR/${sub}_ses-${ses}.tar.gz.lock
+}
+
+cleanup_staging() {
+
+   # Remove staged tarballs; if the job is killed, stop running prefetches and remove their partial copies. Otherwise
+   # only the session copies of this subject are waited for, the prefetch of the next subject continues
+   if [ "$STAGING_KILLED" == y ]; then
+      for pid in $(jobs -p); do pkill -TERM -P $pid; kill $pid; done 2>/dev/null
+      wait 2>/dev/null
+      rm -f $STAGING_DIR/.tmp_$$_*
+   else
+      [ -n "$SESSION_COPY_PIDS" ] && wait $SESSION_COPY_PIDS 2>/dev/null
+   fi
+   rm -rf $TMP_IN/$1
+}
+
+trap "cleanup_staging $1" EXIT
+trap "STAGING_KILLED=y; exit 143" TERM INT
+
 # Define sessions to process
 ############################
 
@@ -98,9 +165,27 @@ fi
 # BIDSIFICATION #
 #################
 
+# Tarballs of the next subject of this slot are copied while this subject converts
+NEXT_SUBJECT=$(echo $SUBJ_BATCH | tr ' ' '\n' | sed -n "$((${PARALLEL_SEQ:-0} + $SUBJS_PER_NODE))p")
+[ $BIDS_PIPE == "heudiconv" ] && [ -n "$PARALLEL_SEQ" ] && [ -n "$NEXT_SUBJECT" ] && prefetch_subject $NEXT_SUBJECT &
+
+SESSION_ARRAY=($SESSIONS)
+
 for SESSION in $SESSIONS; do
 
    if [ $BIDS_PIPE == "heudiconv" ]; then
+
+      # Staging
+      #########################
+
+      stage_session $1 $SESSION || { echo "Staging of $DCM_DIR/$1/ses-${SESSION}.tar.gz failed"; continue; }
+
+      # Copy the next session while this one converts
+      for i in ${!SESSION_ARRAY[@]}; do
+         [ "${SESSION_ARRAY[$i]}" == "$SESSION" ] && NEXT_SESSION=${SESSION_ARRAY[$(($i + 1))]}
+      done
+      [ -n "$NEXT_SESSION" ] && { copy_tarball $1 $NEXT_SESSION & SESSION_COPY_PIDS="$SESSION_COPY_PIDS $!"; }
+      NEXT_SESSION=
       
       # Command
       #########################
@@ -118,22 +203,31 @@ for SESSION in $SESSIONS; do
       # --grouping all \
       # --outdir /bids"
 
+      # heuristic_engine.py applies $HEURISTIC and reads the seqinfo of the session from a cache in $CODE_DIR/log/seqinfo,
+      # which is reused as long as the sha1 of the tarball is unchanged, so re-conversions skip the DICOM header scan of
+      # the staged session
+
+      export SINGULARITYENV_HEURISTIC_MAP=/code/pipelines/bidsify/$HEURISTIC
+      export SINGULARITYENV_SEQINFO_SHA1=$TARBALL_SHA1
+      export SINGULARITYENV_SEQINFO_CACHE=/code/log/seqinfo/${1}_ses-${SESSION}.json
+
       CMD_HEUDICONV="
-      --dicom_dir_template /dcm/{subject}/ses-{session}.tar.gz\
+      --dicom_dir_template /tmp_in/{subject}/ses-{session}.tar\
       --subjects $1 \
       --ses $SESSION \
       --bids notop \
-      --heuristic /code/pipelines/bidsify/$HEURISTIC\
+      --heuristic /code/pipelines/bidsify/heuristic_engine.py\
       --converter dcm2niix \
       --minmeta \
       --overwrite\
-      --grouping all \
+      --grouping custom \
       --outdir /bids"
 
       # Execution
       #########################
 
       $singularity_heudiconv $CMD_HEUDICONV
+      rm -f $TMP_IN/$1/ses-${SESSION}.tar
 
       # Amend permissions for defacing (-> w)
       [ -d $BIDS_DIR/sub-${1} ] && chmod 770 -R $BIDS_DIR/sub-${1} $BIDS_DIR/.heudiconv
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# Table-driven heudiconv heuristic with a persistent DICOM seqinfo cache
+#
+# Instead of one heudiconv_*.py with chains of `if ... == s.series_description` per dataset, the heuristic is a mapping
+# file (heudiconv_<dataset>.json) of BIDS keys and rules:
+#   {"keys":  {"t1w": "sub-{subject}/{session}/anat/sub-{subject}_{session}_T1w", ...},
+#    "rules": [{"key": "t1w", "series_description": "t1_mprage_cor_ND"},
+#              {"key": "t2w", "series_description": ["t2_space_cor_p4_iso_ND", "t2_tse_tra_ND"]},
+#              {"key": "asl", "series_description": "ss_TE00_TI1700", "series_files": {"min": 25}},
+#              {"key": "m0scan", "protocol_name": {"contains": "M0"}}, ...]}
+# A criterion is a string or list of strings (exact match), a number (equality, e.g. "dim4": 72) or an object with
+# contains / regex / min / max; all criteria of a rule have to match. Rules are compiled into dictionaries keyed by
+# their first exact criterion, so every series is looked up in O(1) instead of being tested against every rule; rules
+# without exact criterion are tested for every series. Existing heudiconv_*.py heuristics load as configurations
+# (their create_key and if statements are translated); heuristics with other constructs are delegated to as they are.
+#
+# heudiconv is run with this module as heuristic and --grouping custom. Its grouping reads the seqinfo of a session
+# from $SEQINFO_CACHE if it was written for the same tarball (identified by its sha1 $SEQINFO_SHA1, computed by
+# bidsify.sh while staging), so re-conversions after a mapping change skip the DICOM header scan.
+#
+# Environment (set by bidsify.sh): HEURISTIC_MAP, SEQINFO_SHA1, SEQINFO_CACHE
+#
+# execute e.g. via
+# python heuristic_engine.py convert heudiconv_hchs.py > heudiconv_hchs.json
+# python heuristic_engine.py check heudiconv_arctic.json .heudiconv/<sub>/info/dicominfo_ses-1.tsv
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import ast
+import csv
+import importlib.util
+import json
+import os
+import re
+import sys
+
+PIPELINE_DIR = Path(__file__).resolve().parent
+OPERATORS = {"contains", "regex", "min", "max"}
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Table-driven heudiconv heuristic; convert legacy heuristics or check mappings against dicominfo')
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser('convert', formatter_class=RawTextHelpFormatter,
+                                  help='print the mapping of a heudiconv_*.py heuristic as JSON')
+    convert.add_argument('heuristic', help='[required]\n heudiconv_*.py heuristic')
+    check = commands.add_parser('check', formatter_class=RawTextHelpFormatter,
+                                help='print the keys assigned to the series of a dicominfo.tsv')
+    check.add_argument('mapping', help='[required]\n mapping (heudiconv_*.json) or heudiconv_*.py heuristic')
+    check.add_argument('dicominfo', help='[required]\n dicominfo*.tsv of a heudiconv run (e.g. heudiconv_firstpass.sh)')
+    return parser
+
+
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    if template is None or not template:
+        raise ValueError('Template must be a valid format string')
+    return template, outtype, annotation_classes
+
+
+###########
+# Mapping #
+###########
+
+class Unsupported(ValueError):
+    """Construct of a legacy heuristic without mapping equivalent."""
+
+
+def criterion(node, names):
+    """(field, condition) of a comparison of the form 'x' == s.field, 'x' in s.field or s.field > n."""
+
+    if not (isinstance(node, ast.Compare) and len(node.ops) == 1):
+        raise Unsupported(ast.dump(node))
+    left, op, right = node.left, node.ops[0], node.comparators[0]
+
+    def field(attribute):
+        if isinstance(attribute, ast.Attribute) and isinstance(attribute.value, ast.Name) and attribute.value.id in names:
+            return attribute.attr
+        return None
+
+    def constant(value):
+        return value.value if isinstance(value, ast.Constant) else None
+
+    if isinstance(op, ast.Eq):
+        name, value = (field(right), constant(left)) if field(right) else (field(left), constant(right))
+        if name and value is not None:
+            return name, value
+    if isinstance(op, ast.In) and field(right) and isinstance(constant(left), str):
+        return field(right), {"contains": constant(left)}
+    bounds = {ast.Gt: ("min", 1), ast.GtE: ("min", 0), ast.Lt: ("max", -1), ast.LtE: ("max", 0)}
+    if type(op) in bounds and field(left) and isinstance(constant(right), int):
+        bound, shift = bounds[type(op)]
+        return field(left), {bound: constant(right) + shift}
+    raise Unsupported(ast.unparse(node))
+
+
+def conditions(test, names):
+    """Rules (dicts of field criteria) of an if test; `or` yields several rules, `and` several criteria."""
+
+    if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.Or):
+        return [rule for value in test.values for rule in conditions(value, names)]
+    if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.And):
+        rule = {}
+        for value in test.values:
+            name, condition = criterion(value, names)
+            if name in rule:
+                raise Unsupported(ast.unparse(test))
+            rule[name] = condition
+        return [rule]
+    name, condition = criterion(test, names)
+    return [{name: condition}]
+
+
+def convert(path):
+    """Mapping of a heudiconv_*.py heuristic from its create_key assignments and if statements in infotodict."""
+
+    module = ast.parse(Path(path).read_text())
+    function = next((node for node in module.body if isinstance(node, ast.FunctionDef) and node.name == "infotodict"), None)
+    if function is None:
+        raise Unsupported(f"{path} has no infotodict")
+
+    keys, used, rules = {}, None, []
+    for node in ast.walk(function):
+        # key = create_key('template', ...)
+        if (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)
+                and getattr(node.value.func, "id", None) == "create_key" and len(node.targets) == 1):
+            template = node.value.args[0] if node.value.args else None
+            if not isinstance(template, ast.Constant) or len(node.value.args) > 1 or node.value.keywords:
+                raise Unsupported(ast.unparse(node))
+            keys[node.targets[0].id] = template.value
+        # info = {key: [], ...}
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Dict) and getattr(node.targets[0], "id", None) == "info":
+            used = [key.id for key in node.value.keys]
+        # for idx, s in enumerate(seqinfo): if ...: info[key].append(s.series_id)
+        elif isinstance(node, ast.For):
+            target = node.target.elts[-1] if isinstance(node.target, ast.Tuple) else node.target
+            for statement in node.body:
+                if not isinstance(statement, ast.If) or statement.orelse:
+                    raise Unsupported(ast.unparse(statement))
+                for action in statement.body:
+                    call = action.value if isinstance(action, ast.Expr) else None
+                    if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)
+                            and call.func.attr == "append" and isinstance(call.func.value, ast.Subscript)
+                            and ast.unparse(call.args[0]) == f"{target.id}.series_id"):
+                        raise Unsupported(ast.unparse(action))
+                    key = call.func.value.slice.id
+                    for rule in conditions(statement.test, {target.id}):
+                        rule = {"key": key, **rule}
+                        if rule not in rules:
+                            rules.append(rule)
+
+    if not keys:
+        raise Unsupported(f"{path} defines no keys")
+    used = keys if used is None else used
+    return {"keys": {key: template for key, template in keys.items() if key in used},
+            "rules": [rule for rule in rules if rule["key"] in used]}
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location(Path(path).stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Heuristic:
+    """Compiled mapping: exact criteria are dictionary lookups, other criteria are tested per candidate rule."""
+
+    def __init__(self, mapping):
+        self.keys = {}
+        for name, key in mapping["keys"].items():
+            key = {"template": key} if isinstance(key, str) else key
+            self.keys[name] = create_key(key["template"], tuple(key.get("outtype", ("nii.gz",))), key.get("annotation_classes"))
+
+        self.rules, self.index, self.scan = [], {}, []
+        for number, rule in enumerate(mapping["rules"]):
+            if rule.get("key") not in self.keys:
+                raise SystemExit(f"Rule {number} maps to undefined key {rule.get('key')}")
+            criteria = {name: self.compile(name, condition) for name, condition in rule.items() if name != "key"}
+            if not criteria:
+                raise SystemExit(f"Rule {number} has no criteria")
+            exact = next((name for name, condition in rule.items() if name != "key" and self.exact(condition)), None)
+            if exact:
+                values = rule[exact] if isinstance(rule[exact], list) else [rule[exact]]
+                for value in values:
+                    self.index.setdefault(exact, {}).setdefault(value, []).append(number)
+                criteria.pop(exact)
+            else:
+                self.scan.append(number)
+            self.rules.append((rule["key"], criteria))
+
+    @staticmethod
+    def exact(condition):
+        return isinstance(condition, (str, int, float)) or (
+            isinstance(condition, list) and all(isinstance(value, (str, int, float)) for value in condition))
+
+    @staticmethod
+    def compile(name, condition):
+        if isinstance(condition, list):
+            values = set(condition)
+            return lambda value: value in values
+        if not isinstance(condition, dict):
+            return lambda value: value == condition
+        if set(condition) - OPERATORS:
+            raise SystemExit(f"Unknown operators for {name}: {' '.join(set(condition) - OPERATORS)}")
+        tests = []
+        if "contains" in condition:
+            tests.append(lambda value: condition["contains"] in str(value))
+        if "regex" in condition:
+            pattern = re.compile(condition["regex"])
+            tests.append(lambda value: pattern.search(str(value)) is not None)
+        if "min" in condition:
+            tests.append(lambda value: value is not None and float(value) >= condition["min"])
+        if "max" in condition:
+            tests.append(lambda value: value is not None and float(value) <= condition["max"])
+        return lambda value: all(test(value) for test in tests)
+
+    def match(self, s):
+        """Keys of all rules matching series `s`, in the order of the rules."""
+
+        candidates = list(self.scan)
+        for name, values in self.index.items():
+            candidates += values.get(getattr(s, name, None), [])
+        keys = []
+        for number in sorted(set(candidates)):
+            key, criteria = self.rules[number]
+            if all(test(getattr(s, name, None)) for name, test in criteria.items()) and key not in keys:
+                keys.append(key)
+        return keys
+
+    def infotodict(self, seqinfo):
+        info = {key: [] for key in self.keys.values()}
+        for s in seqinfo:
+            for name in self.match(s):
+                # Keys of legacy heuristics may share a template
+                if s.series_id not in info[self.keys[name]]:
+                    info[self.keys[name]].append(s.series_id)
+        return info
+
+
+def load(path):
+    """Heuristic of a mapping file or, via its mapping or as it is, of a heudiconv_*.py heuristic."""
+
+    path = Path(path)
+    if path.suffix == ".json":
+        return Heuristic(json.loads(path.read_text()))
+    try:
+        return Heuristic(convert(path))
+    except Unsupported as error:
+        print(f"{path.name} is applied as it is (not translatable: {error})", file=sys.stderr)
+        return load_module(path)
+
+
+heuristic = None
+
+
+def infotodict(seqinfo):
+    global heuristic
+    if heuristic is None:
+        path = Path(os.environ["HEURISTIC_MAP"])
+        heuristic = load(path if path.is_absolute() else PIPELINE_DIR / path)
+    return heuristic.infotodict(seqinfo)
+
+
+#################
+# Seqinfo cache #
+#################
+
+def restore(cached, files, SeqInfo):
+    """Seqinfo of the cache entry with its files re-rooted to the current extraction; None if they differ."""
+
+    if cached.get("fields") != list(SeqInfo._fields):
+        return None
+    root = os.path.commonpath(files) if len(files) > 1 else os.path.dirname(files[0])
+    current = {os.path.relpath(path, root) for path in files}
+    if {path for _, paths in cached["seqinfo"] for path in paths} != current:
+        return None
+    seqinfo = {}
+    for fields, paths in cached["seqinfo"]:
+        fields = {name: tuple(value) if isinstance(value, list) else value for name, value in fields.items()}
+        seqinfo[SeqInfo(**fields)] = [os.path.join(root, path) for path in paths]
+    return seqinfo
+
+
+def store(cache, digest, seqinfo, files, SeqInfo):
+    root = os.path.commonpath(files) if len(files) > 1 else os.path.dirname(files[0])
+    entry = {"sha1": digest, "fields": list(SeqInfo._fields),
+             "seqinfo": [[s._asdict(), [os.path.relpath(path, root) for path in paths]] for s, paths in seqinfo.items()]}
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_name(".tmp_" + cache.name)
+    tmp.write_text(json.dumps(entry))
+    os.replace(tmp, cache)
+
+
+def grouping(files, dcmfilter, SeqInfo):
+    """Custom grouping of heudiconv: cached seqinfo of the session or heudiconv's grouping of all files."""
+
+    from heudiconv.dicoms import group_dicoms_into_seqinfos
+
+    files = sorted(files)
+    digest, cache = os.environ.get("SEQINFO_SHA1"), os.environ.get("SEQINFO_CACHE")
+    if not (digest and cache and files):
+        return group_dicoms_into_seqinfos(files, "all", dcmfilter=dcmfilter, flatten=True)
+
+    cache = Path(cache)
+    try:
+        cached = json.loads(cache.read_text()) if cache.exists() else None
+    except ValueError:
+        cached = None
+    if cached and cached.get("sha1") == digest:
+        seqinfo = restore(cached, files, SeqInfo)
+        if seqinfo is not None:
+            print(f"Seqinfo of {len(seqinfo)} series read from {cache}", file=sys.stderr)
+            return seqinfo
+
+    seqinfo = group_dicoms_into_seqinfos(files, "all", dcmfilter=dcmfilter, flatten=True)
+    if all(isinstance(paths, list) for paths in seqinfo.values()):
+        try:
+            store(cache, digest, seqinfo, files, SeqInfo)
+        except OSError as error:
+            print(f"Cannot write {cache}: {error}", file=sys.stderr)
+    return seqinfo
+
+
+########
+# Main #
+########
+
+def read_dicominfo(path):
+    """Series of a dicominfo.tsv with numeric columns converted."""
+
+    class Series:
+        def __init__(self, row):
+            for name, value in row.items():
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    pass
+                setattr(self, name, value)
+
+    with open(path, newline="") as f:
+        return [Series(row) for row in csv.DictReader(f, delimiter="\t")]
+
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    if opts.command == "convert":
+        try:
+            print(json.dumps(convert(opts.heuristic), indent=4))
+        except Unsupported as error:
+            raise SystemExit(f"{opts.heuristic} is not translatable: {error}")
+
+    elif opts.command == "check":
+        heuristic = load(opts.mapping)
+        info = heuristic.infotodict(read_dicominfo(opts.dicominfo))
+        for key, series in info.items():
+            print(f"{key[0]}\t{' '.join(map(str, series)) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
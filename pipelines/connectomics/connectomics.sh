@@ -42,30 +42,25 @@ parpool_threads=16
 #parpool_threads=$SLURM_CPUS_PER_TASK
 #[ $parpool_threads -ge 16 ] && parpool_threads=16
 
-for sub in ${input_subject_array[@]};do
+ATLASES='["schaefer100x7", "schaefer200x7", "schaefer400x7", "schaefer100x17", "schaefer200x17", "schaefer400x17"]'
 
-    if [ $MODIFIER == sc ];then
+if [ $MODIFIER == sc ];then
 
-        INPUT_DIR=$DATA_DIR/qsirecon
+    INPUT_DIR=$DATA_DIR/qsirecon
+    CONNECTIVITY_METHOD=sift
 
-        # Execute 
-        for atlas in schaefer100x7 schaefer200x7 schaefer400x7 schaefer100x17 schaefer200x17 schaefer400x17; do
-            matlab -nosplash -nodesktop -batch \
-            "addpath(genpath('$ENV_DIR/matlab_toolboxes')); addpath(genpath('$CODE_DIR/pipelines/connectomics'));connectomics('$sub','$INPUT_DIR', '$CONN_DIR', 'ses-$SESSION', $parpool_threads, '$atlas', 'sc', 'sift', '$TMP_DIR', '$ENV_DIR/standard/'); quit"
-        done
+elif [ $MODIFIER == fc ];then
 
+    INPUT_DIR=$DATA_DIR/xcpengine
+    CONNECTIVITY_METHOD=36pspkreg
 
-    elif [ $MODIFIER == fc ];then
-        
+fi
 
-        INPUT_DIR=$DATA_DIR/xcpengine
+# Execute
+# All subjects and atlases in one MATLAB session whose parallel pool is started once and processes subject x atlas
+# work items; outputs are written per work item, so resubmitting a killed job only computes the missing ones
+SUBJECTS_FILE=$TMP_DIR/subjects.txt
+printf "%s\n" ${input_subject_array[@]} > $SUBJECTS_FILE
 
-        # Execute 
-        for atlas in schaefer100x7 schaefer200x7 schaefer400x7 schaefer100x17 schaefer200x17 schaefer400x17; do
-            matlab -nosplash -nodesktop -batch \
-            "addpath(genpath('$ENV_DIR/matlab_toolboxes')); addpath(genpath('$CODE_DIR/pipelines/connectomics')); connectomics('$sub','$INPUT_DIR', '$CONN_DIR', 'ses-$SESSION', $parpool_threads, '$atlas', 'fc', '36pspkreg', '$TMP_DIR', '$ENV_DIR/standard/'); quit"
-        done
-
-    fi
-
-done
+matlab -nosplash -nodesktop -batch \
+"addpath(genpath('$ENV_DIR/matlab_toolboxes')); addpath(genpath('$CODE_DIR/pipelines/connectomics')); connectomics_batch('$SUBJECTS_FILE', '$INPUT_DIR', '$CONN_DIR', 'ses-$SESSION', $parpool_threads, $ATLASES, '$MODIFIER', '$CONNECTIVITY_METHOD', '$TMP_DIR', '$ENV_DIR/standard/'); quit"
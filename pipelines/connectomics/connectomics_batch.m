@@ -0,0 +1,76 @@
+function connectomics_batch(subjects_file, input_path, output_path, session, threads, atlases, connectivity_type, connectivity_method, tmp_dir, env_dir)
+% FUNCTION:
+%         Computes connectomics metrics (see connectomics_metrics) for many subjects and atlases
+%         with a single MATLAB startup: the parallel pool is started once and subject x atlas
+%         work items are distributed across its workers
+%
+% INPUT:
+%         subjects_file: text file with one subject (e.g. sub-001) per line
+%         atlases: string array of atlases, e.g. ["schaefer100x7", "schaefer400x17"]
+%         threads: how many pool workers to use
+%         remaining inputs as in connectomics
+%
+% OUTPUT:
+%         CSV files containing metrics at output_path, written per work item as soon as it is done;
+%         work items whose output exists are skipped, so a killed job is resumed by running it again
+%
+% Clinical Stroke Imaging Lab, University Medical Center Hamburg-Eppendorf, 2021.
+
+subjects = string(strsplit(strtrim(fileread(subjects_file))));
+atlases = string(atlases);
+session = convertCharsToStrings(session);
+
+if connectivity_type == "sc"
+    bids_dir = "dwi";
+else
+    bids_dir = "func";
+end
+
+% Work items without output
+[atlas_idx, subject_idx] = ndgrid(1:numel(atlases), 1:numel(subjects));
+item_subjects = subjects(subject_idx(:));
+item_atlases = atlases(atlas_idx(:));
+todo = false(numel(item_subjects), 1);
+for item = 1:numel(item_subjects)
+    out_file = fullfile(output_path, item_subjects(item), session, bids_dir, ...
+        strcat(item_subjects(item), "_", session, "_", item_atlases(item), "_", connectivity_type, "_", connectivity_method, "_connectomics.csv"));
+    todo(item) = ~isfile(out_file);
+end
+item_subjects = item_subjects(todo);
+item_atlases = item_atlases(todo);
+
+% Largest atlases first, so that slow 400 node items do not end up last on few workers
+parcels = str2double(regexp(item_atlases, '\d+', 'match', 'once'));
+[~, order] = sort(parcels, 'descend');
+item_subjects = item_subjects(order);
+item_atlases = item_atlases(order);
+fprintf('%d of %d work items (subjects x atlases) to compute\n', numel(item_subjects), numel(todo));
+
+if isempty(item_subjects)
+    return
+end
+
+% Set up parallel computing to occur in $TMP_DIR
+S = parallel.Settings;
+profiles = S.findProfile;
+sc = profiles(1).getSchedulerComponent;
+set(sc, 'JobStorageLocation', tmp_dir);
+if isempty(gcp('nocreate'))
+    parpool(threads);
+end
+
+% One work item per iteration; parfor loops within connectomics_metrics run serially on the worker
+failed = false(numel(item_subjects), 1);
+parfor item = 1:numel(item_subjects)
+    try
+        connectomics_metrics(item_subjects(item), input_path, output_path, session, item_atlases(item), connectivity_type, connectivity_method, env_dir);
+    catch err
+        fprintf('%s %s failed: %s\n', item_subjects(item), item_atlases(item), err.message);
+        failed(item) = true;
+    end
+end
+
+fprintf('%d work items done, %d failed\n', sum(~failed), sum(failed));
+if any(failed)
+    error('connectomics_batch:failed', '%d work items failed', sum(failed));
+end
@@ -1,32 +1,189 @@
-# Helper script that extracts schaefer parcellated structural connectomes from mat files output of qsiprep
-# execute from code/ directory: `python pipelines/connectomics/extract_sc_from_matfile.py`
-# with a python environment containing the following packages:
+# Helper script that extracts parcellated structural connectomes from mat files output of qsiprep (qsirecon)
+# Mat files are read in a process pool, loading only the *_sift_radius2_count_connectivity variables of the atlases.
+# Connectomes are consolidated into one subjects x nodes x nodes float32 array per atlas
+# (<output_dir>/<atlas>/connectomes_desc-<atlas>_structuralconnectome.npy) with a subject index shared by all atlases
+# (<output_dir>/connectomes_subjects.tsv: row, sub, ses, source). Arrays are memory-mappable, e.g.
+#   np.load(".../connectomes_desc-400x7_structuralconnectome.npy", mmap_mode="r")[row]
+# Subjects already in the store are skipped; new ones are appended. With --csv the former per-subject text files
+# (<output_dir>/<atlas>/<sub>_desc-<atlas>_structuralconnectome.csv) are written as well.
+#
+# execute from code/ directory, e.g. via
+# python pipelines/connectomics/extract_sc_from_matfile.py [-n 16] [--csv]
+# with a python environment containing numpy and scipy
 
+from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import sys
-import pandas as pd
+import csv
+import os
+import numpy as np
 from scipy.io import loadmat
 
-project_dir = Path("../")
-qsirecon_dir = Path(project_dir/"data/qsirecon")
-output_dir = Path(project_dir/"data/connectomics/derivatives/extracted_connectomes")
+ATLASES = {resolution: f"schaefer{resolution}_sift_radius2_count_connectivity"
+           for resolution in ["100x7", "100x17", "200x7", "200x17", "400x7", "400x17"]}
+ATLASES["aal116"] = "aal116_sift_radius2_count_connectivity"
+INDEX_COLUMNS = ["row", "sub", "ses", "source"]
 
-for idx, conn_path in enumerate(qsirecon_dir.glob("*/*/*/*T1w_dhollanderconnectome.mat")):
-    sub_id = str(conn_path).split("/")[3]
 
-    print(conn_path)
-    print(idx, sub_id)
+def get_parser():
 
-    try :conn_mat = loadmat(conn_path)
-    except ValueError: pass
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Extract structural connectomes from qsirecon mat files into consolidated per-atlas arrays')
+    parser.add_argument(
+        '-i', '--input-dir', default='../data/qsirecon',
+        help='[optional]\n qsirecon directory; default ../data/qsirecon')
+    parser.add_argument(
+        '-o', '--output-dir', default='../data/connectomics/derivatives/extracted_connectomes',
+        help='[optional]\n output directory; default ../data/connectomics/derivatives/extracted_connectomes')
+    parser.add_argument(
+        '-n', '--n-procs', type=int, default=os.cpu_count(),
+        help='[optional]\n processes reading mat files; default all cores')
+    parser.add_argument(
+        '--csv', action='store_true',
+        help='[optional]\n also write per-subject space-separated CSVs (former output layout)')
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='[optional]\n discard the existing store and extract all subjects')
+    return parser
 
-    for resolution in ["100x7", "100x17", "200x7", "200x17", "400x7", "400x17"]:
-        if Path(output_dir/f"{resolution}/{sub_id}_desc-{resolution}_structuralconnectome.csv").exists(): continue
-        Path(output_dir/f"{resolution}").mkdir(parents=True, exist_ok=True)
-        atlas_df = pd.DataFrame(conn_mat[f"schaefer{resolution}_sift_radius2_count_connectivity"])
-        atlas_df.to_csv(output_dir/f"{resolution}/{sub_id}_desc-{resolution}_structuralconnectome.csv", index=False, header=None, sep=" ")
 
-    if Path(output_dir/f"aal116/{sub_id}_desc-aal116_structuralconnectome.csv").exists(): continue
-    Path(output_dir/f"aal116").mkdir(parents=True, exist_ok=True)
-    atlas_df = pd.DataFrame(conn_mat[f"aal116_sift_radius2_count_connectivity"])
-    atlas_df.to_csv(output_dir/f"aal116/{sub_id}_desc-aal116_structuralconnectome.csv", index=False, header=None, sep=" ")
+########
+# Read #
+########
+
+def session_of(conn_path):
+    ses = conn_path.parent.parent.name
+    return ses[len("ses-"):] if ses.startswith("ses-") else ""
+
+
+def extract(conn_path):
+    """Connectomes of all atlases of one mat file; None if the file is unreadable or lacks an atlas."""
+
+    try:
+        conn_mat = loadmat(conn_path, variable_names=list(ATLASES.values()))
+    except Exception as error:
+        print(f"Cannot read {conn_path}: {error}")
+        return None
+    missing = [variable for variable in ATLASES.values() if variable not in conn_mat]
+    if missing:
+        print(f"{conn_path} lacks {' '.join(missing)}")
+        return None
+    return {atlas: conn_mat[variable].astype(np.float32) for atlas, variable in ATLASES.items()}
+
+
+#########
+# Store #
+#########
+
+def store_path(output_dir, atlas):
+    return output_dir / atlas / f"connectomes_desc-{atlas}_structuralconnectome.npy"
+
+
+def read_index(index_path):
+    if not index_path.exists():
+        return []
+    with open(index_path, newline="") as f:
+        return list(csv.DictReader(f, delimiter="\t"))
+
+
+def write_index(index_path, rows):
+    tmp = index_path.with_name(".tmp_" + index_path.name)
+    with open(tmp, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp, index_path)
+
+
+def open_stores(output_dir, rows, n_new, shapes):
+    """New arrays per atlas with room for `n_new` subjects after the existing rows, which are copied over."""
+
+    stores = {}
+    for atlas, shape in shapes.items():
+        path = store_path(output_dir, atlas)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        old = np.load(path, mmap_mode="r") if rows else None
+        # Rows beyond the index stem from an interrupted run and are dropped
+        if old is not None and (old.shape[0] < len(rows) or old.shape[1:] != shape):
+            raise SystemExit(f"{path} ({old.shape}) does not match the subject index ({len(rows)} rows) "
+                             f"or atlas size {shape}; rerun with --rebuild")
+        tmp = path.with_name(".tmp_" + path.name)
+        store = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(len(rows) + n_new,) + shape)
+        if old is not None:
+            for start in range(0, len(rows), 256):
+                end = min(start + 256, len(rows))
+                store[start:end] = old[start:end]
+        stores[atlas] = (store, tmp, path)
+    return stores
+
+
+def write_csvs(output_dir, sub_id, connectomes):
+    for atlas, matrix in connectomes.items():
+        csv_path = output_dir / atlas / f"{sub_id}_desc-{atlas}_structuralconnectome.csv"
+        if csv_path.exists():
+            continue
+        csv_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savetxt(csv_path, matrix, fmt="%.10g", delimiter=" ")
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    output_dir = Path(opts.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    index_path = output_dir / "connectomes_subjects.tsv"
+
+    rows = [] if opts.rebuild else read_index(index_path)
+    known = {(row["sub"], row["ses"]) for row in rows}
+    todo = [conn_path for conn_path in sorted(Path(opts.input_dir).glob("*/*/*/*T1w_dhollanderconnectome.mat"))
+            if (conn_path.parent.parent.parent.name, session_of(conn_path)) not in known]
+    print(f"{len(rows)} subjects in store, {len(todo)} mat files to extract")
+    if not todo:
+        return
+
+    stores, n_added = None, 0
+    with ProcessPoolExecutor(max_workers=opts.n_procs) as pool:
+        for conn_path, connectomes in zip(todo, pool.map(extract, todo, chunksize=4)):
+            if connectomes is None:
+                continue
+            sub_id = conn_path.parent.parent.parent.name
+            if stores is None:
+                stores = open_stores(output_dir, rows, len(todo), {atlas: m.shape for atlas, m in connectomes.items()})
+            row = len(rows)
+            for atlas, matrix in connectomes.items():
+                stores[atlas][0][row] = matrix
+            rows.append({"row": row, "sub": sub_id, "ses": session_of(conn_path), "source": str(conn_path)})
+            n_added += 1
+            if opts.csv:
+                write_csvs(output_dir, sub_id, connectomes)
+            if n_added % 100 == 0:
+                print(f"{n_added} of {len(todo)} extracted")
+
+    if stores is None:
+        print("No readable mat files")
+        return
+
+    # Unreadable files leave unused rows at the end of the preallocated arrays
+    for store, tmp, path in stores.values():
+        if store.shape[0] != len(rows):
+            final = np.lib.format.open_memmap(path.with_name(".tmp2_" + path.name), mode="w+", dtype=np.float32,
+                                              shape=(len(rows),) + store.shape[1:])
+            final[:] = store[:len(rows)]
+            final.flush()
+            del final
+            os.replace(path.with_name(".tmp2_" + path.name), tmp)
+        else:
+            store.flush()
+        os.replace(tmp, path)
+    # Index last, so an interrupted run leaves the previous consistent store
+    write_index(index_path, rows)
+    print(f"Appended {n_added} subjects; store holds {len(rows)} subjects in {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
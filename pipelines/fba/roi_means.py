@@ -0,0 +1,235 @@
+# Batched TractSeg ROI readout for fixel and voxel metrics in template space
+# All bundle fixel masks and voxel masks are stacked once into sparse bundle x fixel / bundle x voxel matrices
+# (cached next to the masks and shared by all subjects), so each metric image is read once and all bundle means
+# are computed as one sparse matrix product per metric (replaces per-bundle `mrstats -output mean -mask` calls).
+#
+# execute e.g. via
+# python roi_means.py -s sub-01 -o <roi_means.csv> -b AF_left AF_right ... \
+#     --fixel-mask-dir <tractseg/bundles_fixelmask> --voxel-mask-dir <tractseg/tractseg_output/bundle_segmentations> \
+#     --fixel fd=<fd_smooth/sub-01.mif> ... --voxel FA=<..._desc-DTINoNeg_FA.nii.gz> ...
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import fcntl
+import os
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+
+MIF_DTYPES = {
+    "Int8": "i1", "UInt8": "u1",
+    "Int16": "i2", "UInt16": "u2",
+    "Int32": "i4", "UInt32": "u4",
+    "Int64": "i8", "UInt64": "u8",
+    "Float32": "f4", "Float64": "f8",
+}
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Read out means of fixel and voxel metrics for all TractSeg bundles in one pass')
+    parser.add_argument(
+        '-s', '--subject', required=True,
+        help='[required]\n subject id with sub-, e.g. sub-01')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output CSV (header and one row of means)')
+    parser.add_argument(
+        '-b', '--bundles', nargs='+', required=True,
+        help='[required]\n bundle names in column order')
+    parser.add_argument(
+        '--fixel-mask-dir', required=True,
+        help='[required]\n directory with <bundle>_fixelmask.mif')
+    parser.add_argument(
+        '--voxel-mask-dir', required=True,
+        help='[required]\n directory with <bundle>.nii.gz')
+    parser.add_argument(
+        '--fixel', nargs='*', default=[], metavar='NAME=MIF',
+        help='[optional]\n fixel metrics, e.g. fd=<fd_smooth/sub-01.mif>')
+    parser.add_argument(
+        '--voxel', nargs='*', default=[], metavar='NAME=IMAGE',
+        help='[optional]\n voxel metrics, e.g. FA=<..._FA.nii.gz>; written after fixel metrics')
+    parser.add_argument(
+        '--cache', required=False,
+        help='[optional]\n stacked mask cache (.npz); default: roi_masks.npz in parent of --fixel-mask-dir')
+    return parser
+
+
+###############
+# MRtrix .mif #
+###############
+
+def read_mif_header(path):
+    """Parse the key-value header of an MRtrix .mif/.mih image."""
+
+    header = {}
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"mrtrix image":
+            raise ValueError(f"{path} is not an MRtrix image")
+        for line in f:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+            key, _, value = line.partition(":")
+            header.setdefault(key.strip(), []).append(value.strip())
+    return header
+
+
+def load_mif(path):
+    """Load an MRtrix .mif/.mih image as array in axis order, memory-mapped where possible."""
+
+    path = Path(path)
+    header = read_mif_header(path)
+
+    dim = [int(d) for d in header["dim"][0].split(",")]
+    layout = [d.strip() for d in header["layout"][0].split(",")]
+    datatype = header["datatype"][0]
+    data_file, _, offset = header["file"][0].partition(" ")
+    data_file = path if data_file == "." else path.parent / data_file
+    offset = int(offset or 0)
+
+    if datatype == "Bit":
+        # Bits are packed most significant bit first
+        n = int(np.prod(dim))
+        packed = np.fromfile(data_file, dtype=np.uint8, count=(n + 7) // 8, offset=offset)
+        flat = np.unpackbits(packed)[:n].astype(bool)
+    else:
+        base = datatype.rstrip("LBE")
+        byteorder = ">" if datatype.endswith("BE") else "<"
+        dtype = np.dtype(byteorder + MIF_DTYPES[base])
+        flat = np.memmap(data_file, dtype=dtype, mode="r", offset=offset, shape=(int(np.prod(dim)),))
+
+    # Layout gives the stride rank of each axis (0 = fastest) and its direction
+    ranks = [int(l[1:]) if l[0] in "+-" else int(l) for l in layout]
+    by_rank = sorted(range(len(dim)), key=lambda axis: ranks[axis], reverse=True)
+    data = flat.reshape([dim[axis] for axis in by_rank])
+    data = data.transpose([by_rank.index(axis) for axis in range(len(dim))])
+    for axis, l in enumerate(layout):
+        if l.startswith("-"):
+            data = np.flip(data, axis)
+
+    if "scaling" in header:
+        intercept, slope = (float(v) for v in header["scaling"][0].split(","))
+        if (intercept, slope) != (0.0, 1.0):
+            data = data * slope + intercept
+
+    return data
+
+
+def load_image(path):
+    """Load a voxel/fixel image (.mif or NIfTI) as flat array."""
+
+    if str(path).endswith((".mif", ".mih")):
+        return np.asarray(load_mif(path)).ravel(order="F")
+    return np.asanyarray(nib.load(path).dataobj).ravel(order="F")
+
+
+###############
+# Mask matrix #
+###############
+
+def stack_masks(paths):
+    """Stack binary masks into a sparse CSR matrix (bundles x elements)."""
+
+    rows, cols = [], []
+    n = None
+    for row, path in enumerate(paths):
+        mask = load_image(path)
+        n = mask.size if n is None else n
+        if mask.size != n:
+            raise ValueError(f"{path} differs in size from other masks")
+        idx = np.flatnonzero(mask)
+        rows.append(np.full(idx.size, row, dtype=np.int32))
+        cols.append(idx.astype(np.int64))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix((np.ones(rows.size, dtype=np.float64), (rows, cols)), shape=(len(paths), n))
+
+
+def fingerprint(paths):
+    return np.array([f"{p}:{os.stat(p).st_size}:{os.stat(p).st_mtime_ns}" for p in paths])
+
+
+def load_mask_matrices(fixel_paths, voxel_paths, cache):
+    """Return stacked fixel and voxel mask matrices, rebuilding the shared cache if masks changed.
+
+    Concurrent subjects on a node serialize on a lock file so the masks are only read once.
+    """
+
+    cache = Path(cache)
+    key = fingerprint(fixel_paths + voxel_paths)
+
+    with open(f"{cache}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if cache.exists():
+            stored = np.load(cache)
+            if np.array_equal(stored["key"], key):
+                fixel = sparse.csr_matrix((stored["fixel_data"], stored["fixel_indices"], stored["fixel_indptr"]),
+                                          shape=tuple(stored["fixel_shape"]))
+                voxel = sparse.csr_matrix((stored["voxel_data"], stored["voxel_indices"], stored["voxel_indptr"]),
+                                          shape=tuple(stored["voxel_shape"]))
+                return fixel, voxel
+
+        print(f"Stacking {len(fixel_paths)} fixel and {len(voxel_paths)} voxel masks into {cache} ...")
+        fixel = stack_masks(fixel_paths)
+        voxel = stack_masks(voxel_paths)
+
+        tmp = cache.with_name(cache.name + ".tmp.npz")
+        np.savez(tmp, key=key,
+                 fixel_data=fixel.data, fixel_indices=fixel.indices, fixel_indptr=fixel.indptr, fixel_shape=fixel.shape,
+                 voxel_data=voxel.data, voxel_indices=voxel.indices, voxel_indptr=voxel.indptr, voxel_shape=voxel.shape)
+        os.replace(tmp, cache)
+
+    return fixel, voxel
+
+
+def masked_means(masks, values):
+    """Mean of finite values within each mask row (one sparse matrix product)."""
+
+    finite = np.isfinite(values)
+    values = np.where(finite, values, 0).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (masks @ values) / (masks @ finite.astype(np.float64))
+
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    fixel_mask_dir = Path(opts.fixel_mask_dir)
+    voxel_mask_dir = Path(opts.voxel_mask_dir)
+    cache = opts.cache or fixel_mask_dir.parent / "roi_masks.npz"
+
+    fixel_paths = [str(fixel_mask_dir / f"{bundle}_fixelmask.mif") for bundle in opts.bundles]
+    voxel_paths = [str(voxel_mask_dir / f"{bundle}.nii.gz") for bundle in opts.bundles]
+
+    fixel_masks, voxel_masks = load_mask_matrices(fixel_paths, voxel_paths, cache)
+
+    header = ["sub_id"]
+    row = [opts.subject]
+
+    for kind, metrics, masks in (("fixel", opts.fixel, fixel_masks), ("voxel", opts.voxel, voxel_masks)):
+        for name, path in (m.split("=", 1) for m in metrics):
+
+            header += [f"fba_{bundle}_mean_{name}" for bundle in opts.bundles]
+
+            if not Path(path).exists():
+                print(f"{path} not found. Leaving {name} columns empty ...")
+                row += [""] * len(opts.bundles)
+                continue
+
+            values = load_image(path)
+            if values.size != masks.shape[1]:
+                raise SystemExit(f"{path} does not match the {kind} masks in size")
+
+            row += ["" if not np.isfinite(m) else f"{m:.6g}" for m in masked_means(masks, values)]
+
+    with open(opts.output, "w") as f:
+        f.write(",".join(header) + "\n")
+        f.write(",".join(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# Lesion profile of diffusion measures in perilesional white matter shells
+# Builds all shells around a lesion at once from one distance transform of the lesion mask (formerly one maskfilter
+# dilation per shell in lesionanalysis_1.sh) and reads out the means of all images for the lesion and every shell in
+# one labelled reduction (formerly one fslmaths/fslstats pair per image, shell and side in lesionanalysis_2.sh).
+#
+# Shells are either voxel layers (distance along face neighbours, as maskfilter dilate -npass i; default) or, with
+# --shell-width, Euclidean distance bins in mm, e.g. --shells 20 --shell-width 1 for 1 mm shells up to 20 mm. Shells
+# only contain white matter (--wm). Means are taken over the nonzero voxels of each region, as fslstats -M.
+#
+# With --flip-transform and --flip-template, the lesion and its shells are mirrored to the contralateral hemisphere
+# by an index mapping: every voxel is mapped to its contralateral voxel through the rigid transformation to MNI
+# space (antsRegistrationSyN.sh -t r, lesionanalysis_1.sh) and the x mirror of the MNI template grid (fslswapdim -x).
+# Ventricles are excluded from the flipped lesion and voxels of the flipped shells are removed from the shells of the
+# same distance. Additional *_norm_* columns hold the ratio of ipsi- to contralateral means.
+#
+# Outputs:
+#   CSV with sub_id, ses_id, lesionanalysis_{lesion,fliplesion,shell<i>,flipshell<i>}_mean_<image> and
+#       lesionanalysis_{lesion,shell<i>}_norm_<image>, columns ordered as the former lesionanalysis_2.sh
+#   <labels>_desc-shells_dseg.nii.gz (and <labels>_desc-flipped_desc-shells_dseg.nii.gz): 1 = lesion, i + 1 = shell i
+#
+# execute e.g. via
+# python lesion_profile.py -l <lesion_mask> -w <wm_mask> -i FW=<FW> FAt=<FAt> MD=<MD> --sub sub-001 --ses 1 -o <csv>
+#   [--flip-transform <rigid.mat> --flip-template <MNI template> -v <ventricle_mask>] [--shells 20 --shell-width 1]
+# with a python environment containing numpy, scipy and nibabel
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import csv
+import os
+import numpy as np
+import nibabel as nib
+from scipy.io import loadmat
+from scipy.ndimage import distance_transform_cdt, distance_transform_edt
+
+# LPS (ITK/ANTs) <-> RAS (NIfTI) world coordinates
+LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Means of images in a lesion, its perilesional shells and their contralateral mirror')
+    parser.add_argument(
+        '-l', '--lesion', required=True,
+        help='[required]\n lesion mask in readout space')
+    parser.add_argument(
+        '-w', '--wm', required=True,
+        help='[required]\n (eroded) white matter mask in readout space; shells are restricted to it')
+    parser.add_argument(
+        '-i', '--images', required=True, nargs='+', metavar='NAME=PATH',
+        help='[required]\n images in readout space to read out, e.g. FW=<FW> FAt=<FAt> MD=<MD>')
+    parser.add_argument(
+        '--sub', required=True,
+        help='[required]\n subject, e.g. sub-001')
+    parser.add_argument(
+        '--ses', required=True,
+        help='[required]\n session, e.g. 1')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output CSV')
+    parser.add_argument(
+        '--shells', type=int, default=8,
+        help='[optional]\n number of shells; default 8')
+    parser.add_argument(
+        '--shell-width', type=float,
+        help='[optional]\n shell width in mm (Euclidean distance); default one voxel layer per shell')
+    parser.add_argument(
+        '--flip-transform',
+        help='[optional]\n rigid ANTs transformation T1w -> MNI (*0GenericAffine.mat); enables contralateral read out')
+    parser.add_argument(
+        '--flip-template',
+        help='[optional]\n MNI template the transformation was estimated on; required with --flip-transform')
+    parser.add_argument(
+        '-v', '--ventricles',
+        help='[optional]\n ventricle mask in readout space, excluded from the flipped lesion')
+    parser.add_argument(
+        '--labels',
+        help='[optional]\n prefix of shell label images, e.g. <out_dir>/<sub>_ses-<ses>_space-T1w_desc-lesion_res-2mm')
+    return parser
+
+
+def load(path, affine=None):
+    img = nib.load(path)
+    if affine is not None and not np.allclose(img.affine, affine, atol=1e-3):
+        raise SystemExit(f"{path} is not on the grid of the lesion mask")
+    return np.asanyarray(img.dataobj, dtype=np.float32)
+
+
+##########
+# Shells #
+##########
+
+def shell_labels(lesion, zooms, shells, width):
+    """Lesion (1) and shells (2 .. shells + 1) from one distance transform; 0 elsewhere, not restricted to WM."""
+
+    # Without lesion voxels there is nothing to measure distances to
+    if not lesion.any():
+        return np.zeros(lesion.shape, dtype=np.int32)
+
+    if width:
+        distance = distance_transform_edt(~lesion, sampling=zooms)
+        shell = np.ceil(distance / width)
+    else:
+        # Voxel layers along face neighbours, as repeated 6-connected dilation
+        shell = distance_transform_cdt(~lesion, metric="taxicab").astype(np.float32)
+    labels = np.where(shell <= shells, shell + 1, 0).astype(np.int32)
+    labels[lesion] = 1
+    return labels
+
+
+##############
+# Flip index #
+##############
+
+def ants_rigid(path):
+    """4x4 RAS matrix of an ANTs linear transformation (mapping points of the fixed to the moving image)."""
+
+    mat = loadmat(path)
+    key = next((key for key in mat if key.startswith("AffineTransform")), None)
+    if key is None:
+        raise SystemExit(f"No affine transformation in {path}")
+    parameters = mat[key].ravel()
+    matrix, translation = parameters[:9].reshape(3, 3), parameters[9:12]
+    centre = mat["fixed"].ravel() if "fixed" in mat else np.zeros(3)
+    transform = np.eye(4)
+    transform[:3, :3] = matrix
+    transform[:3, 3] = translation + centre - matrix @ centre
+    return LPS @ transform @ LPS
+
+
+def flip_index(img, transform_path, template_path):
+    """Flat index of the contralateral voxel of every voxel (-1 outside the image)."""
+
+    template = nib.load(template_path)
+    mirror = np.eye(4)
+    mirror[0, 0], mirror[0, 3] = -1, template.shape[0] - 1
+    mirror = template.affine @ mirror @ np.linalg.inv(template.affine)
+
+    # readout voxel -> T1w -> MNI -> mirrored MNI -> T1w -> readout voxel
+    to_readout = np.linalg.inv(img.affine)
+    mni_to_t1w = ants_rigid(transform_path)
+    mapping = to_readout @ mni_to_t1w @ mirror @ np.linalg.inv(mni_to_t1w) @ img.affine
+
+    shape = np.array(img.shape[:3])
+    voxels = np.indices(shape).reshape(3, -1)
+    target = np.rint(mapping[:3, :3] @ voxels + mapping[:3, 3:]).astype(np.int64)
+    inside = ((target >= 0) & (target < shape[:, None])).all(axis=0)
+    index = np.full(voxels.shape[1], -1, dtype=np.int64)
+    index[inside] = np.ravel_multi_index(target[:, inside], shape)
+    return index
+
+
+def flip_labels(labels, index):
+    flipped = np.where(index >= 0, labels.ravel()[np.maximum(index, 0)], 0)
+    return flipped.reshape(labels.shape)
+
+
+############
+# Read out #
+############
+
+def region_means(values, labels, n_regions):
+    """Means of the nonzero values of all images (images x voxels) in every region of all label images at once."""
+
+    # One bin per image, label image and region; label 0 is dropped
+    bins = np.concatenate([np.where(label.ravel() > 0, label.ravel() - 1 + k * n_regions, -1)
+                           for k, label in enumerate(labels)])
+    region = bins >= 0
+    values = np.concatenate([values] * len(labels), axis=1)[:, region]
+    n_bins = len(labels) * n_regions
+    bins = (bins[region] + np.arange(len(values))[:, None] * n_bins).ravel()
+    nonzero = (values != 0).ravel().astype(np.float64)
+    sums = np.bincount(bins, weights=values.ravel(), minlength=n_bins * len(values))
+    counts = np.bincount(bins, weights=nonzero, minlength=n_bins * len(values))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    # images x label images x regions
+    return means.reshape(len(values), len(labels), n_regions)
+
+
+def write_labels(prefix, labels, affine):
+    path = Path(f"{prefix}_desc-shells_dseg.nii.gz")
+    nib.save(nib.Nifti1Image(labels.astype(np.int16), affine), path)
+    print(f"Shell labels written to {path}")
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    flip = opts.flip_transform is not None
+    if flip and not opts.flip_template:
+        raise SystemExit("--flip-template is required with --flip-transform")
+
+    images = dict(image.split("=", 1) for image in opts.images)
+    lesion_img = nib.load(opts.lesion)
+    affine = lesion_img.affine
+    lesion = np.asanyarray(lesion_img.dataobj) > 0
+    wm = load(opts.wm, affine) > 0
+    if not lesion.any():
+        print(f"Empty lesion mask {opts.lesion}")
+
+    raw = shell_labels(lesion, lesion_img.header.get_zooms()[:3], opts.shells, opts.shell_width)
+    ipsi = np.where((raw == 1) | wm, raw, 0)
+    labels = [ipsi]
+
+    if flip:
+        contra = flip_labels(raw, flip_index(lesion_img, opts.flip_transform, opts.flip_template))
+        if opts.ventricles:
+            contra[(contra == 1) & (load(opts.ventricles, affine) > 0)] = 0
+        contra[(contra > 1) & ~wm] = 0
+        # Shells of ipsi- and contralateral side must not overlap
+        ipsi[(ipsi > 1) & (ipsi == contra)] = 0
+        labels.append(contra)
+
+    if opts.labels:
+        write_labels(opts.labels, ipsi, affine)
+        if flip:
+            write_labels(f"{opts.labels}_desc-flipped", contra, affine)
+
+    values = np.stack([load(path, affine).ravel() for path in images.values()])
+    means = region_means(values, labels, opts.shells + 1)
+
+    # Columns as written by the former lesionanalysis_2.sh, normalized means appended
+    regions = ["lesion"] + [f"shell{i}" for i in range(1, opts.shells + 1)]
+    header, row = ["sub_id", "ses_id"], [opts.sub, opts.ses]
+    for r, region in enumerate(regions):
+        for m, name in enumerate(images):
+            header.append(f"lesionanalysis_{region}_mean_{name}")
+            row.append(means[m, 0, r])
+            if flip:
+                header.append(f"lesionanalysis_flip{region}_mean_{name}")
+                row.append(means[m, 1, r])
+    if flip:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = means[:, 0] / means[:, 1]
+        for r, region in enumerate(regions):
+            for m, name in enumerate(images):
+                header.append(f"lesionanalysis_{region}_norm_{name}")
+                row.append(ratio[m, r])
+
+    output = Path(opts.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp = output.with_name(".tmp_" + output.name)
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerow(row[:2] + [f"{value:.6f}" if np.isfinite(value) else "" for value in row[2:]])
+    os.replace(tmp, output)
+
+    print(f"Lesion profile ({len(regions)} regions x {len(images)} images{', both hemispheres' if flip else ''}) "
+          f"written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,8 @@
 ##################################################################################################
 # Submission script for white matter lesion analysis                                             #
 #                                                                                                #
-# Part I: creation of lesion shells and flipping of lesions/shells to contralateral hemisphere   #
-# for normalization of later derived means                                                       #
+# Part I: white matter and ventricle masks in readout space and rigid transformation to MNI      #
+# space for flipping lesions to the contralateral hemisphere (flip and shells: lesion_profile.py)#
 ##################################################################################################
 
 ##################################################################################################
@@ -191,9 +191,9 @@ fi
 
 # TO DO: Add other readout spaces
 
-##########################################
-# Flip lesion mask to contralateral side #
-##########################################
+#################################################################
+# Rigid transformation to MNI space for flipping of lesion mask #
+#################################################################
 
 if [ $MODIFIER == "yes" ]; then
 
@@ -226,10 +226,6 @@ if [ $MODIFIER == "yes" ]; then
         T1w_MNI_OUT=$OUT_DIR/${1}_ses-${SESSION}_from-T1w_to-MNI152NLin2009cAsym_desc-rigid_
         RIGID=${T1w_MNI_OUT}0GenericAffine.mat
         
-        LESION_MNI=$OUT_DIR/${1}_ses-${SESSION}_space-MNI152NLin2009cAsym_desc-lesion_mask.nii.gz
-        LESION_MNI_FLIP=$OUT_DIR/${1}_ses-${SESSION}_space-MNI152NLin2009cAsym_desc-lesion_desc-flipped_mask.nii.gz
-        LESION_T1w_FLIP=$OUT_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_desc-flipped_mask.nii.gz
-        
         # Mask brain prior to registration
         ##################################
         
@@ -249,163 +245,37 @@ if [ $MODIFIER == "yes" ]; then
         # Execute command
         $singularity_mrtrix3 $CMD_T1w2MNI
 
-        # Apply transformation to lesion mask
-        #####################################
-        
-        # Define command
-        CMD_APPLY_XFM="antsApplyTransforms -d 3 -e 0 -i $LESION_T1w -r $MNI_TEMPLATE -t $RIGID -o $LESION_MNI"
-
-        # Execute command
-        $singularity_mrtrix3 $CMD_APPLY_XFM
-
-        # Flip lesion mask to contralateral hemisphere in MNI space
-        ###########################################################
-        
-        # Define command
-        CMD_SWAP="fslswapdim $LESION_MNI -x y z $LESION_MNI_FLIP"
-
-        # Execute command
-        $singularity_fsl $CMD_SWAP
-
-        # Apply inverse transformation to flipped lesion mask
-        #####################################################
-
-        # Define command
-        CMD_APPLY_XFM_INV="antsApplyTransforms -d 3 -e 0 -i $LESION_MNI_FLIP -r $T1_BRAIN -t [ $RIGID, 1 ] -o $LESION_T1w_FLIP"
-
-        # Execute command
-        $singularity_mrtrix3 $CMD_APPLY_XFM_INV
-
-        # Threshold flipped lesion mask in T1w space
-        ############################################
-
-        # Define command
-        FLIP_THRESH="fslmaths $LESION_T1w_FLIP -thr 0.9 -bin $LESION_T1w_FLIP"
-
-        # Execute command
-        $singularity_fsl $FLIP_THRESH
-
     fi
 
 fi
 
 # TO DO: add other orig spaces
 
-###############################################################################################
-# Registration of lesion masks to readout space and filter flipped mask to exclude ventricles #
-###############################################################################################
+################################################
+# Registration of lesion mask to readout space #
+################################################
 
 if [ $ORIG_SPACE == "T1w" ] && [ $READOUT_SPACE == "dwi" ]; then
 
-    # Since DWI is registered to T1w-space in qsiprep, only regridding of lesion masks is necessary
+    # Since DWI is registered to T1w-space in qsiprep, only regridding of the lesion mask is necessary
 
     # Define output
     ###############
 
     LESION_READOUT_RESIZED=$OUT_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_res-2mm_mask.nii.gz
-    LESION_READOUT_FLIP_RESIZED=$OUT_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_desc-flipped_res-2mm_mask.nii.gz
 
     # Define commands
     #################
 
     CMD_RESIZE_IPSI="mrgrid -force -template $DWI -interp nearest -datatype uint32 $LESION_T1w regrid $LESION_READOUT_RESIZED"
-    CMD_RESIZE_FLIP="mrgrid -force -template $DWI -interp nearest -datatype uint32 $LESION_T1w_FLIP regrid $LESION_READOUT_FLIP_RESIZED"
-    CMD_FILTER_FLIP="fslmaths $LESION_READOUT_FLIP_RESIZED -sub $VENTRICLES_ALL_REG -thr 1 -bin $LESION_READOUT_FLIP_RESIZED"
 
     # Execute command
     #################
 
     $singularity_mrtrix3 $CMD_RESIZE_IPSI
-    
-    [ $MODIFIER == "yes" ] && $singularity_mrtrix3 $CMD_RESIZE_FLIP && $singularity_fsl $CMD_FILTER_FLIP
 
 fi
 
 # TODO: add other combinations
 
-##############################
-# Create perilesional shells #
-##############################
-
-if [ $READOUT_SPACE == "dwi" ]; then
-
-    # Define output
-    ###############
-    
-    LESION_DIL_i=$OUT_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_res-2mm_desc-dil
-    LESION_FLIP_DIL_i=$OUT_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_desc-flipped_res-2mm_desc-dil
-
-    # Dilate lesion masks
-    #####################
-
-    # ipsilateral
-
-    for i in {1..8}; do
-        
-        CMD_DIL="maskfilter -npass $i $LESION_READOUT_RESIZED dilate ${LESION_DIL_i}${i}_mask.nii.gz"
-        $singularity_mrtrix3 $CMD_DIL
-    
-    done
-    
-    # flipped
-    
-    if [ $MODIFIER == "yes" ]; then
-
-        for i in {1..8}; do
-            
-            CMD_DIL_FLIP="maskfilter -npass $i $LESION_READOUT_FLIP_RESIZED dilate ${LESION_FLIP_DIL_i}${i}_mask.nii.gz"
-            $singularity_mrtrix3 $CMD_DIL_FLIP
-        
-        done
-    fi
-    
-    # Create and filter shells
-    ##########################
-    
-    # Create ipsilateral shells - include only white matter
-    
-    CMD_SHELL="fslmaths ${LESION_DIL_i}1_mask.nii.gz -sub $LESION_READOUT_RESIZED -mul $WM_REFINED_REG ${LESION_DIL_i}1_shell.nii.gz"
-    $singularity_fsl $CMD_SHELL
-
-    for i in {2..8}; do
-        
-        CMD_SHELL="fslmaths ${LESION_DIL_i}${i}_mask.nii.gz -sub ${LESION_DIL_i}$(($i-1))_mask.nii.gz -mul $WM_REFINED_REG ${LESION_DIL_i}${i}_shell.nii.gz"
-        $singularity_fsl $CMD_SHELL
-    
-    done
-    
-    if [ $MODIFIER == "yes" ]; then
-
-        # Create contralateral shells - include only white matter
-        
-        CMD_SHELL_FLIP="fslmaths ${LESION_FLIP_DIL_i}1_mask.nii.gz -sub $LESION_READOUT_FLIP_RESIZED -mul $WM_REFINED_REG ${LESION_FLIP_DIL_i}1_shell.nii.gz"
-        $singularity_fsl $CMD_SHELL_FLIP
-
-        for i in {2..8}; do
-            
-            CMD_SHELL_FLIP="fslmaths ${LESION_FLIP_DIL_i}${i}_mask.nii.gz -sub ${LESION_FLIP_DIL_i}$(($i-1))_mask.nii.gz -mul $WM_REFINED_REG ${LESION_FLIP_DIL_i}${i}_shell.nii.gz"
-            $singularity_fsl $CMD_SHELL_FLIP
-        
-        done
-
-        # Substract ipsi- and contralateral shells from each other to avoid overlap
-        
-        for i in {1..8}; do
-            
-            CMD_UNIQ_IPSI="fslmaths ${LESION_DIL_i}${i}_shell.nii.gz -sub ${LESION_FLIP_DIL_i}${i}_shell.nii.gz -thr 1 -bin ${LESION_DIL_i}${i}_shell.nii.gz"
-            CMD_UNIQ_FLIP="fslmaths ${LESION_FLIP_DIL_i}${i}_shell.nii.gz -sub ${LESION_DIL_i}${i}_shell.nii.gz -thr 1 -bin ${LESION_FLIP_DIL_i}${i}_shell.nii.gz"
-            $singularity_fsl $CMD_UNIQ_IPSI
-            $singularity_fsl $CMD_UNIQ_FLIP
-        
-        done
-
-    fi
-
-    # Remove dilated masks
-    ######################
-
-    rm -rvf $OUT_DIR/*_desc-lesion_*_desc-dil*_mask.nii.gz
-
-fi
-
 # TO DO: Add other readout spaces
@@ -13,7 +13,9 @@
 #       - lesion segmentation of some sort                                                       #
 #       - lesionanalysis_1.sh                                                                    #
 #   [container]                                                                                  #
-#       - fsl-6.0.3                                                                              #
+#       - miniconda-csi                                                                          #
+#   [code]                                                                                       #
+#       - lesion_profile.py                                                                      #
 ##################################################################################################
 
 # Get verbose outputs
@@ -29,17 +31,18 @@ TMP_OUT=$TMP_DIR/output;               [ ! -d $TMP_OUT ] && mkdir -p $TMP_OUT
 # Define environment
 ####################
 
-parallel="parallel --ungroup --delay 0.2 -j16 --joblog $CODE_DIR/log/parallel_runtask.log"
-
-container_fsl=fsl-6.0.3
-singularity_fsl="singularity run --cleanenv --no-home --userns \
+container_miniconda=miniconda-csi
+singularity_miniconda="singularity run --cleanenv --no-home --userns \
     -B .
     -B $PROJ_DIR \
     -B $(readlink -f $ENV_DIR) \
     -B $TMP_DIR \
     -B $TMP_IN \
     -B $TMP_OUT \
-    $ENV_DIR/$container_fsl"
+    $ENV_DIR/$container_miniconda"
+
+# Use the node's persistent container instances (utils/container_instances.sh) when run via 02_pipelines_batch.sh
+[ -n "$CONTAINER_RUN" ] && singularity_miniconda="$CONTAINER_RUN $container_miniconda"
 
 # Input directory
 #################
@@ -73,244 +76,49 @@ if [ $ANALYSIS_LEVEL == "subject" ]; then
 
     if [ $ORIG_SPACE == "T1w" ] && [ $READOUT_SPACE == "dwi" ]; then
 
-        ###################
-        # Create CSV file #
-        ################### 
-
-        CSV=$LA_DIR/$1/ses-${SESSION}/dwi/${1}_ses-${SESSION}_mod-${READOUT_SPACE}_space-T1w_lesionanalysis.csv
-
-        if [ $MODIFIER == "yes" ]; then
-
-            echo -en "sub_id,ses_id,\
-    lesionanalysis_lesion_mean_FW,lesionanalysis_fliplesion_mean_FW,\
-    lesionanalysis_lesion_mean_FAt,lesionanalysis_fliplesion_mean_FAt,\
-    lesionanalysis_lesion_mean_MD,lesionanalysis_fliplesion_mean_MD,\
-    lesionanalysis_shell1_mean_FW,lesionanalysis_flipshell1_mean_FW,\
-    lesionanalysis_shell1_mean_FAt,lesionanalysis_flipshell1_mean_FAt,\
-    lesionanalysis_shell1_mean_MD,lesionanalysis_flipshell1_mean_MD,\
-    lesionanalysis_shell2_mean_FW,lesionanalysis_flipshell2_mean_FW,\
-    lesionanalysis_shell2_mean_FAt,lesionanalysis_flipshell2_mean_FAt,\
-    lesionanalysis_shell2_mean_MD,lesionanalysis_flipshell2_mean_MD,\
-    lesionanalysis_shell3_mean_FW,lesionanalysis_flipshell3_mean_FW,\
-    lesionanalysis_shell3_mean_FAt,lesionanalysis_flipshell3_mean_FAt,\
-    lesionanalysis_shell3_mean_MD,lesionanalysis_flipshell3_mean_MD,\
-    lesionanalysis_shell4_mean_FW,lesionanalysis_flipshell4_mean_FW,\
-    lesionanalysis_shell4_mean_FAt,lesionanalysis_flipshell4_mean_FAt,\
-    lesionanalysis_shell4_mean_MD,lesionanalysis_flipshell4_mean_MD,\
-    lesionanalysis_shell5_mean_FW,lesionanalysis_flipshell5_mean_FW,\
-    lesionanalysis_shell5_mean_FAt,lesionanalysis_flipshell5_mean_FAt,\
-    lesionanalysis_shell5_mean_MD,lesionanalysis_flipshell5_mean_MD,\
-    lesionanalysis_shell6_mean_FW,lesionanalysis_flipshell6_mean_FW,\
-    lesionanalysis_shell6_mean_FAt,lesionanalysis_flipshell6_mean_FAt,\
-    lesionanalysis_shell6_mean_MD,lesionanalysis_flipshell6_mean_MD,\
-    lesionanalysis_shell7_mean_FW,lesionanalysis_flipshell7_mean_FW,\
-    lesionanalysis_shell7_mean_FAt,lesionanalysis_flipshell7_mean_FAt,\
-    lesionanalysis_shell7_mean_MD,lesionanalysis_flipshell7_mean_MD,\
-    lesionanalysis_shell8_mean_FW,lesionanalysis_flipshell8_mean_FW,\
-    lesionanalysis_shell8_mean_FAt,lesionanalysis_flipshell8_mean_FAt,\
-    lesionanalysis_shell8_mean_MD,lesionanalysis_flipshell8_mean_MD" > $CSV
-
-        elif [ $MODIFIER == "no" ]; then
-
-            echo -en "sub_id,ses_id,\
-    lesionanalysis_lesion_mean_FW,lesionanalysis_lesion_mean_FAt,lesionanalysis_lesion_mean_MD,\
-    lesionanalysis_shell1_mean_FW,lesionanalysis_shell1_mean_FAt,lesionanalysis_shell1_mean_MD,\
-    lesionanalysis_shell2_mean_FW,lesionanalysis_shell2_mean_FAt,lesionanalysis_shell2_mean_MD,\
-    lesionanalysis_shell3_mean_FW,lesionanalysis_shell3_mean_FAt,lesionanalysis_shell3_mean_MD,\
-    lesionanalysis_shell4_mean_FW,lesionanalysis_shell4_mean_FAt,lesionanalysis_shell4_mean_MD,\
-    lesionanalysis_shell5_mean_FW,lesionanalysis_shell5_mean_FAt,lesionanalysis_shell5_mean_MD,\
-    lesionanalysis_shell6_mean_FW,lesionanalysis_shell6_mean_FAt,lesionanalysis_shell6_mean_MD,\
-    lesionanalysis_shell7_mean_FW,lesionanalysis_shell7_mean_FAt,lesionanalysis_shell7_mean_MD,\
-    lesionanalysis_shell8_mean_FW,lesionanalysis_shell8_mean_FAt,lesionanalysis_shell8_mean_MD" > $CSV
-
-        fi
-
-        #######################################
-        # Extract means of lesions and shells #
-        #######################################
-        
-        # Define image modalities from which to extract means 
-        #####################################################
+        # Define input
+        ##############
+
+        SUB_DIR=$LA_DIR/${1}/ses-$SESSION/dwi
 
+        LESION=$SUB_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_res-2mm_mask.nii.gz
+        WM_REFINED_REG=$SUB_DIR/${1}_ses-${SESSION}_space-T1w_desc-wm_desc-eroded_res-2mm_mask.nii.gz
+        VENTRICLES_ALL_REG=$SUB_DIR/${1}_ses-${SESSION}_space-T1w_desc-ventricles_res-2mm_mask.nii.gz
+        RIGID=$SUB_DIR/${1}_ses-${SESSION}_from-T1w_to-MNI152NLin2009cAsym_desc-rigid_0GenericAffine.mat
+        MNI_TEMPLATE=$ENV_DIR/standard/tpl-MNI152NLin2009cAsym_res-01_desc-brain_T1w.nii.gz
+
+        # Image modalities from which to extract means 
         FW_IMAGE=$DATA_DIR/freewater/$1/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_FW.nii.gz
         FAt_IMAGE=$DATA_DIR/freewater/$1/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_desc-FWcorrected_FA.nii.gz
         MD_IMAGE=$DATA_DIR/freewater/$1/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_desc-DTINoNeg_MD.nii.gz
 
-        ######################
-        # Ipsilateral lesion #
-        ######################
-
-        # Define input
-        ##############
-
-        LESION=$LA_DIR/${1}/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_desc-lesion_res-2mm_mask.nii.gz
-
         # Define output
         ###############
 
-        FW_LESION=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-lesion_FW.nii.gz
-        FAt_LESION=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-FWcorrected_desc-lesion_FAt.nii.gz
-        MD_LESION=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-DTINoNeg_desc-lesion_MD.nii.gz
-
-        # Define commands
-        #################
-
-        CMD_LESION_FW="fslmaths $FW_IMAGE -mul $LESION $FW_LESION"
-        CMD_LESION_MEAN_FW="fslstats $FW_LESION -M"
-        CMD_LESION_FAt="fslmaths $FAt_IMAGE -mul $LESION $FAt_LESION"
-        CMD_LESION_MEAN_FAt="fslstats $FAt_LESION -M"
-        CMD_LESION_MD="fslmaths $MD_IMAGE -mul $LESION $MD_LESION"
-        CMD_LESION_MEAN_MD="fslstats $MD_LESION -M"
-
-        # Execute commands
-        ##################
-
-        $singularity_fsl /bin/bash -c "$CMD_LESION_FW;$CMD_LESION_FAt;$CMD_LESION_MD"
-        mean_lesion_fw=`$singularity_fsl $CMD_LESION_MEAN_FW | tail -n 1`
-        mean_lesion_fat=`$singularity_fsl $CMD_LESION_MEAN_FAt | tail -n 1`
-        mean_lesion_md=`$singularity_fsl $CMD_LESION_MEAN_MD | tail -n 1`
-
-        ########################
-        # Contralateral lesion #
-        ########################
-
-        if [ $MODIFIER = "yes" ]; then
-
-            # Define input
-            ##############
-
-            LESION_FLIP=$LA_DIR/${1}/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_desc-lesion_desc-flipped_res-2mm_mask.nii.gz
-
-            # Define output
-            ###############
-
-            FW_LESION_FLIP=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-lesion_desc-flipped_FW.nii.gz
-            FAt_LESION_FLIP=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-FWcorrected_desc-lesion_desc-flipped_FAt.nii.gz
-            MD_LESION_FLIP=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-DTINoNeg_desc-lesion_desc-flipped_MD.nii.gz
-
-            # Define commands
-            #################
+        CSV=$SUB_DIR/${1}_ses-${SESSION}_mod-${READOUT_SPACE}_space-T1w_lesionanalysis.csv
+        SHELL_LABELS=$SUB_DIR/${1}_ses-${SESSION}_space-T1w_desc-lesion_res-2mm
 
-            CMD_LESION_FLIP_FW="fslmaths $FW_IMAGE -mul $LESION_FLIP $FW_LESION_FLIP"
-            CMD_LESION_FLIP_MEAN_FW="fslstats $FW_LESION_FLIP -M"
-            CMD_LESION_FLIP_FAt="fslmaths $FAt_IMAGE -mul $LESION_FLIP $FAt_LESION_FLIP"
-            CMD_LESION_FLIP_MEAN_FAt="fslstats $FAt_LESION_FLIP -M"
-            CMD_LESION_FLIP_MD="fslmaths $MD_IMAGE -mul $LESION_FLIP $MD_LESION_FLIP"
-            CMD_LESION_FLIP_MEAN_MD="fslstats $MD_LESION_FLIP -M"
+        # Define command
+        ################
 
-            # Execute commands
-            ##################
+        # Shells are built from one distance transform of the lesion mask and the lesion is flipped to the
+        # contralateral hemisphere by an index mapping; e.g. --shells 20 --shell-width 1 gives 1 mm shells up to 20 mm
+        CMD_PROFILE="python $PIPELINE_DIR/lesion_profile.py \
+            -l $LESION \
+            -w $WM_REFINED_REG \
+            -i FW=$FW_IMAGE FAt=$FAt_IMAGE MD=$MD_IMAGE \
+            --sub $1 \
+            --ses $SESSION \
+            --shells 8 \
+            --labels $SHELL_LABELS \
+            -o $CSV"
 
-            $singularity_fsl /bin/bash -c "$CMD_LESION_FLIP_FW; $CMD_LESION_FLIP_FAt; $CMD_LESION_FLIP_MD"
-            mean_lesion_flip_fw=`$singularity_fsl $CMD_LESION_FLIP_MEAN_FW | tail -n 1`
-            mean_lesion_flip_fat=`$singularity_fsl $CMD_LESION_FLIP_MEAN_FAt | tail -n 1`
-            mean_lesion_flip_md=`$singularity_fsl $CMD_LESION_FLIP_MEAN_MD | tail -n 1`
+        [ $MODIFIER == "yes" ] && CMD_PROFILE="$CMD_PROFILE --flip-transform $RIGID --flip-template $MNI_TEMPLATE -v $VENTRICLES_ALL_REG"
 
-        fi
-        
-        ##############################
-        # Append lesion means to CSV #
-        ##############################
-
-        if [ $MODIFIER == "yes" ]; then
-
-            echo -en "\n$1,$SESSION,$mean_lesion_fw,$mean_lesion_flip_fw,$mean_lesion_fat,$mean_lesion_flip_fat,$mean_lesion_md,$mean_lesion_flip_md," >> $CSV
-        
-        elif [ $MODIFIER == "no" ]; then
-
-            echo -en "\n$1,$SESSION,$mean_lesion_fw,$mean_lesion_fat,$mean_lesion_md," >> $CSV
-
-        fi
-
-        ######################
-        # Ipsilateral shells #
-        ######################
-
-        for i in {1..8}; do
-
-            # Define input
-            ##############
-
-            LESION_SHELL=$LA_DIR/${1}/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_desc-lesion_res-2mm_desc-dil${i}_shell.nii.gz
-            
-            # Define output
-            ###############
-
-            FW_SHELL=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-shell${i}_FW.nii.gz
-            FAt_SHELL=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-FWcorrected_desc-shell${i}_FA.nii.gz
-            MD_SHELL=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-DTINoNeg_desc-shell${i}_MD.nii.gz
-
-            # Define commands
-            #################
-
-            CMD_SHELL_FW="fslmaths $FW_IMAGE -mul $LESION_SHELL $FW_SHELL"
-            CMD_SHELL_MEAN_FW="fslstats $FW_SHELL -M"
-            CMD_SHELL_FAt="fslmaths $FAt_IMAGE -mul $LESION_SHELL $FAt_SHELL"
-            CMD_SHELL_MEAN_FAt="fslstats $FAt_SHELL -M"
-            CMD_SHELL_MD="fslmaths $MD_IMAGE -mul $LESION_SHELL $MD_SHELL"
-            CMD_SHELL_MEAN_MD="fslstats $MD_SHELL -M"
-
-            # Execute commands
-            ##################
-
-            $singularity_fsl /bin/bash -c "$CMD_SHELL_FW;$CMD_SHELL_FAt;$CMD_SHELL_MD"
-            mean_shell_fw=`$singularity_fsl $CMD_SHELL_MEAN_FW | tail -n 1`
-            mean_shell_fat=`$singularity_fsl $CMD_SHELL_MEAN_FAt | tail -n 1`
-            mean_shell_md=`$singularity_fsl $CMD_SHELL_MEAN_MD | tail -n 1`
-    
-        ########################
-        # Contralateral shells #
-        ########################
-        
-            if [ $MODIFIER = yes ]; then
-        
-                # Define input
-                ##############
-
-                LESION_FLIP_SHELL=$LA_DIR/${1}/ses-$SESSION/dwi/${1}_ses-${SESSION}_space-T1w_desc-lesion_desc-flipped_res-2mm_desc-dil${i}_shell.nii.gz
-                
-                # Define output
-                ###############
-
-                FW_SHELL_FLIP=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-shell${i}_desc-flipped_FW.nii.gz
-                FAt_SHELL_FLIP=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-FWcorrected_desc-shell${i}_desc-flipped_FA.nii.gz
-                MD_SHELL_FLIP=$TMP_OUT/${1}_ses-${SESSION}_space-T1w_desc-DTINoNeg_desc-shell${i}_desc-flipped_MD.nii.gz
-
-                # Define commands
-                #################
-
-                CMD_SHELL_FLIP_FW="fslmaths $FW_IMAGE -mul $LESION_FLIP_SHELL $FW_SHELL_FLIP"
-                CMD_SHELL_FLIP_MEAN_FW="fslstats $FW_SHELL_FLIP -M"
-                CMD_SHELL_FLIP_FAt="fslmaths $FAt_IMAGE -mul $LESION_FLIP_SHELL $FAt_SHELL_FLIP"
-                CMD_SHELL_FLIP_MEAN_FAt="fslstats $FAt_SHELL_FLIP -M"
-                CMD_SHELL_FLIP_MD="fslmaths $MD_IMAGE -mul $LESION_FLIP_SHELL $MD_SHELL_FLIP"
-                CMD_SHELL_FLIP_MEAN_MD="fslstats $MD_SHELL_FLIP -M"
-
-                # Execute commands
-                ##################
-
-                $singularity_fsl /bin/bash -c "$CMD_SHELL_FLIP_FW;$CMD_SHELL_FLIP_FAt;$CMD_SHELL_FLIP_MD"
-                mean_shell_flip_fw=`$singularity_fsl $CMD_SHELL_FLIP_MEAN_FW | tail -n 1`
-                mean_shell_flip_fat=`$singularity_fsl $CMD_SHELL_FLIP_MEAN_FAt | tail -n 1`
-                mean_shell_flip_md=`$singularity_fsl $CMD_SHELL_FLIP_MEAN_MD | tail -n 1`
-            
-            fi
-        
-        #############################
-        # Append shell means to CSV #
-        #############################
-
-            if [ $MODIFIER == "yes" ]; then
-
-                echo -n "$mean_shell_fw,$mean_shell_flip_fw,$mean_shell_fat,$mean_shell_flip_fat,$mean_shell_md,$mean_shell_flip_md," >> $CSV
-            
-            elif [ $MODIFIER == "no" ]; then
-
-                echo -n "$mean_shell_fw,$mean_shell_fat,$mean_shell_md," >> $CSV
+        # Execute command
+        #################
 
-            fi
-        
-        done
+        $singularity_miniconda $CMD_PROFILE
     
     fi
 
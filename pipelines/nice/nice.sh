@@ -58,6 +58,10 @@ singularity_fsl="singularity run --cleanenv --userns \
     -B $TMP_OUT \
     $ENV_DIR/$container_fsl"
 
+# Use the node's persistent container instances (utils/container_instances.sh) when run via 02_pipelines_batch.sh
+[ -n "$CONTAINER_RUN" ] && singularity_mrtrix3="$CONTAINER_RUN $container_mrtrix3"
+[ -n "$CONTAINER_RUN" ] && singularity_fsl="$CONTAINER_RUN $container_fsl"
+
 # Define pipeline output directory 
 ##################################
 
@@ -502,6 +506,9 @@ elif [ $TEMP_SPACE == "brainder" ];then
 
 fi
 
+# Read the template from the node-local asset cache (utils/asset_cache.py) when run via 02_pipelines_batch.sh
+[ -n "$ASSET_PATH" ] && TEMPLATE=$($ASSET_PATH $TEMPLATE)
+
 # Define output
 ###############
 
@@ -14,6 +14,15 @@
 #   [container]                                                                                  #
 #       - fsl-6.0.3                                                                              #
 #       - mrtrix3-3.0.2                                                                          #
+#       - csi-miniconda                                                                          #
+#   [code]                                                                                       #
+#       - psmd_engine.py                                                                         #
+#                                                                                                #
+# The subject level fits DTI, registers FA to MNI space and projects FA and MD onto the skeleton #
+# with TBSS (default, PSMD_PROJECTION=fsl). With PSMD_PROJECTION=engine projection and histogram #
+# analysis of all subjects are done at group level by psmd_engine.py in one run instead; its     #
+# numpy projection is not identical to tbss_skeleton (see psmd_engine.py) and has not been       #
+# validated against it on real subjects, so values are not comparable with FSL runs              #
 ##################################################################################################
 
 # Get verbose outputs
@@ -50,11 +59,28 @@ singularity_fsl="singularity run --cleanenv --no-home --userns \
     -B $TMP_OUT \
     $ENV_DIR/$container_fsl" 
 
+container_miniconda=miniconda-csi
+singularity_miniconda="singularity run --cleanenv --no-home --userns \
+    -B .
+    -B $PROJ_DIR \
+    -B $(readlink -f $ENV_DIR) \
+    -B $TMP_DIR \
+    -B $TMP_IN \
+    -B $TMP_OUT \
+    $ENV_DIR/$container_miniconda"
+
+# Use the node's persistent container instances (utils/container_instances.sh) when run via 02_pipelines_batch.sh
+[ -n "$CONTAINER_RUN" ] && singularity_mrtrix3="$CONTAINER_RUN $container_mrtrix3"
+[ -n "$CONTAINER_RUN" ] && singularity_fsl="$CONTAINER_RUN $container_fsl"
+[ -n "$CONTAINER_RUN" ] && singularity_miniconda="$CONTAINER_RUN $container_miniconda"
+
 # Define PSMD output directory
 ##############################
 
 PSMD_DIR=$DATA_DIR/psmd${PIPELINE_SUFFIX}
 
+[ -z $PSMD_PROJECTION ] && PSMD_PROJECTION=fsl
+
 #############################################
 # PSMD calculation - subject level analysis #
 #############################################
@@ -123,6 +149,7 @@ if [ $ANALYSIS_LEVEL == "subject" ]; then
     # Input
 
     FA_MNI_TARGET="$ENV_DIR/standard/FMRIB58_FA_1mm.nii.gz"
+    [ -n "$ASSET_PATH" ] && FA_MNI_TARGET=$($ASSET_PATH $FA_MNI_TARGET)
     FA="$TMP_OUT/tbss/FA/temp-DTI_FA_FA.nii.gz"
     MD="$TMP_OUT/temp-DTI_MD.nii.gz"
 
@@ -180,119 +207,147 @@ if [ $ANALYSIS_LEVEL == "subject" ]; then
     $singularity_mrtrix3 $CMD_FA2MNI
     $singularity_mrtrix3 $CMD_MD2MNI
 
-    # Run TBSS 3 postreg
-    ####################
+    # With PSMD_PROJECTION=engine registered FA and MD are projected onto the skeleton for all subjects at group level
+    # (psmd_engine.py); by default TBSS projects them per subject
 
-    mkdir $TMP_OUT/tbss/stats
-    cp $FA_MNI $TMP_OUT/tbss/stats/all_FA.nii.gz
+    if [ $PSMD_PROJECTION == "fsl" ]; then
 
-    pushd $TMP_OUT/tbss/stats
+        # Run TBSS 3 postreg
+        ####################
 
-    echo "creating valid mask and mean FA"
-    $singularity_fsl fslmaths all_FA -max 0 -Tmin -bin mean_FA_mask -odt char
-    $singularity_fsl fslmaths all_FA -mas mean_FA_mask all_FA
-    $singularity_fsl fslmaths all_FA -Tmean mean_FA
+        mkdir $TMP_OUT/tbss/stats
+        cp $FA_MNI $TMP_OUT/tbss/stats/all_FA.nii.gz
 
-    echo "creating skeleton"
-    $singularity_fsl fslmaths $ENV_DIR/standard/FMRIB58_FA_1mm -mas mean_FA_mask mean_FA
-    $singularity_fsl fslmaths mean_FA -bin mean_FA_mask
-    $singularity_fsl fslmaths all_FA -mas mean_FA_mask all_FA
-    $singularity_fsl imcp $ENV_DIR/standard/FMRIB58_FA-skeleton_1mm mean_FA_skeleton
+        pushd $TMP_OUT/tbss/stats
 
-    popd
+        echo "creating valid mask and mean FA"
+        $singularity_fsl fslmaths all_FA -max 0 -Tmin -bin mean_FA_mask -odt char
+        $singularity_fsl fslmaths all_FA -mas mean_FA_mask all_FA
+        $singularity_fsl fslmaths all_FA -Tmean mean_FA
+
+        echo "creating skeleton"
+        $singularity_fsl fslmaths $ENV_DIR/standard/FMRIB58_FA_1mm -mas mean_FA_mask mean_FA
+        $singularity_fsl fslmaths mean_FA -bin mean_FA_mask
+        $singularity_fsl fslmaths all_FA -mas mean_FA_mask all_FA
+        $singularity_fsl imcp $ENV_DIR/standard/FMRIB58_FA-skeleton_1mm mean_FA_skeleton
 
-    # Run TBSS 4 prestats
-    #####################
+        popd
 
-    $singularity_fsl tbss_4_prestats 0.2
+        # Run TBSS 4 prestats
+        #####################
 
-    # Run TBSS NonFA
-    ################
+        $singularity_fsl tbss_4_prestats 0.2
 
-    cp $TMP_OUT/tbss/MD/${1}_ses-${SESSION}_space-MNI_MD.nii.gz $TMP_OUT/tbss/stats/all_MD.nii.gz
+        # Run TBSS NonFA
+        ################
 
-    pushd $TMP_OUT/tbss/stats
+        cp $TMP_OUT/tbss/MD/${1}_ses-${SESSION}_space-MNI_MD.nii.gz $TMP_OUT/tbss/stats/all_MD.nii.gz
 
-    echo "masking MD and projecting onto FA skeleton"
+        pushd $TMP_OUT/tbss/stats
+
+        echo "masking MD and projecting onto FA skeleton"
  
-    CMD_MASK="
-        fslmaths \
-            all_MD \
-            -mas mean_FA_mask \
-            all_MD"
-
-    CMD_PROJ="
-        tbss_skeleton \
-            -i mean_FA \
-            -p 0.2 mean_FA_skeleton_mask_dst $ENV_DIR/standard/LowerCingulum_1mm all_FA all_MD_skeletonised \
-            -a all_MD"
-
-    $singularity_fsl $CMD_MASK
-    $singularity_fsl $CMD_PROJ
-
-    # Histogram analysis
-    ####################
+        CMD_MASK="
+            fslmaths \
+                all_MD \
+                -mas mean_FA_mask \
+                all_MD"
+
+        CMD_PROJ="
+            tbss_skeleton \
+                -i mean_FA \
+                -p 0.2 mean_FA_skeleton_mask_dst $ENV_DIR/standard/LowerCingulum_1mm all_FA all_MD_skeletonised \
+                -a all_MD"
+
+        $singularity_fsl $CMD_MASK
+        $singularity_fsl $CMD_PROJ
+
+        # Histogram analysis
+        ####################
     
-    SKELETON_MASK=$PIPELINE_DIR/skeleton_mask_2019.nii.gz
+        SKELETON_MASK=$PIPELINE_DIR/skeleton_mask_2019.nii.gz
+        [ -n "$ASSET_PATH" ] && SKELETON_MASK=$($ASSET_PATH $SKELETON_MASK)
     
-    $singularity_fsl fslmaths all_MD_skeletonised.nii.gz -mas $SKELETON_MASK -mul 1000000 MD_skeletonised_masked.nii.gz
-    mdskel=MD_skeletonised_masked.nii.gz
+        $singularity_fsl fslmaths all_MD_skeletonised.nii.gz -mas $SKELETON_MASK -mul 1000000 MD_skeletonised_masked.nii.gz
+        mdskel=MD_skeletonised_masked.nii.gz
 
-    # Whole brain metrics
+        # Whole brain metrics
       
-    a=`$singularity_fsl fslstats $mdskel -P 95 | tail -n 1`
-    b=`$singularity_fsl fslstats $mdskel -P 5 | tail -n 1`
-    psmd_global=`echo - | awk "{print ( ${a} - ${b} ) / 1000000 }" | sed 's/,/./'`
+        a=`$singularity_fsl fslstats $mdskel -P 95 | tail -n 1`
+        b=`$singularity_fsl fslstats $mdskel -P 5 | tail -n 1`
+        psmd_global=`echo - | awk "{print ( ${a} - ${b} ) / 1000000 }" | sed 's/,/./'`
 
-    # Left and right hemisphere metrics
+        # Left and right hemisphere metrics
 
-    $singularity_fsl fslmaths $mdskel -roi  0 90 0 -1 0 -1 0 -1 MD_skeletonised_masked_R.nii.gz
-    $singularity_fsl fslmaths $mdskel -roi 91 90 0 -1 0 -1 0 -1 MD_skeletonised_masked_L.nii.gz
+        $singularity_fsl fslmaths $mdskel -roi  0 90 0 -1 0 -1 0 -1 MD_skeletonised_masked_R.nii.gz
+        $singularity_fsl fslmaths $mdskel -roi 91 90 0 -1 0 -1 0 -1 MD_skeletonised_masked_L.nii.gz
 
-    mdskel=MD_skeletonised_masked_L.nii.gz
-    a=`$singularity_fsl fslstats $mdskel -P 95 | tail -n 1`
-    b=`$singularity_fsl fslstats $mdskel -P 5 | tail -n 1`
-    psmdL=`echo - | awk "{print ( ${a} - ${b} ) / 1000000 }" | sed 's/,/./'`
+        mdskel=MD_skeletonised_masked_L.nii.gz
+        a=`$singularity_fsl fslstats $mdskel -P 95 | tail -n 1`
+        b=`$singularity_fsl fslstats $mdskel -P 5 | tail -n 1`
+        psmdL=`echo - | awk "{print ( ${a} - ${b} ) / 1000000 }" | sed 's/,/./'`
 
-    mdskel=MD_skeletonised_masked_R.nii.gz
-    a=`$singularity_fsl fslstats $mdskel -P 95 | tail -n 1`
-    b=`$singularity_fsl fslstats $mdskel -P 5 | tail -n 1`
-    psmdR=`echo - | awk "{print ( ${a} - ${b} ) / 1000000 }" | sed 's/,/./'`
+        mdskel=MD_skeletonised_masked_R.nii.gz
+        a=`$singularity_fsl fslstats $mdskel -P 95 | tail -n 1`
+        b=`$singularity_fsl fslstats $mdskel -P 5 | tail -n 1`
+        psmdR=`echo - | awk "{print ( ${a} - ${b} ) / 1000000 }" | sed 's/,/./'`
 
-    popd
+        popd
 
-    # Create CSV file
-    #################
+        # Create CSV file
+        #################
 
-    echo "sub_id,psmd_global,psmd_left,psmd_right" > $PSMD_DIR/$1/ses-${SESSION}/dwi/${1}_ses-${SESSION}_psmd.csv
-    echo $1,$psmd_global,$psmdL,$psmdR >> $PSMD_DIR/$1/ses-${SESSION}/dwi/${1}_ses-${SESSION}_psmd.csv
+        echo "sub_id,psmd_global,psmd_left,psmd_right" > $PSMD_DIR/$1/ses-${SESSION}/dwi/${1}_ses-${SESSION}_psmd.csv
+        echo $1,$psmd_global,$psmdL,$psmdR >> $PSMD_DIR/$1/ses-${SESSION}/dwi/${1}_ses-${SESSION}_psmd.csv
+
+    fi
 
     popd
 
     # Copy data to /work
     ####################
 
-    cp -ruvf $TMP_OUT/tbss $PSMD_DIR/$1/ses-${SESSION}/dwi/
+    [ $PSMD_PROJECTION == "fsl" ] && cp -ruvf $TMP_OUT/tbss $PSMD_DIR/$1/ses-${SESSION}/dwi/
+    cp -uvf $FA_MNI $MD_MNI $FA2MNI_WARP $PSMD_DIR/$1/ses-${SESSION}/dwi/
 
 
-#######################################
-# Combine CSVs - group level analysis #
-#######################################
+###########################################
+# PSMD calculation - group level analysis #
+###########################################
 
 elif [ $ANALYSIS_LEVEL == "group" ]; then
 
     [ -d $PSMD_DIR/derivatives/ses-${SESSION}/dwi ] || mkdir -p $PSMD_DIR/derivatives/ses-${SESSION}/dwi
 
-    pushd $PSMD_DIR
-    echo "sub_id,psmd_global,psmd_left,psmd_right" > $PSMD_DIR/derivatives/ses-${SESSION}/dwi/group_ses-${SESSION}_psmd.csv
-    
-        for sub in $(ls -d sub-*); do
+    if [ $PSMD_PROJECTION == "fsl" ]; then
 
-            tail -n 1 $PSMD_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_psmd.csv >> \
-            $PSMD_DIR/derivatives/ses-${SESSION}/dwi/group_ses-${SESSION}_psmd.csv
+        pushd $PSMD_DIR
+        echo "sub_id,psmd_global,psmd_left,psmd_right" > $PSMD_DIR/derivatives/ses-${SESSION}/dwi/group_ses-${SESSION}_psmd.csv
         
-        done
+            for sub in $(ls -d sub-*); do
 
-    popd
+                tail -n 1 $PSMD_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_psmd.csv >> \
+                $PSMD_DIR/derivatives/ses-${SESSION}/dwi/group_ses-${SESSION}_psmd.csv
+            
+            done
+
+        popd
+
+    elif [ $PSMD_PROJECTION == "engine" ]; then
+
+        # Skeleton projection and histogram analysis of all subjects with MNI space FA and MD in one run; the projection
+        # lookup is computed once and reused from $PSMD_DIR/derivatives/ses-${SESSION}/dwi. Per subject CSVs are written
+        # next to the MNI space maps as by the subject level with FSL
+
+        $singularity_miniconda python $PIPELINE_DIR/psmd_engine.py \
+            -d $PSMD_DIR \
+            --session $SESSION \
+            -t $ENV_DIR/standard \
+            -m $PIPELINE_DIR/skeleton_mask_2019.nii.gz \
+            -o $PSMD_DIR/derivatives/ses-${SESSION}/dwi/group_ses-${SESSION}_psmd.csv \
+            --subject-csvs \
+            -n $SLURM_CPUS_PER_TASK
+
+    fi
 
-fi
\ No newline at end of file
+fi
@@ -0,0 +1,271 @@
+# Cohort PSMD engine
+# Computes PSMD (peak width of skeletonized mean diffusivity, Baykara et al. 2016) of all subjects of a session in
+# one run from their MNI space FA and MD maps (written by the subject level of psmd_csi.sh).
+#
+# The TBSS projection (tbss_4_prestats 0.2 + tbss_skeleton -p against FMRIB58_FA-skeleton_1mm, formerly rerun for
+# every subject in a private tbss/ tree) only depends on the template, so its search paths are precomputed once into
+# a lookup table: for every voxel of the thresholded skeleton within skeleton_mask_2019, the voxels along the
+# perpendicular to the skeleton (along z within the lower cingulum search rule mask) as long as the distance to the
+# skeleton increases. The lookup is stored next to the group table and reused while template and masks are
+# unchanged. Per subject, FA and MD of all search paths are gathered with the lookup in one indexing operation and
+# the MD at the FA maximum of every path is projected; the 5th and 95th percentiles of the nonzero skeleton values
+# (as fslstats -P) of the whole skeleton and both hemispheres are then taken for blocks of subjects at once.
+#
+# The projection is a reimplementation of tbss_skeleton -p and differs from the FSL path of psmd_csi.sh: the search
+# stops where the distance to the skeleton stops increasing (tbss_4_prestats also measures the distance to the edge of
+# the subject's mean_FA_mask), the template brain mask is used instead of the subject's mean_FA_mask and the lower
+# cingulum rule only searches along z. PSMD values are therefore not comparable with those of the FSL path; it is only
+# run with PSMD_PROJECTION=engine and has not been validated against tbss_skeleton on real subjects.
+#
+# Output: group table (sub_id,psmd_global,psmd_left,psmd_right), as written by the former group level, and with
+#         --subject-csvs per subject tables <sub>/ses-<ses>/dwi/<sub>_ses-<ses>_psmd.csv as written by the FSL path
+#
+# execute e.g. via
+# python psmd_engine.py -d data/psmd_csi --session 1 -t envs/standard -o data/psmd_csi/derivatives/ses-1/dwi/group_ses-1_psmd.csv [-n 8]
+# with a python environment containing numpy, scipy and nibabel
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+import csv
+import hashlib
+import os
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import distance_transform_edt
+
+SKELETON_THRESHOLD = 0.2
+MAX_STEPS = 20
+# Voxel columns of the hemispheres in MNI 1mm space (fslmaths -roi 0 90 / -roi 91 90)
+RIGHT, LEFT = slice(0, 90), slice(91, 181)
+BLOCK = 256
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Compute PSMD of a cohort in one vectorized pass with a precomputed skeleton projection')
+    parser.add_argument(
+        '-d', '--psmd-dir', required=True,
+        help='[required]\n psmd directory with <sub>/ses-<ses>/dwi/<sub>_ses-<ses>_space-MNI_{FA,MD}.nii.gz')
+    parser.add_argument(
+        '--session', required=True,
+        help='[required]\n session, e.g. 1')
+    parser.add_argument(
+        '-t', '--standard-dir', required=True,
+        help='[required]\n directory with FMRIB58_FA_1mm, FMRIB58_FA-skeleton_1mm and LowerCingulum_1mm')
+    parser.add_argument(
+        '-m', '--skeleton-mask', default=str(Path(__file__).resolve().parent / "skeleton_mask_2019.nii.gz"),
+        help='[optional]\n skeleton mask; default skeleton_mask_2019.nii.gz next to this script')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n group table (CSV)')
+    parser.add_argument(
+        '-s', '--subjects', nargs='+',
+        help='[optional]\n subjects (or a file with one subject per line); default all subjects in the psmd directory')
+    parser.add_argument(
+        '--subject-csvs', action='store_true',
+        help='[optional]\n also write <sub>_ses-<ses>_psmd.csv of every subject next to its FA and MD')
+    parser.add_argument(
+        '-n', '--n-procs', type=int, default=1,
+        help='[optional]\n processes reading subject images; default 1')
+    return parser
+
+
+##########
+# Lookup #
+##########
+
+def load(path):
+    for candidate in (Path(path), Path(f"{path}.nii.gz")):
+        if candidate.exists():
+            return np.asanyarray(nib.load(candidate).dataobj, dtype=np.float32)
+    raise SystemExit(f"{path} not found")
+
+
+def directions(mean_fa, voxels):
+    """Perpendicular of the skeleton per voxel, following tbss_skeleton: towards the local FA centre of gravity
+    if it is off-centre, otherwise the neighbour direction across which FA drops most."""
+
+    offsets = np.array([offset for offset in product((-1, 0, 1), repeat=3) if any(offset)])
+    padded = np.pad(mean_fa, 1)
+    x, y, z = (voxels + 1).T
+    neighbours = np.stack([padded[x + i, y + j, z + k] for i, j, k in offsets], axis=1)
+    centre = padded[x, y, z]
+
+    weights = np.concatenate([neighbours, centre[:, None]], axis=1)
+    cog = (neighbours @ offsets) / np.maximum(weights.sum(axis=1), 1e-6)[:, None]
+    off_centre = np.linalg.norm(cog, axis=1) > 0.6
+    cog_direction = np.rint(cog / np.maximum(np.abs(cog).max(axis=1), 1e-6)[:, None]).astype(int)
+
+    # One of each pair of opposite directions (the search runs both ways); on ties, face neighbours come first
+    half = np.argsort(np.abs(offsets[:13]).sum(axis=1), kind="stable")
+    opposite = np.array([np.flatnonzero((offsets == -offsets[i]).all(axis=1))[0] for i in half])
+    across = neighbours[:, half] + neighbours[:, opposite]
+    drop_direction = offsets[half][np.argmin(across, axis=1)]
+
+    return np.where(off_centre[:, None], cog_direction, drop_direction)
+
+
+def build_lookup(standard_dir, skeleton_mask):
+    """Flat voxel indices of the search paths (voxels x steps, -1 padded) and hemisphere of each skeleton voxel."""
+
+    mean_fa = load(standard_dir / "FMRIB58_FA_1mm")
+    skeleton = load(standard_dir / "FMRIB58_FA-skeleton_1mm") > SKELETON_THRESHOLD
+    cingulum = load(standard_dir / "LowerCingulum_1mm") > 0
+    brain = mean_fa > 0
+
+    distance = distance_transform_edt(~skeleton) * brain
+    voxels = np.argwhere(skeleton & brain & (load(skeleton_mask) > 0))
+    direction = directions(mean_fa, voxels)
+    direction[cingulum[tuple(voxels.T)]] = (0, 0, 1)
+
+    shape = np.array(mean_fa.shape)
+    paths = np.full((len(voxels), 2 * MAX_STEPS + 1), -1, dtype=np.int64)
+    paths[:, 0] = np.ravel_multi_index(voxels.T, mean_fa.shape)
+    for sign, column in ((1, 1), (-1, 1 + MAX_STEPS)):
+        previous = np.zeros(len(voxels))
+        active = np.ones(len(voxels), dtype=bool)
+        for step in range(1, MAX_STEPS + 1):
+            position = voxels + sign * step * direction
+            active &= ((position >= 0) & (position < shape)).all(axis=1)
+            current = np.zeros(len(voxels))
+            current[active] = distance[tuple(position[active].T)]
+            # Search continues while the distance to the skeleton increases
+            active &= current > previous
+            paths[active, column + step - 1] = np.ravel_multi_index(position[active].T, mean_fa.shape)
+            previous = current
+
+    # Drop step columns no path reaches
+    paths = paths[:, (paths >= 0).any(axis=0)]
+
+    hemisphere = np.full(len(voxels), "", dtype="<U1")
+    hemisphere[(voxels[:, 0] >= RIGHT.start) & (voxels[:, 0] < RIGHT.stop)] = "R"
+    hemisphere[(voxels[:, 0] >= LEFT.start) & (voxels[:, 0] < LEFT.stop)] = "L"
+    return paths, hemisphere
+
+
+def lookup(standard_dir, skeleton_mask, cache_dir):
+    """Lookup of the cohort, reused while template, skeleton and masks are unchanged."""
+
+    inputs = [standard_dir / f"{name}.nii.gz" for name in ("FMRIB58_FA_1mm", "FMRIB58_FA-skeleton_1mm", "LowerCingulum_1mm")]
+    state = [(str(path), path.stat().st_size, path.stat().st_mtime_ns) for path in inputs + [Path(skeleton_mask)] if path.exists()]
+    key = hashlib.sha1(repr((state, SKELETON_THRESHOLD, MAX_STEPS)).encode()).hexdigest()[:12]
+    cache = cache_dir / f"psmd_lookup_{key}.npz"
+    if cache.exists():
+        stored = np.load(cache)
+        return stored["paths"], stored["hemisphere"]
+
+    paths, hemisphere = build_lookup(standard_dir, skeleton_mask)
+    tmp = cache.with_name(".tmp_" + cache.name)
+    with open(tmp, "wb") as f:
+        np.savez(f, paths=paths, hemisphere=hemisphere)
+    os.replace(tmp, cache)
+    print(f"Projection lookup of {len(paths)} skeleton voxels written to {cache}")
+    return paths, hemisphere
+
+
+############
+# Subjects #
+############
+
+index, valid = None, None
+
+
+def init_worker(paths):
+    global index, valid
+    valid = paths >= 0
+    index = np.where(valid, paths, 0)
+
+
+def project(job):
+    """MD at the FA maximum along every search path of one subject; None if images are missing."""
+
+    sub, fa_path, md_path = job
+    try:
+        fa = np.asanyarray(nib.load(fa_path).dataobj, dtype=np.float32).ravel()
+        md = np.asanyarray(nib.load(md_path).dataobj, dtype=np.float32).ravel()
+    except (FileNotFoundError, nib.filebasedimages.ImageFileError) as error:
+        print(f"{sub}: {error}")
+        return sub, None
+    path_fa = np.where(valid, fa[index], -np.inf)
+    best = np.take_along_axis(index, np.argmax(path_fa, axis=1)[:, None], axis=1)[:, 0]
+    # MD is masked by the FA mask of the subject, as all_MD -mas mean_FA_mask
+    return sub, np.where(fa[best] > 0, md[best], 0)
+
+
+def percentile_width(values):
+    """95th minus 5th percentile of the nonzero values of every row, with fslstats -P indexing."""
+
+    values = np.where(values != 0, values, np.nan)
+    n = np.sum(~np.isnan(values), axis=1)
+    ordered = np.sort(values, axis=1)
+
+    def percentile(p):
+        index = np.minimum((p / 100 * n).astype(int), np.maximum(n - 1, 0))
+        return np.take_along_axis(ordered, index[:, None], axis=1)[:, 0]
+
+    width = percentile(95) - percentile(5)
+    return np.where(n > 0, width, np.nan)
+
+
+def write_table(path, rows):
+    tmp = path.with_name(".tmp_" + path.name)
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["sub_id", "psmd_global", "psmd_left", "psmd_right"])
+        writer.writerows(rows)
+    os.replace(tmp, path)
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    psmd_dir, output = Path(opts.psmd_dir), Path(opts.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    subjects = opts.subjects or sorted(path.name for path in psmd_dir.glob("sub-*") if path.is_dir())
+    if opts.subjects and len(subjects) == 1 and Path(subjects[0]).is_file():
+        subjects = Path(subjects[0]).read_text().split()
+
+    paths, hemisphere = lookup(Path(opts.standard_dir), opts.skeleton_mask, output.parent)
+
+    def image(sub, mod):
+        return psmd_dir / sub / f"ses-{opts.session}" / "dwi" / f"{sub}_ses-{opts.session}_space-MNI_{mod}.nii.gz"
+
+    jobs = [(sub, image(sub, "FA"), image(sub, "MD")) for sub in subjects]
+    rows, missing = [], []
+    with ProcessPoolExecutor(max_workers=opts.n_procs, initializer=init_worker, initargs=(paths,)) as pool:
+        for start in range(0, len(jobs), BLOCK):
+            block = list(pool.map(project, jobs[start:start + BLOCK]))
+            missing += [sub for sub, skeleton in block if skeleton is None]
+            block = [(sub, skeleton) for sub, skeleton in block if skeleton is not None]
+            if not block:
+                continue
+            # Percentiles of all subjects of the block at once; subjects x skeleton voxels
+            skeleton = np.stack([values for _, values in block])
+            widths = [percentile_width(skeleton),
+                      percentile_width(skeleton[:, hemisphere == "L"]),
+                      percentile_width(skeleton[:, hemisphere == "R"])]
+            rows += [[sub] + [width[i] for width in widths] for i, (sub, _) in enumerate(block)]
+            print(f"{start + len(block)} of {len(jobs)} subjects")
+
+    rows = [[row[0]] + [f"{value:.6g}" if np.isfinite(value) else "" for value in row[1:]] for row in rows]
+    write_table(output, rows)
+    if opts.subject_csvs:
+        for row in rows:
+            write_table(image(row[0], "FA").with_name(f"{row[0]}_ses-{opts.session}_psmd.csv"), [row])
+
+    if missing:
+        print(f"Missing FA or MD images of {len(missing)} subjects: {' '.join(missing)}")
+    print(f"PSMD of {len(rows)} subjects written to {output}")
+
+
+if __name__ == "__main__":
+    main()
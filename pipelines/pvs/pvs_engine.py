@@ -0,0 +1,253 @@
+# PVS segmentation post-processing and quantification engine for pvs_frangi / pvs_rorpo
+#
+# segment:  thresholds the regional vesselness maps (<sub>_ses-1_PVS_{Left,Right}{BG,CSO}_NAWM, _Midbrain_NAWM) of one
+#           subject in one pass (formerly one fslmaths call per map) at the robust minimum of the first BG map
+#           (fslstats -r) or at --threshold, removes exclusion masks (manual aqueduct/ventricle mask, WMH) and writes
+#           <prefix>_desc-pvs_mask.nii.gz, <prefix>_desc-pvs_desc-{bg,cso,midbrain}_mask.nii.gz and the region labels
+#           <prefix>_desc-pvs_dseg.nii.gz (1 = BG, 2 = CSO, 3 = midbrain)
+#
+# quantify: labels the PVS segmentation of all subjects (in parallel) into connected components (26-connectivity, as
+#           cluster --thresh=1) and computes per PVS its volume, length and orientation from the voxel coordinate
+#           moments of all components at once: the principal axis (largest eigenvector of the coordinate covariance)
+#           gives the orientation (absolute RAS components; none for single voxel PVS, which are left out of the mean
+#           orientations), the length is sqrt(12 * variance + voxel extent^2) along it, the extent of a straight PVS.
+#           PVS are assigned to the region holding most of their voxels. Writes
+#           <output>.csv         one row per subject: sub_id, pvs_count, pvs_volume (mm3), pvs_length_{mean,median}
+#                                (mm), pvs_orientation_{x,y,z} and the same for bg_, cso_ and midbrain_pvs_*
+#           <output>_pvs.csv     one row per PVS: sub_id, pvs, region, voxels, volume, length, orientation_{x,y,z},
+#                                centroid_{x,y,z} (mm)
+#           (formerly fslstats -V / cluster text files per subject and region, appended one subject at a time)
+#
+# execute e.g. via
+# python pvs_engine.py segment --bg <LeftBG> <RightBG> --cso <LeftCSO> <RightCSO> --midbrain <Midbrain> -e <mask> -o <prefix>
+# python pvs_engine.py quantify -s sub-001 sub-002 -p 'data/pvs_frangi/{sub}/ses-1/Segmentation/PVS/{sub}_ses-1_space-T1_desc-pvs_dseg.nii.gz' -o data/pvs_frangi/derivatives/pvs_frangi_summary [-n 8]
+# with a python environment containing numpy, scipy and nibabel
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import csv
+import os
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import label
+
+REGIONS = ("bg", "cso", "midbrain")
+STATS = ("count", "volume", "length_mean", "length_median", "orientation_x", "orientation_y", "orientation_z")
+PVS_COLUMNS = ("sub_id", "pvs", "region", "voxels", "volume", "length", "orientation_x", "orientation_y",
+               "orientation_z", "centroid_x", "centroid_y", "centroid_z")
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Segment PVS from regional vesselness maps and quantify them per PVS, region and subject')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    segment = subparsers.add_parser(
+        'segment', formatter_class=RawTextHelpFormatter,
+        help='threshold regional maps of one subject and write PVS masks and region labels')
+    segment.add_argument(
+        '--bg', required=True, nargs='+',
+        help='[required]\n basal ganglia maps, e.g. <sub>_ses-1_PVS_LeftBG_NAWM.nii.gz <sub>_ses-1_PVS_RightBG_NAWM.nii.gz')
+    segment.add_argument(
+        '--cso', required=True, nargs='+',
+        help='[required]\n centrum semiovale maps')
+    segment.add_argument(
+        '--midbrain', required=True, nargs='+',
+        help='[required]\n midbrain maps')
+    segment.add_argument(
+        '-t', '--threshold', type=float,
+        help='[optional]\n vesselness threshold; default robust minimum of the first BG map (fslstats -r)')
+    segment.add_argument(
+        '-e', '--exclude', nargs='+', default=[],
+        help='[optional]\n masks removed from all PVS masks, e.g. manual aqueduct/ventricle mask or WMH mask')
+    segment.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output prefix, e.g. <out_dir>/<sub>_ses-1_space-T1')
+
+    quantify = subparsers.add_parser(
+        'quantify', formatter_class=RawTextHelpFormatter,
+        help='label PVS of all subjects and write cohort and per PVS tables')
+    quantify.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subjects (e.g. sub-001) or a file with one subject per line')
+    quantify.add_argument(
+        '-p', '--pattern', required=True,
+        help='[required]\n path of the region labels (segment) with {sub} for the subject')
+    quantify.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output prefix of <output>.csv and <output>_pvs.csv')
+    quantify.add_argument(
+        '-n', '--n-procs', type=int, default=1,
+        help='[optional]\n subjects processed in parallel; default 1')
+    return parser
+
+
+###########
+# Segment #
+###########
+
+def robust_min(values):
+    """Robust minimum as fslstats -r: 2nd percentile of all voxels."""
+    return float(np.percentile(values, 2))
+
+
+def save_mask(mask, img, path):
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), img.affine, img.header), path)
+
+
+def segment(opts):
+
+    maps = {region: paths for region, paths in zip(REGIONS, (opts.bg, opts.cso, opts.midbrain))}
+    reference = nib.load(maps["bg"][0])
+    data = {path: np.asanyarray(nib.load(path).dataobj, dtype=np.float32) for paths in maps.values() for path in paths}
+
+    threshold = opts.threshold if opts.threshold is not None else robust_min(data[maps["bg"][0]])
+    exclude = np.zeros(reference.shape, dtype=bool)
+    for path in opts.exclude:
+        exclude |= np.asanyarray(nib.load(path).dataobj) > 0
+
+    # Map above threshold (fslmaths -sub <threshold> -bin), minus exclusion masks
+    regions = {region: np.logical_or.reduce([data[path] > threshold for path in paths]) & ~exclude
+               for region, paths in maps.items()}
+    pvs = np.logical_or.reduce(list(regions.values()))
+
+    dseg = np.zeros(reference.shape, dtype=np.uint8)
+    # Reversed, so that the first region wins where regions overlap
+    for value, region in reversed(list(enumerate(REGIONS, 1))):
+        dseg[regions[region]] = value
+        save_mask(regions[region], reference, f"{opts.output}_desc-pvs_desc-{region}_mask.nii.gz")
+    save_mask(pvs, reference, f"{opts.output}_desc-pvs_mask.nii.gz")
+    nib.save(nib.Nifti1Image(dseg, reference.affine, reference.header), f"{opts.output}_desc-pvs_dseg.nii.gz")
+
+    print(f"Threshold {threshold:.6g}: {int(pvs.sum())} PVS voxels "
+          f"({', '.join(f'{region} {int(mask.sum())}' for region, mask in regions.items())}) written to {opts.output}_desc-pvs_*")
+
+
+############
+# Quantify #
+############
+
+def components(dseg, affine):
+    """Per PVS: region, voxels, volume, length, orientation (3) and centroid (3), from one labelling."""
+
+    labels, n = label(dseg > 0, structure=np.ones((3, 3, 3)))
+    voxel_volume = abs(np.linalg.det(affine[:3, :3]))
+    if n == 0:
+        return np.empty((0, 11)), voxel_volume
+
+    index = np.nonzero(labels)
+    lab = labels[index] - 1
+    coords = (affine[:3, :3] @ np.stack(index) + affine[:3, 3:]).T
+
+    # First and second moments of the coordinates of all components at once
+    count = np.bincount(lab, minlength=n)
+    mean = np.stack([np.bincount(lab, weights=coords[:, i], minlength=n) for i in range(3)], axis=1) / count[:, None]
+    centred = coords - mean[lab]
+    cov = np.empty((n, 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            cov[:, i, j] = cov[:, j, i] = np.bincount(lab, weights=centred[:, i] * centred[:, j], minlength=n) / count
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    principal = eigenvectors[:, :, -1]
+
+    # sqrt(12 * variance + voxel extent^2) along the principal axis is n * d for a straight line of n voxels of size d
+    extent = np.abs(principal @ affine[:3, :3]).sum(axis=1)
+    length = np.sqrt(12 * np.maximum(eigenvalues[:, -1], 0) + extent ** 2)
+    # Single voxels have no principal axis
+    orientation = np.where(count[:, None] > 1, np.abs(principal), np.nan)
+
+    # Region holding most voxels of the PVS
+    votes = np.bincount(lab * (len(REGIONS) + 1) + dseg[index], minlength=n * (len(REGIONS) + 1))
+    region = votes.reshape(n, len(REGIONS) + 1)[:, 1:].argmax(axis=1) + 1
+
+    return np.column_stack([region, count, count * voxel_volume, length, orientation, mean]), voxel_volume
+
+
+def summary(pvs, mask):
+    selected = pvs[mask]
+    if not len(selected):
+        return [0, 0, np.nan, np.nan, np.nan, np.nan, np.nan]
+    # Orientation over PVS of more than one voxel
+    oriented = selected[selected[:, 1] > 1, 4:7]
+    return [len(selected), selected[:, 2].sum(), selected[:, 3].mean(), np.median(selected[:, 3]),
+            *(oriented.mean(axis=0) if len(oriented) else [np.nan] * 3)]
+
+
+def quantify_subject(job):
+    """Cohort row and PVS rows of one subject; None if the segmentation is missing."""
+
+    sub, path = job
+    try:
+        img = nib.load(path)
+    except (FileNotFoundError, nib.filebasedimages.ImageFileError) as error:
+        print(f"{sub}: {error}")
+        return sub, None, None
+    dseg = np.asanyarray(img.dataobj).astype(np.int64)
+    pvs, voxel_volume = components(dseg, img.affine)
+
+    row = summary(pvs, np.ones(len(pvs), dtype=bool))
+    for value, region in enumerate(REGIONS, 1):
+        region_row = summary(pvs, pvs[:, 0] == value)
+        # Region volumes are counted voxelwise, so that PVS crossing regions are split as by fslstats -V
+        region_row[1] = np.count_nonzero(dseg == value) * voxel_volume
+        row += region_row
+    return sub, row, pvs
+
+
+def fmt(value):
+    return f"{value:.6g}" if np.isfinite(value) else ""
+
+
+def quantify(opts):
+
+    subjects = opts.subjects
+    if len(subjects) == 1 and Path(subjects[0]).is_file():
+        subjects = Path(subjects[0]).read_text().split()
+
+    header = ["sub_id"] + [f"pvs_{stat}" for stat in STATS] + [f"{region}_pvs_{stat}" for region in REGIONS for stat in STATS]
+    output, output_pvs = Path(f"{opts.output}.csv"), Path(f"{opts.output}_pvs.csv")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp, tmp_pvs = (path.with_name(".tmp_" + path.name) for path in (output, output_pvs))
+
+    jobs = [(sub, opts.pattern.format(sub=sub)) for sub in subjects]
+    missing, n_pvs = [], 0
+    with open(tmp, "w", newline="") as f, open(tmp_pvs, "w", newline="") as f_pvs, \
+            ProcessPoolExecutor(max_workers=opts.n_procs) as pool:
+        writer, writer_pvs = csv.writer(f, lineterminator="\n"), csv.writer(f_pvs, lineterminator="\n")
+        writer.writerow(header)
+        writer_pvs.writerow(PVS_COLUMNS)
+        for sub, row, pvs in pool.map(quantify_subject, jobs, chunksize=4):
+            if row is None:
+                missing.append(sub)
+                writer.writerow([sub] + [""] * (len(header) - 1))
+                continue
+            writer.writerow([sub] + [fmt(value) for value in row])
+            writer_pvs.writerows([sub, i, REGIONS[int(values[0]) - 1], int(values[1])] + [fmt(value) for value in values[2:]]
+                                 for i, values in enumerate(pvs, 1))
+            n_pvs += len(pvs)
+    os.replace(tmp, output)
+    os.replace(tmp_pvs, output_pvs)
+
+    if missing:
+        print(f"Missing PVS segmentations of {len(missing)} subjects: {' '.join(missing)}")
+    print(f"{n_pvs} PVS of {len(jobs) - len(missing)} subjects written to {output} and {output_pvs}")
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    if opts.command == "segment":
+        segment(opts)
+    elif opts.command == "quantify":
+        quantify(opts)
+
+
+if __name__ == "__main__":
+    main()
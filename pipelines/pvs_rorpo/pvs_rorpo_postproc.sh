@@ -9,8 +9,10 @@
 #       - fmriprep
 #       - wmh                                                                                                   
 #   [container]                                                                                                   
-#       - fsl 
 #       - mrtrix
+#       - miniconda-csi
+#   [code]
+#       - pvs/pvs_engine.py
 #                                                                                               
 ###################################################################################################################
 
@@ -28,14 +30,14 @@ TMP_OUT=$TMP_DIR/output;               [ ! -d $TMP_OUT ] && mkdir -p $TMP_OUT
 # Pipeline-specific environment
 ##################################
 # Singularity container version and command
-container_fsl=fsl-6.0.3
-singularity_fsl="singularity run --cleanenv --userns \
+container_miniconda=miniconda-csi
+singularity_miniconda="singularity run --cleanenv --userns \
     -B $PROJ_DIR \
     -B $(readlink -f $ENV_DIR) \
     -B $TMP_DIR/:/tmp \
     -B $TMP_IN:/tmp_in \
     -B $TMP_OUT:/tmp_out \
-    $ENV_DIR/$container_fsl" 
+    $ENV_DIR/$container_miniconda" 
 
 container_mrtrix=mrtrix3-3.0.2
 singularity_mrtrix="singularity run --cleanenv --userns \
@@ -72,37 +74,18 @@ T1_TO_MNI_WARP=$DATA_DIR/fmriprep/$1/ses-${SESSION}/anat/${1}_ses-${SESSION}_fro
 SEGMENTATION_WMH=$DATA_DIR/wmh/$1/ses-${SESSION}/anat/LOCATE/${1}_ses-${SESSION}_space-T1_desc-masked_desc-wmh_desc-LOCATE_mask.nii.gz
 
 # Define outputs
-MASK1_THRESH=$OUT_DIR/${1}_ses-1_PVS_LeftBG_NAWM_thresh.nii.gz
-MASK2_THRESH=$OUT_DIR/${1}_ses-1_PVS_LeftCSO_NAWM_thresh.nii.gz
-MASK3_THRESH=$OUT_DIR/${1}_ses-1_PVS_Midbrain_NAWM_thresh.nii.gz
-MASK4_THRESH=$OUT_DIR/${1}_ses-1_PVS_RightBG_NAWM_thresh.nii.gz
-MASK5_THRESH=$OUT_DIR/${1}_ses-1_PVS_RightCSO_NAWM_thresh.nii.gz
-SEGMENTATION_PVS=$OUT_DIR/${1}_ses-1_space-T1_desc-pvs_mask.nii.gz
+SEGMENTATION_PREFIX=$OUT_DIR/${1}_ses-1_space-T1
+SEGMENTATION_PVS=${SEGMENTATION_PREFIX}_desc-pvs_mask.nii.gz
 SEGMENTATION_PVS_MNI=$OUT_DIR/${1}_ses-1_space-MNI_desc-pvs_mask.nii.gz
-PVS_vol=$DERIVATIVE_dir/${1}_ses-1_pvsvolume.csv
-PVS_count=$DERIVATIVE_dir/${1}_ses-1_pvscount.csv
-threshold=$DERIVATIVE_dir/${1}_thresh.csv
 
 # Define commands 
-$singularity_fsl /bin/bash -c "$(echo fslstats $MASK1 -r) > $threshold"
-CMD_THRESH_MASK_1="fslmaths $MASK1 -sub $(cat $threshold | sed 's/\s.*$//') -bin $MASK1_THRESH"
-CMD_THRESH_MASK_2="fslmaths $MASK2 -sub $(cat $threshold | sed 's/\s.*$//') -bin $MASK2_THRESH"
-CMD_THRESH_MASK_3="fslmaths $MASK3 -sub $(cat $threshold | sed 's/\s.*$//') -bin $MASK3_THRESH"
-CMD_THRESH_MASK_4="fslmaths $MASK4 -sub $(cat $threshold | sed 's/\s.*$//') -bin $MASK4_THRESH"
-CMD_THRESH_MASK_5="fslmaths $MASK5 -sub $(cat $threshold | sed 's/\s.*$//') -bin $MASK5_THRESH"
-CMD_ADD_ALL_MASKS="fslmaths $MASK1_THRESH -add $MASK2_THRESH -add $MASK3_THRESH -add $MASK4_THRESH -add $MASK5_THRESH -bin $SEGMENTATION_PVS"
-CMD_EXCLUDE_WMH="fslmaths $SEGMENTATION_PVS -sub $SEGMENTATION_WMH -thr 0 -bin $SEGMENTATION_PVS"
+# Thresholds all regional maps at the robust minimum of $MASK1 and removes WMH in one pass; writes
+# ${SEGMENTATION_PREFIX}_desc-pvs_mask.nii.gz, _desc-pvs_desc-{bg,cso,midbrain}_mask.nii.gz and _desc-pvs_dseg.nii.gz
+CMD_SEGMENT="python $CODE_DIR/pipelines/pvs/pvs_engine.py segment --bg $MASK1 $MASK4 --cso $MASK2 $MASK5 --midbrain $MASK3 -e $SEGMENTATION_WMH -o $SEGMENTATION_PREFIX"
 CMD_SEGMENTATION_TO_MNI="antsApplyTransforms -d 3 -i $SEGMENTATION_PVS -r $MNI_TEMPLATE -t $T1_TO_MNI_WARP -o $SEGMENTATION_PVS_MNI"
 
 # Execute
-$singularity_fsl /bin/bash -c "$CMD_THRESH_MASK_1; $CMD_THRESH_MASK_2; $CMD_THRESH_MASK_3; $CMD_THRESH_MASK_4; $CMD_THRESH_MASK_5; $CMD_ADD_ALL_MASKS; $CMD_EXCLUDE_WMH"
-rm $threshold
+$singularity_miniconda $CMD_SEGMENT
 $singularity_mrtrix /bin/bash -c "$CMD_SEGMENTATION_TO_MNI"
 
-$singularity_fsl /bin/bash -c "$(echo fslstats $SEGMENTATION_PVS -V) > $PVS_vol"
-[ ! -f $SEGMENTATION_PVS ] && echo "na na" > $PVS_vol
-
-$singularity_fsl /bin/bash -c "$(echo cluster --in=$SEGMENTATION_PVS --thresh=1) > $PVS_count"
-echo $(cat $PVS_count | head -2 | tail -1 | cut -c1-4) > $PVS_count
-[ ! -f $SEGMENTATION_PVS ] && echo "na na" > $PVS_count
-
+# PVS counts, volumes, lengths and orientations of all subjects are computed on group level (pvs_rorpo_summary.sh)
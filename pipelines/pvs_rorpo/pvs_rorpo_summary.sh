@@ -1,7 +1,7 @@
 #!/usr/bin/env bash
 
 ###################################################################################################################
-# Simple data summary of the pvs count and volume. Please run this after pvs_postproc.sh
+# Cohort summary of PVS count, volume, length and orientation per region. Please run this after pvs_postproc.sh
 #                                                                                                                 
 # Pipeline specific dependencies:                                                                                 
 #   [pipelines which need to be run first]                                                                        
@@ -9,40 +9,39 @@
 #       - wmh     
 #       - pvs_postproc                                                                                              
 #   [container]                                                                                                   
-#       - fsl 
-#       - mrtrix 
+#       - miniconda-csi
+#   [code]
+#       - pvs/pvs_engine.py
 #                                                                           
 ###################################################################################################################
 # Get verbose outputs
 set -x
 ulimit -c 0
 
+# Pipeline-specific environment
+##################################
+# Singularity container version and command
+container_miniconda=miniconda-csi
+singularity_miniconda="singularity run --cleanenv --userns \
+    -B $PROJ_DIR \
+    -B $(readlink -f $ENV_DIR) \
+    $ENV_DIR/$container_miniconda" 
+
+# Use the node's persistent container instances (utils/container_instances.sh) when run via 02_pipelines_batch.sh
+[ -n "$CONTAINER_RUN" ] && singularity_miniconda="$CONTAINER_RUN $container_miniconda"
+
 # Set output directories
 DERIVATIVE_dir=$DATA_DIR/$PIPELINE/derivatives
 [ ! -d $DERIVATIVE_dir ] && mkdir -p $DERIVATIVE_dir
 
-echo "subject pvs_count pvs_volume" > $DERIVATIVE_dir/pvs_rorpo_summary.csv
-
-for sub in $sublist; do  
-
-    # Set subject-specific output directories
-    OUT_DIR=$DATA_DIR/$PIPELINE/$sub/ses-${SESSION}/anat/
-    [ ! -d $OUT_DIR ] && mkdir -p $OUT_DIR
-    export TMP_DIR=$SCRATCH_DIR/$sub/tmp/;   [ ! -d $TMP_DIR ] && mkdir -p $TMP_DIR
-    TMP_IN=$TMP_DIR/input;                 [ ! -d $TMP_IN ] && mkdir -p $TMP_IN
-    TMP_OUT=$TMP_DIR/output;               [ ! -d $TMP_OUT ] && mkdir -p $TMP_OUT
-
-
-    ###################################################################################################################
-    # Pipeline execution
-    ###################################################################################################################
-
-    if [ -f $DERIVATIVE_dir/${sub}_ses-1_pvscount.csv ]; then 
-
-        echo $sub | tr '\n' ' ' >> $DERIVATIVE_dir/pvs_rorpo_summary.csv
-        cat $DERIVATIVE_dir/${sub}_ses-1_pvscount.csv | awk '{print $1}' | tr '\n' ' ' >> $DERIVATIVE_dir/pvs_rorpo_summary.csv
-        cat $DERIVATIVE_dir/${sub}_ses-1_pvsvolume.csv | awk '{print $2}' >> $DERIVATIVE_dir/pvs_rorpo_summary.csv 
+###################################################################################################################
+# Pipeline execution
+###################################################################################################################
 
-    fi
-    
-done
\ No newline at end of file
+# Connected components (26-connectivity) of the PVS segmentations of all subjects in parallel; writes one row per
+# subject to pvs_rorpo_summary.csv and one row per PVS to pvs_rorpo_summary_pvs.csv
+$singularity_miniconda python $CODE_DIR/pipelines/pvs/pvs_engine.py quantify \
+    -s $sublist \
+    -p "$DATA_DIR/$PIPELINE/{sub}/ses-${SESSION}/Segmentation/PVS/{sub}_ses-1_space-T1_desc-pvs_dseg.nii.gz" \
+    -o $DERIVATIVE_dir/pvs_rorpo_summary \
+    -n $SLURM_CPUS_PER_TASK
@@ -0,0 +1,233 @@
+# Permutation shards of MRtrix3 permutation tests (mrclusterstats, fixelcfestats, connectomestats)
+#
+# plan:  draws the permutations of the whole test once from a fixed seed (unique, without the default labelling) and
+#        writes the columns of one shard to <shard_dir>/permutations.txt (subjects x permutations, 0-based, as read by
+#        -permutations). Every array task draws the same permutations, so shards never overlap and need no shared file.
+#        The default labelling is the first column of every shard, as MRtrix3 counts it into the null distribution.
+# merge: concatenates the null distributions (null_dist*.txt) of all shards, dropping the repeated default labelling
+#        of all but the first shard, and computes the FWE-corrected p-values (fwe_1mpvalue) of the enhanced statistic
+#        as MRtrix3 does: fraction of the null distribution below or equal to the statistic. Null distribution and
+#        p-values are identical to those of a single run with all permutations of the plan. All other outputs of the
+#        first shard (betas, test statistics, enhanced statistic, fixel directory files) are copied; uncorrected
+#        p-values depend on the permutations of a shard and are not copied.
+#
+# Shard outputs are <shards>/shard-<k>/<prefix>*, merged outputs <output><file> (e.g. output prefix fd_stats/fd_ or
+# fixel directory stats_fd/)
+#
+# execute e.g. via
+# python permutation_shards.py plan -f files.txt -n 5000 -k 8 --shard 3 -o shards/fd/shard-3
+# python permutation_shards.py merge -s shards/fd -p fd_ -e tfce -k 8 -o fd_stats/fd_
+# with a python environment containing numpy
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import os
+import re
+import shutil
+import numpy as np
+
+SEED = 2016
+ENHANCED = ("tfce", "cfe", "enhanced")
+# Outputs depending on the permutations of a shard
+PERMUTATION_OUTPUTS = ("null_", "fwe_", "uncorrected_", "permutations")
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Split MRtrix3 permutation tests into seeded shards and merge their null distributions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan = subparsers.add_parser(
+        'plan', formatter_class=RawTextHelpFormatter,
+        help='write the permutations of one shard')
+    plan.add_argument(
+        '-f', '--files', required=True,
+        help='[required]\n input file list of the test (one subject per line), e.g. files.txt')
+    plan.add_argument(
+        '-n', '--nshuffles', type=int, default=5000,
+        help='[optional]\n permutations of the whole test including the default labelling; default 5000')
+    plan.add_argument(
+        '-k', '--shards', type=int, required=True,
+        help='[required]\n number of shards')
+    plan.add_argument(
+        '--shard', type=int, required=True,
+        help='[required]\n shard index, 0 .. shards - 1 (SLURM_ARRAY_TASK_ID)')
+    plan.add_argument(
+        '--seed', type=int, default=SEED,
+        help=f'[optional]\n seed of the permutations; default {SEED}')
+    plan.add_argument(
+        '-o', '--shard-dir', required=True,
+        help='[required]\n shard directory, <shard_dir>/permutations.txt is written')
+
+    merge = subparsers.add_parser(
+        'merge', formatter_class=RawTextHelpFormatter,
+        help='merge null distributions of all shards and compute FWE-corrected p-values')
+    merge.add_argument(
+        '-s', '--shards-dir', required=True,
+        help='[required]\n directory with shard-<k>/ of all shards')
+    merge.add_argument(
+        '-p', '--prefix', default='',
+        help='[optional]\n output prefix of the test within the shard directories, e.g. fd_; default none')
+    merge.add_argument(
+        '-e', '--enhanced', required=True, choices=ENHANCED,
+        help='[required]\n enhanced statistic the null distribution refers to: tfce (mrclusterstats), cfe (fixelcfestats)\n or enhanced (connectomestats)')
+    merge.add_argument(
+        '-k', '--shards', type=int, required=True,
+        help='[required]\n number of shards; all of them must be complete')
+    merge.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output prefix, e.g. fd_stats/fd_ or stats_fd/')
+    return parser
+
+
+########
+# Plan #
+########
+
+def permutations(n_subjects, nshuffles, seed):
+    """nshuffles - 1 unique permutations (nshuffles - 1 x subjects) without the default labelling."""
+
+    n_possible = np.prod(np.arange(1, n_subjects + 1, dtype=float))
+    if nshuffles > n_possible:
+        raise SystemExit(f"{nshuffles} permutations requested, but only {n_possible:.0f} exist for {n_subjects} subjects")
+
+    rng = np.random.default_rng(seed)
+    default = np.arange(n_subjects)
+    seen, drawn = {default.tobytes()}, []
+    while len(drawn) < nshuffles - 1:
+        for permutation in rng.permuted(np.tile(default, (nshuffles - 1 - len(drawn), 1)), axis=1):
+            if permutation.tobytes() not in seen:
+                seen.add(permutation.tobytes())
+                drawn.append(permutation)
+    return np.array(drawn, dtype=np.int64).reshape(-1, n_subjects)
+
+
+def plan(opts):
+
+    if not 0 <= opts.shard < opts.shards:
+        raise SystemExit(f"Shard {opts.shard} not in 0 .. {opts.shards - 1}")
+    n_subjects = len([line for line in Path(opts.files).read_text().splitlines() if line.strip()])
+
+    shard = np.array_split(permutations(n_subjects, opts.nshuffles, opts.seed), opts.shards)[opts.shard]
+    shard = np.vstack([np.arange(n_subjects), shard])
+
+    shard_dir = Path(opts.shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    output = shard_dir / "permutations.txt"
+    tmp = output.with_name(".tmp_" + output.name)
+    np.savetxt(tmp, shard.T, fmt="%d")
+    os.replace(tmp, output)
+    print(f"{len(shard)} permutations of {n_subjects} subjects (shard {opts.shard} of {opts.shards}) written to {output}")
+
+
+#########
+# Merge #
+#########
+
+def read_values(path):
+    """Header and values of a .mif image (flat, in file order) or delimiter and values of a text matrix."""
+
+    if path.suffix != ".mif":
+        lines = [line for line in path.read_text().splitlines() if not line.startswith("#")]
+        delimiter = "," if any("," in line for line in lines) else None
+        return delimiter, np.loadtxt(path, delimiter=delimiter, ndmin=2)
+
+    raw = path.read_bytes()
+    end = raw.index(b"\nEND\n") + len(b"\nEND\n")
+    header = raw[:end].decode().splitlines()
+    keys = dict(line.split(": ", 1) for line in header[1:-1] if ": " in line)
+    file_entry = keys.get("file", "").split()
+    if len(file_entry) != 2 or file_entry[0] != ".":
+        raise SystemExit(f"{path}: only single file .mif images are supported")
+    datatype = keys["datatype"]
+    dtype = np.dtype(("<" if datatype.endswith("LE") else ">") + {"Float32": "f4", "Float64": "f8"}[datatype[:-2]])
+    return header, np.frombuffer(raw, dtype=dtype, offset=int(file_entry[1]))
+
+
+def write_values(path, header, values):
+    """Values in the format and layout of the image or matrix the header was read from."""
+
+    tmp = path.with_name(".tmp_" + path.name)
+    if path.suffix != ".mif":
+        np.savetxt(tmp, values, delimiter=header or " ", fmt="%.6g")
+    else:
+        lines = [line for line in header[:-1] if not line.startswith(("file: ", "datatype: ", "scaling: "))]
+        text = "\n".join(lines + ["datatype: Float32LE"]) + "\n"
+        # Data starts after the header, padded to 16 bytes; room for up to 12 digits of the offset itself
+        offset = -(-(len(text) + len("file: . \nEND\n") + 12) // 16) * 16
+        text += f"file: . {offset}\nEND\n"
+        with open(tmp, "wb") as f:
+            f.write(text.encode().ljust(offset, b"\0"))
+            f.write(values.astype("<f4").tobytes())
+    os.replace(tmp, path)
+
+
+def fwe_1mpvalue(statistic, null):
+    """1 - FWE-corrected p-value as MRtrix3: fraction of null maxima <= statistic, 0 for statistic <= 0."""
+
+    ordered = np.sort(null)
+    return np.where(statistic > 0, np.searchsorted(ordered, statistic, side="right") / len(ordered), 0)
+
+
+def merge(opts):
+
+    shards = [Path(opts.shards_dir) / f"shard-{k}" for k in range(opts.shards)]
+    incomplete = [shard.name for shard in shards if not list(shard.glob(f"{opts.prefix}null_dist*.txt"))]
+    if incomplete:
+        raise SystemExit(f"No null distribution in {' '.join(incomplete)} of {opts.shards_dir}; rerun these shards")
+
+    output = Path(opts.output)
+    out_dir = output if opts.output.endswith("/") else output.parent
+    out_prefix = "" if opts.output.endswith("/") else output.name
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Outputs not depending on the permutations are identical in all shards
+    for path in sorted(shards[0].glob(f"{opts.prefix}*")):
+        name = path.name[len(opts.prefix):]
+        if path.is_file() and not name.startswith(PERMUTATION_OUTPUTS):
+            shutil.copyfile(path, out_dir / (out_prefix + name))
+
+    # One enhanced statistic per hypothesis, e.g. tfce.mif or tfce_t1.mif, tfce_t2.mif, ...
+    pattern = re.compile(rf"{re.escape(opts.prefix)}{opts.enhanced}(_[^.]*)?\.(mif|csv|txt)$")
+    enhanced = sorted(path for path in shards[0].iterdir() if pattern.match(path.name))
+    if not enhanced:
+        raise SystemExit(f"No {opts.enhanced} statistic in {shards[0]}")
+
+    for h, path in enumerate(enhanced):
+        postfix = pattern.match(path.name).group(1) or ""
+        name = f"null_dist{postfix}.txt" if (shards[0] / f"{opts.prefix}null_dist{postfix}.txt").exists() else "null_dist.txt"
+
+        # Default labelling is the first permutation of every shard and counted once
+        nulls = []
+        for k, shard in enumerate(shards):
+            null = np.loadtxt(shard / f"{opts.prefix}{name}", ndmin=2)
+            null = null.T if null.shape[0] == 1 else null
+            nulls.append(null[:, min(h, null.shape[1] - 1)][int(k > 0):])
+        null = np.concatenate(nulls)
+        np.savetxt(out_dir / f"{out_prefix}null_dist{postfix}.txt", null[None], fmt="%.9g")
+
+        header, statistic = read_values(path)
+        write_values(out_dir / f"{out_prefix}fwe_1mpvalue{postfix}{path.suffix}", header,
+                     fwe_1mpvalue(statistic, null).reshape(statistic.shape))
+        print(f"{path.name}: null distribution of {len(null)} permutations from {len(shards)} shards")
+
+    print(f"Merged outputs written to {opts.output}")
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    if opts.command == "plan":
+        plan(opts)
+    elif opts.command == "merge":
+        merge(opts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env bash
+
+###################################################################################################################
+# Permutation tests of the statistics pipelines, sourced by statistics_cfe.sh, statistics_nbs.sh and              #
+# statistics_tfce_tbss.sh once singularity_mrtrix3 is defined                                                     #
+#                                                                                                                 #
+# Dependencies:                                                                                                   #
+#   [container]                                                                                                   #
+#       - miniconda-csi.sif                                                                                       #
+#   [code]                                                                                                        #
+#       - permutation_shards.py                                                                                   #
+#                                                                                                                 #
+# With PERM_SHARDS > 1 the NSHUFFLES permutations are split into seeded shards, one per array task                #
+# (PERM_STEP=shard), whose null distributions are merged into FWE-corrected p-values (PERM_STEP=merge)            #
+#                                                                                                                 #
+# Author: Marvin Petersen (m-petersen)                                                                            #
+###################################################################################################################
+
+container_miniconda=miniconda-csi
+singularity_miniconda="singularity run --cleanenv --no-home --userns \
+    -B $PROJ_DIR \
+    -B $(readlink -f $ENV_DIR) \
+    $ENV_DIR/$container_miniconda"
+
+NSHUFFLES=${NSHUFFLES:-5000}
+
+# Run a permutation test as one run or as shard / merge step of a sharded run
+# arg1 - output prefix or directory, arg2 - enhanced statistic, arg3 - file list, arg4... - command without output
+permutation_test() {
+
+    output=$1; enhanced=$2; files=$3; shift 3
+    shards_dir=$STATISTICS_DIR/shards/$(basename ${output%/*})
+    shard=${SLURM_ARRAY_TASK_ID:-0}
+
+    if [ "${PERM_SHARDS:-1}" -le 1 ]; then
+
+        $singularity_mrtrix3 "$@" $output -nshuffles $NSHUFFLES -force
+
+    elif [ "$PERM_STEP" == shard ]; then
+
+        $singularity_miniconda python $PIPELINE_DIR/permutation_shards.py plan \
+            -f $files -n $NSHUFFLES -k $PERM_SHARDS --shard $shard -o $shards_dir/shard-$shard
+        $singularity_mrtrix3 "$@" $shards_dir/shard-$shard/${output##*/} -permutations $shards_dir/shard-$shard/permutations.txt -force
+
+    elif [ "$PERM_STEP" == merge ]; then
+
+        $singularity_miniconda python $PIPELINE_DIR/permutation_shards.py merge \
+            -s $shards_dir -p "${output##*/}" -e $enhanced -k $PERM_SHARDS -o $output
+
+    fi
+}
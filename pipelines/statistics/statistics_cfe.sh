@@ -14,6 +14,9 @@ set -x
 #       - fba levels 1-4                                                                                          #
 #   [container]                                                                                                   #
 #       - mrtrix3-3.0.2.sif                                                                                       #
+#       - miniconda-csi.sif                                                                                       #
+#   [code]                                                                                                        #
+#       - permutation_test.sh (permutation tests with optional sharding, see there)                               #
 #                                                                                                                 #
 # Author: Marvin Petersen (m-petersen)                                                                            #
 ###################################################################################################################
@@ -35,6 +38,8 @@ singularity_mrtrix3="singularity run --cleanenv --userns \
     -B $SCRATCH_DIR:/tmp \
     $ENV_DIR/$container_mrtrix3" 
 
+source $PIPELINE_DIR/permutation_test.sh
+
 #########################
 # CFE
 #########################
@@ -60,12 +65,12 @@ CONTRAST_FDC=$STATISTICS_DIR/contrast_fdc.txt
 
 # Command
 #########################
-CMD_CFE_FD="fixelcfestats $FD_SMOOTH_DIR $FILES $DESIGN_MATRIX_FD $CONTRAST_FD $MATRIX_DIR $STATISTICS_DIR/stats_fd/ -force"
-CMD_CFE_LOG_FC="fixelcfestats $LOG_FC_SMOOTH_DIR $FILES $DESIGN_MATRIX_LOGFC $CONTRAST_LOGFC $MATRIX_DIR $STATISTICS_DIR/stats_log_fc/ -force"
-CMD_CFE_FDC="fixelcfestats $FDC_SMOOTH_DIR $FILES $DESIGN_MATRIX_FDC $CONTRAST_FDC $MATRIX_DIR $STATISTICS_DIR/stats_fdc/ -force"
+CMD_CFE_FD="fixelcfestats $FD_SMOOTH_DIR $FILES $DESIGN_MATRIX_FD $CONTRAST_FD $MATRIX_DIR"
+CMD_CFE_LOG_FC="fixelcfestats $LOG_FC_SMOOTH_DIR $FILES $DESIGN_MATRIX_LOGFC $CONTRAST_LOGFC $MATRIX_DIR"
+CMD_CFE_FDC="fixelcfestats $FDC_SMOOTH_DIR $FILES $DESIGN_MATRIX_FDC $CONTRAST_FDC $MATRIX_DIR"
 
 # Execution
 #########################
-$singularity_mrtrix3 $CMD_CFE_FD
-$singularity_mrtrix3 $CMD_CFE_LOG_FC
-$singularity_mrtrix3 $CMD_CFE_FDC
+permutation_test $STATISTICS_DIR/stats_fd/ cfe $FILES $CMD_CFE_FD
+permutation_test $STATISTICS_DIR/stats_log_fc/ cfe $FILES $CMD_CFE_LOG_FC
+permutation_test $STATISTICS_DIR/stats_fdc/ cfe $FILES $CMD_CFE_FDC
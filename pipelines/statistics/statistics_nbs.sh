@@ -15,6 +15,9 @@ set -x
 #       - functional connectomes: bidsify, fmriprep, xcpengine                                                    #
 #   [container]                                                                                                   #
 #       - mrtrix3-3.0.2.sif                                                                                       #
+#       - miniconda-csi.sif                                                                                       #
+#   [code]                                                                                                        #
+#       - permutation_test.sh (permutation tests with optional sharding, see there)                               #
 #                                                                                                                 #
 # Author: Marvin Petersen (m-petersen)                                                                            #
 ###################################################################################################################
@@ -36,6 +39,8 @@ singularity_mrtrix3="singularity run --cleanenv --userns \
     -B $SCRATCH_DIR:/tmp \
     $ENV_DIR/$container_mrtrix3" 
 
+source $PIPELINE_DIR/permutation_test.sh
+
 #########################
 # TFCE
 #########################
@@ -53,9 +58,9 @@ FILES=$STATISTICS_DIR/files.txt
 
 # Command
 #########################
-CMD_NBS="connectomestats $FILES tfnbs $DESIGN_MATRIX $CONTRAST $STATISTICS_DIR/output/ -force"
+CMD_NBS="connectomestats $FILES tfnbs $DESIGN_MATRIX $CONTRAST"
 
 
 # Execution
 #########################
-$singularity_mrtrix3 $CMD_NBS
+permutation_test $STATISTICS_DIR/output/ enhanced $FILES $CMD_NBS
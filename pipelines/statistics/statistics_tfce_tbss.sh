@@ -15,6 +15,11 @@
 #   [container]                                                                                                   #
 #       - mrtrix3-3.0.2.sif                                                                                       #
 #       - fsl-6.0.3.sif                                                                                           #
+#       - miniconda-csi.sif                                                                                       #
+#   [code]                                                                                                        #
+#       - permutation_test.sh (permutation tests with optional sharding, see there)                               #
+#                                                                                                                 #
+# With PERM_SHARDS > 1 significant voxels are visualized and counted in the merge step                            #
 #                                                                                                                 #
 # Author: Felix Naegele (felenae) & Marvin Petersen (m-petersen)                                                  #
 ###################################################################################################################
@@ -49,6 +54,8 @@ singularity_fsl="singularity run --cleanenv --userns \
     -B $(readlink -f $ENV_DIR) \
     $ENV_DIR/$container_fsl"
 
+source $PIPELINE_DIR/permutation_test.sh
+
 #########################
 # TFCE
 #########################
@@ -124,62 +131,65 @@ MASK=$DATA_DIR/tbss_mni/derivatives/sub-all/ses-1/dwi/sub-all_ses-1_space-MNI_de
 #########################
 
 # FBA TIV
-CMD_TFCE_LOG_FC="mrclusterstats -strong $FILES_LOG_FC $DESIGN_MATRIX_FBA_TIV $CONTRAST_MATRIX_FBA_TIV $MASK logfc_stats/logfc_ -force"
-CMD_TFCE_FDC="mrclusterstats -strong $FILES_FDC $DESIGN_MATRIX_FBA_TIV $CONTRAST_MATRIX_FBA_TIV $MASK fdc_stats/fdc_ -force"
+CMD_TFCE_LOG_FC="mrclusterstats -strong $FILES_LOG_FC $DESIGN_MATRIX_FBA_TIV $CONTRAST_MATRIX_FBA_TIV $MASK"
+CMD_TFCE_FDC="mrclusterstats -strong $FILES_FDC $DESIGN_MATRIX_FBA_TIV $CONTRAST_MATRIX_FBA_TIV $MASK"
 
 # FBA
-CMD_TFCE_FD="mrclusterstats -strong $FILES_FD $DESIGN_MATRIX_FBA $CONTRAST_MATRIX_FBA $MASK fd_stats/fd_ -force"
-CMD_TFCE_COMP="mrclusterstats -strong $FILES_COMP $DESIGN_MATRIX_FBA $CONTRAST_MATRIX_FBA $MASK complexity_stats/complexity_ -force"
+CMD_TFCE_FD="mrclusterstats -strong $FILES_FD $DESIGN_MATRIX_FBA $CONTRAST_MATRIX_FBA $MASK"
+CMD_TFCE_COMP="mrclusterstats -strong $FILES_COMP $DESIGN_MATRIX_FBA $CONTRAST_MATRIX_FBA $MASK"
 
 # DTI
-CMD_TFCE_FA="mrclusterstats -strong $FILES_FA $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK fa_stats/fa_ -force"
-CMD_TFCE_AD="mrclusterstats -strong $FILES_AD $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK ad_stats/ad_ -force"
-CMD_TFCE_MD="mrclusterstats -strong $FILES_MD $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK md_stats/md_ -force"
-CMD_TFCE_RD="mrclusterstats -strong $FILES_RD $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK rd_stats/rd_ -force"
-CMD_TFCE_FAt="mrclusterstats -strong $FILES_FAt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK fat_stats/fat_ -force"
-CMD_TFCE_ADt="mrclusterstats -strong $FILES_ADt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK adt_stats/adt_ -force"
-CMD_TFCE_MDt="mrclusterstats -strong $FILES_MDt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK mdt_stats/mdt_ -force"
-CMD_TFCE_RDt="mrclusterstats -strong $FILES_RDt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK rdt_stats/rdt_ -force"
-CMD_TFCE_FW="mrclusterstats -strong $FILES_FW $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK fw_stats/fw_ -force"
+CMD_TFCE_FA="mrclusterstats -strong $FILES_FA $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_AD="mrclusterstats -strong $FILES_AD $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_MD="mrclusterstats -strong $FILES_MD $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_RD="mrclusterstats -strong $FILES_RD $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_FAt="mrclusterstats -strong $FILES_FAt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_ADt="mrclusterstats -strong $FILES_ADt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_MDt="mrclusterstats -strong $FILES_MDt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_RDt="mrclusterstats -strong $FILES_RDt $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+CMD_TFCE_FW="mrclusterstats -strong $FILES_FW $DESIGN_MATRIX_DTI $CONTRAST_MATRIX_DTI $MASK"
+
+# Execution
+#########################
 
-# # Execution
-# #########################
+if [ "${PERM_SHARDS:-1}" -gt 1 ]; then
 
-# pushd $STATISTICS_DIR
+    if [ -f $DESIGN_MATRIX_DTI ]; then
 
-# if [ -f $DESIGN_MATRIX_DTI ]; then
+        permutation_test $STATISTICS_DIR/fa_stats/fa_ tfce $FILES_FA $CMD_TFCE_FA
+        permutation_test $STATISTICS_DIR/ad_stats/ad_ tfce $FILES_AD $CMD_TFCE_AD
+        permutation_test $STATISTICS_DIR/md_stats/md_ tfce $FILES_MD $CMD_TFCE_MD
+        permutation_test $STATISTICS_DIR/rd_stats/rd_ tfce $FILES_RD $CMD_TFCE_RD
+        permutation_test $STATISTICS_DIR/fat_stats/fat_ tfce $FILES_FAt $CMD_TFCE_FAt
+        permutation_test $STATISTICS_DIR/adt_stats/adt_ tfce $FILES_ADt $CMD_TFCE_ADt
+        permutation_test $STATISTICS_DIR/mdt_stats/mdt_ tfce $FILES_MDt $CMD_TFCE_MDt
+        permutation_test $STATISTICS_DIR/rdt_stats/rdt_ tfce $FILES_RDt $CMD_TFCE_RDt
+        permutation_test $STATISTICS_DIR/fw_stats/fw_ tfce $FILES_FW $CMD_TFCE_FW
 
-#     $singularity_mrtrix3 $CMD_TFCE_FA
-#     $singularity_mrtrix3 $CMD_TFCE_AD
-#     $singularity_mrtrix3 $CMD_TFCE_MD
-#     $singularity_mrtrix3 $CMD_TFCE_RD
-#     $singularity_mrtrix3 $CMD_TFCE_FAt
-#     $singularity_mrtrix3 $CMD_TFCE_ADt
-#     $singularity_mrtrix3 $CMD_TFCE_MDt
-#     $singularity_mrtrix3 $CMD_TFCE_RDt
-#     $singularity_mrtrix3 $CMD_TFCE_FW
+    fi
 
-# fi
+    if [ -f $DESIGN_MATRIX_FBA ]; then
 
-# if [ -f $DESIGN_MATRIX_FBA ]; then
+        permutation_test $STATISTICS_DIR/fd_stats/fd_ tfce $FILES_FD $CMD_TFCE_FD
+        permutation_test $STATISTICS_DIR/complexity_stats/complexity_ tfce $FILES_COMP $CMD_TFCE_COMP
 
-#     $singularity_mrtrix3 $CMD_TFCE_FD
-#     $singularity_mrtrix3 $CMD_TFCE_COMP
+    fi
 
-# fi
+    if [ -f $DESIGN_MATRIX_FBA_TIV ]; then
 
-# if [ -f $DESIGN_MATRIX_FBA_TIV ]; then
+        permutation_test $STATISTICS_DIR/logfc_stats/logfc_ tfce $FILES_LOG_FC $CMD_TFCE_LOG_FC
+        permutation_test $STATISTICS_DIR/fdc_stats/fdc_ tfce $FILES_FDC $CMD_TFCE_FDC
+    fi
 
-#     $singularity_mrtrix3 $CMD_TFCE_LOG_FC
-#     $singularity_mrtrix3 $CMD_TFCE_FDC
-# fi
-
-# popd
+fi
 
 ############################################################ 
 # Visualize and calculate percentage of significant voxels #
 ############################################################
 
+# Shards only run their part of the permutations
+[ "$PERM_STEP" == shard ] && return 0
+
 pushd $STATISTICS_DIR
 
 # Mean FA
@@ -0,0 +1,155 @@
+# Group QC statistics of TBSS skeleton and ROI means for all modalities in one pass
+# Reads the merged CSVs once and computes robust summary statistics of every column ({prefix}_{region}_mean_{mod},
+# region = skeleton or a JHU ROI) at once: median, MAD and robust z-scores z = (x - median) / (1.4826 * MAD).
+# Values with |z| above the threshold are flagged as outliers, empty values as missing. Histogram and boxplot of
+# the skeleton mean of each modality are rendered in parallel (formerly one stats.py run per modality).
+#
+# Outputs (with -o <prefix>):
+#   <prefix>_desc-groupqc_summary.csv     statistics per column
+#   <prefix>_desc-groupqc_outliers.tsv    one row per flagged value: sub_id, modality, region, value, z, reason
+#   <prefix>_desc-groupqc_flagged.txt     subjects with a skeleton level outlier, a missing skeleton mean or at least
+#                                         --min-roi-outliers ROI outliers; one per line, e.g. as subject_file
+#                                         (re-queue) or exclude_file of a run spec (utils/submit_runs.py)
+#   <prefix>_desc-mean<mod>_histogram.png, <prefix>_desc-mean<mod>_boxplot.png
+#
+# execute e.g. via
+# python group_qc.py -c sub-all_..._desc-ROIs_means.csv -o <DER_DIR>/sub-all_ses-1_space-MNI_desc-skeleton [-n 8]
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+import re
+import numpy as np
+import pandas as pd
+
+COLUMN = re.compile(r"^(?P<prefix>tbss\w*?)_(?P<region>.+)_mean_(?P<mod>[^_]+)$")
+MAD_SCALE = 1.4826
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Robust group statistics, outlier flags and figures of skeleton and ROI means of all modalities')
+    parser.add_argument(
+        '-c', '--csv', required=True, nargs='+',
+        help='[required]\n merged CSVs with sub_id and {prefix}_{region}_mean_{mod} columns')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output prefix, e.g. <DER_DIR>/sub-all_ses-1_space-MNI_desc-skeleton')
+    parser.add_argument(
+        '-z', '--threshold', type=float, default=3.5,
+        help='[optional]\n |robust z| above which values are flagged; default 3.5')
+    parser.add_argument(
+        '--min-roi-outliers', type=int, default=5,
+        help='[optional]\n ROI outliers (any modality) for a subject to be flagged; default 5')
+    parser.add_argument(
+        '-n', '--n-procs', type=int, default=1,
+        help='[optional]\n processes rendering figures; default 1')
+    parser.add_argument(
+        '--no-figures', action='store_true',
+        help='[optional]\n only write statistics and outlier lists')
+    return parser
+
+
+def read_csvs(csvs):
+    """Merged CSVs joined on sub_id; columns appearing in several CSVs are taken from the first."""
+
+    frames = [pd.read_csv(csv).set_index("sub_id") for csv in csvs]
+    return reduce(lambda left, right: left.join(right[right.columns.difference(left.columns)], how="outer"), frames)
+
+
+def robust_z(values):
+    """Robust z-scores of all columns; NaN for columns without spread."""
+
+    median = values.median()
+    mad = (values - median).abs().median() * MAD_SCALE
+    return (values - median) / mad.replace(0, np.nan), median, mad
+
+
+def figures(job):
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    mod, values, flagged, histfig, boxfig = job
+
+    hist = sns.displot(values, kde=True)
+    hist.savefig(histfig)
+    plt.close("all")
+
+    fig, ax = plt.subplots()
+    sns.boxplot(data=values, ax=ax)
+    # Outliers of this modality in red
+    ax.scatter(np.zeros(len(flagged)), flagged, color="red", zorder=3, s=12)
+    fig.savefig(boxfig)
+    plt.close("all")
+    return mod
+
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    df = read_csvs(opts.csv)
+    columns = {column: COLUMN.match(column) for column in df.columns}
+    columns = {column: match for column, match in columns.items() if match}
+    if not columns:
+        raise SystemExit(f"No {{prefix}}_{{region}}_mean_{{mod}} columns in {' '.join(opts.csv)}")
+
+    values = df[list(columns)].apply(pd.to_numeric, errors="coerce")
+    z, median, mad = robust_z(values)
+    outlier = z.abs() > opts.threshold
+    missing = values.isna()
+
+    # Summary per column
+    summary = pd.DataFrame({
+        "modality": [match["mod"] for match in columns.values()],
+        "region": [match["region"] for match in columns.values()],
+        "n": values.count(), "n_missing": missing.sum(),
+        "median": median, "mad": mad, "mean": values.mean(), "std": values.std(),
+        "min": values.min(), "max": values.max(),
+        "n_outliers": outlier.sum()}, index=list(columns))
+    summary.index.name = "column"
+    summary.to_csv(f"{opts.output}_desc-groupqc_summary.csv")
+
+    # Long list of flagged values
+    flags = (outlier | missing).stack()
+    flags = flags[flags].index
+    rows = pd.DataFrame({
+        "sub_id": flags.get_level_values(0),
+        "modality": [columns[column]["mod"] for column in flags.get_level_values(1)],
+        "region": [columns[column]["region"] for column in flags.get_level_values(1)],
+        "value": [values.at[sub, column] for sub, column in flags],
+        "z": [z.at[sub, column] for sub, column in flags]})
+    rows["reason"] = np.where(rows["value"].isna(), "missing", "outlier")
+    rows.sort_values(["sub_id", "region", "modality"]).to_csv(
+        f"{opts.output}_desc-groupqc_outliers.tsv", sep="\t", index=False, float_format="%.6g")
+
+    # Subjects to re-queue or exclude
+    skeleton = [column for column, match in columns.items() if match["region"] == "skeleton"]
+    roi = [column for column, match in columns.items() if match["region"] != "skeleton"]
+    flagged = (outlier[skeleton] | missing[skeleton]).any(axis=1) | (outlier[roi].sum(axis=1) >= opts.min_roi_outliers)
+    flagged_subjects = sorted(flagged[flagged].index)
+    with open(f"{opts.output}_desc-groupqc_flagged.txt", "w") as f:
+        f.writelines(f"{sub}\n" for sub in flagged_subjects)
+
+    print(f"{len(values)} subjects, {len(columns)} columns: {int(outlier.values.sum())} outliers (|z| > {opts.threshold}), "
+          f"{int(missing.values.sum())} missing values, {len(flagged_subjects)} subjects flagged")
+
+    if opts.no_figures:
+        return
+
+    # Figures of skeleton means, one job per modality
+    jobs = [(columns[column]["mod"], values[column].dropna(), values.loc[outlier[column], column],
+             f"{opts.output}_desc-mean{columns[column]['mod']}_histogram.png",
+             f"{opts.output}_desc-mean{columns[column]['mod']}_boxplot.png") for column in skeleton]
+    with ProcessPoolExecutor(max_workers=opts.n_procs) as pool:
+        for mod in pool.map(figures, jobs):
+            print(f"Figures of {mod} written")
+
+
+if __name__ == "__main__":
+    main()
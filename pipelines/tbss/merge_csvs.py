@@ -0,0 +1,106 @@
+# Incremental merge of subject-level TBSS CSVs (header + one row each) into the group CSV
+# Rows of subjects whose CSV did not change since the last merge are taken over from the existing merged CSV;
+# only new or changed subject CSVs are read. Subject CSV versions are kept in <merged csv>_manifest.json.
+#
+# execute e.g. via
+# python merge_csvs.py -s <subjects.txt> -t '<TBSS_DIR>/{sub}/ses-1/dwi/{sub}_ses-1_space-MNI_desc-skeleton_label-JHU_desc-ROIs_means.csv' \
+#     -o <sub-all_..._desc-ROIs_means.csv>
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import os
+from merge_skeletons import file_version, same_version, read_manifest, write_manifest
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Merge subject CSVs into a group CSV, re-reading only new or changed subjects')
+    parser.add_argument(
+        '-s', '--subjects', required=True,
+        help='[required]\n text file with one subject id per line defining the row order (e.g. <sidecar>_subjects.txt)')
+    parser.add_argument(
+        '-t', '--template', required=True,
+        help='[required]\n path template of subject CSVs containing {sub}')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n merged CSV')
+    parser.add_argument(
+        '--hash', action='store_true',
+        help='[optional]\n identify subject CSV versions by SHA-1 of their content instead of size and mtime')
+    return parser
+
+
+def read_rows(csv):
+    """Return header and rows (keyed by subject id) of a CSV with sub_id in the first column."""
+
+    with open(csv) as f:
+        lines = f.read().splitlines()
+    return lines[0], {line.split(",", 1)[0]: line for line in lines[1:] if line}
+
+
+def read_subject(csv):
+    """Return header and the (last) data row of a subject CSV."""
+
+    with open(csv) as f:
+        lines = [line for line in f.read().splitlines() if line]
+    return lines[0], lines[-1]
+
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    with open(opts.subjects) as f:
+        subjects = [line.strip() for line in f if line.strip()]
+
+    output = Path(opts.output)
+    manifest_file = output.with_name(output.stem + "_manifest.json")
+    manifest = read_manifest(manifest_file) if output.exists() else None
+
+    # Subject CSVs and their versions
+    csvs = {sub: opts.template.format(sub=sub) for sub in subjects}
+    versions = {sub: file_version(csv, opts.hash) for sub, csv in csvs.items() if Path(csv).exists()}
+
+    for sub in subjects:
+        if sub not in versions:
+            print(f"{csvs[sub]} not found. Skipping {sub} ...")
+
+    # Reuse rows of unchanged subjects
+    header, rows = None, {}
+    if manifest is not None:
+        header, merged_rows = read_rows(output)
+        for sub, version in versions.items():
+            if sub in manifest["csvs"] and same_version(manifest["csvs"][sub], version) and sub in merged_rows:
+                rows[sub] = merged_rows[sub]
+
+    print(f"Reading {len(versions) - len(rows)} new or changed subject CSVs ...")
+    fresh = {sub: read_subject(csvs[sub]) for sub in versions if sub not in rows}
+
+    # Changed columns invalidate all reused rows
+    if header is not None and {sub_header for sub_header, _ in fresh.values()} - {header}:
+        print("Columns of subject CSVs changed. Re-reading all subject CSVs ...")
+        rows = {}
+        fresh = {sub: read_subject(csvs[sub]) for sub in versions}
+
+    for sub, (sub_header, row) in fresh.items():
+        header = sub_header
+        rows[sub] = row
+
+    if header is None:
+        raise SystemExit("No subject CSVs found")
+
+    tmp = output.with_name(".tmp_" + output.name)
+    with open(tmp, "w") as f:
+        f.write(header + "\n")
+        for sub in subjects:
+            if sub in rows:
+                f.write(rows[sub] + "\n")
+    os.replace(tmp, output)
+
+    write_manifest(manifest_file, {"csvs": {sub: versions[sub] for sub in subjects if sub in rows}})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+# Streaming merge of subject skeletons into one 4D image (replaces batched `fslmerge -t`)
+# Volumes are written one subject at a time, either into a memory-mapped uncompressed .nii or
+# through a gzip stream for .nii.gz, so memory stays at one volume irrespective of cohort size.
+# With --incremental an existing merge is updated instead of being rebuilt: a .nii in place, a .nii.gz by streaming
+# its unchanged volumes into the new file. Merges without new or changed subjects are not touched.
+# Optionally a compact sidecar with skeleton voxels only (subjects x skeleton voxels, float32)
+# and the flat voxel index of the skeleton mask is written alongside.
+#
+# execute e.g. via
+# python merge_skeletons.py -l <mergelist.txt> -o <sub-all_..._desc-skeleton_FW.nii.gz> \
+#     -m <sub-all_..._desc-skeleton_desc-meanFA_mask.nii.gz> --sidecar <sub-all_..._desc-skeleton_FW>
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import gzip
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import nibabel as nib
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Merge 3D skeletons into a 4D image one volume at a time')
+    parser.add_argument(
+        '-l', '--list', required=True,
+        help='[required]\n text file with one skeleton path per line (merge order)')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n 4D output; .nii is written through a memory map, .nii.gz as gzip stream')
+    parser.add_argument(
+        '-m', '--mask', required=False,
+        help='[optional]\n skeleton mask defining the voxels of the sidecar; required together with --sidecar')
+    parser.add_argument(
+        '--sidecar', required=False,
+        help='[optional]\n output prefix of skeleton-voxel sidecar'
+             '\n writes <prefix>_skeletonvoxels.npy (subjects x voxels), <prefix>_voxelindex.npy and <prefix>_subjects.txt')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='[optional]\n update a previous merge: append new subjects and rewrite volumes whose input changed, in place'
+             '\n for .nii, by copying unchanged volumes for .nii.gz; merged subjects and input versions are kept in'
+             '\n <output>_manifest.json')
+    parser.add_argument(
+        '--hash', action='store_true',
+        help='[optional]\n identify input versions by SHA-1 of their content instead of size and mtime')
+    return parser
+
+
+def merged_header(first_img, n_vols):
+    """4D float32 header derived from the first input volume."""
+
+    header = first_img.header.copy()
+    header.set_data_shape(first_img.shape[:3] + (n_vols,))
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    header["vox_offset"] = 352
+    zooms = first_img.header.get_zooms()[:3]
+    header.set_zooms(zooms + (1.0,))
+    return header
+
+
+def volumes(paths, shape):
+    """Yield one float32 volume per input path."""
+
+    for path in paths:
+        img = nib.load(path)
+        if img.shape[:3] != shape:
+            raise SystemExit(f"{path} has shape {img.shape}, expected {shape}")
+        yield path, np.asanyarray(img.dataobj, dtype=np.float32).reshape(shape)
+
+
+def header_bytes(header):
+    # NIfTI-1 single file: 348 byte header, 4 byte extension flag, data at vox_offset 352
+    return header.binaryblock + b"\x00" * 4
+
+
+def subject_id(path):
+    return Path(path).name.split("_")[0]
+
+
+###########################
+# Incremental merge state #
+###########################
+
+def file_version(path, content_hash=False):
+    """Size and mtime (and optionally SHA-1) identifying the version of an input file."""
+
+    stat = os.stat(path)
+    version = {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        version["sha1"] = sha1.hexdigest()
+    return version
+
+
+def same_version(old, new):
+    if "sha1" in old and "sha1" in new:
+        return old["sha1"] == new["sha1"]
+    return all(old.get(key) == new[key] for key in ("path", "size", "mtime_ns"))
+
+
+def manifest_path(output):
+    output = Path(output)
+    stem = output.name[:-len(".nii.gz")] if output.name.endswith(".nii.gz") else output.stem
+    return output.with_name(stem + "_manifest.json")
+
+
+def read_manifest(path):
+    if not Path(path).exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    tmp = Path(path).with_name(".tmp_" + Path(path).name)
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def plan_update(manifest, subjects, versions):
+    """Return merge order and positions to (re)write, or None if a full rebuild is necessary.
+
+    Subjects already merged keep their position; changed inputs are rewritten in place and new subjects are appended.
+    """
+
+    merged = [entry["sub"] for entry in manifest["volumes"]]
+
+    removed = set(merged) - set(subjects)
+    if removed:
+        print(f"{len(removed)} previously merged subjects are not in the merge list anymore. Rebuilding ...")
+        return None
+
+    order = merged + [sub for sub in subjects if sub not in set(merged)]
+    new_versions = dict(zip(subjects, versions))
+    to_write = [t for t, sub in enumerate(order)
+                if t >= len(merged) or not same_version(manifest["volumes"][t]["version"], new_versions[sub])]
+
+    return order, to_write
+
+
+def stream_compatible(output, first_img):
+    """Whether the volumes of a compressed merge can be copied as they are: float32 of the byte order of the
+    inputs' merge, unscaled, at offset 352."""
+
+    # Header as stored; loaded images report vox_offset 0
+    with gzip.open(output, "rb") as f:
+        header = nib.Nifti1Header.from_fileobj(f)
+    slope, inter = header.get_slope_inter()
+    return (header.get_data_dtype() == np.dtype(np.float32).newbyteorder(first_img.header.endianness)
+            and int(header["vox_offset"]) == 352 and slope in (None, 1) and inter in (None, 0))
+
+
+def resize_npy(path, rows, cols):
+    """Open a 2D .npy as writable memmap with `rows` rows, keeping existing rows (grown in place where possible)."""
+
+    path = Path(path)
+
+    if path.exists():
+        with open(path, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran, dtype = read_header(f)
+            offset = f.tell()
+
+        if len(shape) == 2 and shape[1] == cols and not fortran and dtype == np.float32:
+
+            header = io.BytesIO()
+            write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+            write_header(header, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows, cols)})
+
+            if header.tell() == offset:
+                with open(path, "r+b") as f:
+                    f.write(header.getvalue())
+                    f.truncate(offset + rows * cols * 4)
+                return np.lib.format.open_memmap(path, mode="r+")
+
+            # Header size changed; copy existing rows into a new array
+            old = np.load(path, mmap_mode="r")
+            tmp = path.with_name(".tmp_" + path.name)
+            new = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(rows, cols))
+            new[:min(rows, old.shape[0])] = old[:rows]
+            new.flush()
+            del old, new
+            os.replace(tmp, path)
+            return np.lib.format.open_memmap(path, mode="r+")
+
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(rows, cols))
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    with open(opts.list) as f:
+        paths = [line.strip() for line in f if line.strip()]
+
+    if not paths:
+        raise SystemExit(f"No skeletons listed in {opts.list}")
+
+    output = Path(opts.output)
+    compressed = output.name.endswith(".nii.gz")
+
+    first = nib.load(paths[0])
+    shape = first.shape[:3]
+    subjects = [subject_id(p) for p in paths]
+    path_of = dict(zip(subjects, paths))
+    versions = [file_version(p, opts.hash) for p in paths]
+    mask_version = file_version(opts.mask, opts.hash) if opts.mask else None
+
+    # Decide between incremental update and full merge
+    ##################################################
+
+    plan = None
+    manifest_file = manifest_path(output)
+
+    if opts.incremental and output.exists():
+        manifest = read_manifest(manifest_file)
+        if manifest is None:
+            print(f"No manifest found for {output}. Rebuilding ...")
+        elif manifest["shape"] != list(shape) or manifest.get("sidecar") != opts.sidecar \
+                or (mask_version is not None and not same_version(manifest.get("mask") or {}, mask_version)):
+            print(f"Image shape, skeleton mask or sidecar of {output} changed. Rebuilding ...")
+        elif compressed and not stream_compatible(output, first):
+            print(f"Data layout of {output} differs from a merge of the inputs. Rebuilding ...")
+        else:
+            plan = plan_update(manifest, subjects, versions)
+
+    if plan is None:
+        order, to_write = subjects, list(range(len(subjects)))
+    else:
+        order, to_write = plan
+        if not to_write:
+            print(f"{output} is up to date ({len(order)} volumes)")
+            return
+        print(f"Updating {output}: {len(to_write)} of {len(order)} volumes to (re)write ...")
+
+    header = merged_header(first, len(order))
+    write_paths = [path_of[order[t]] for t in to_write]
+
+    # Skeleton-voxel sidecar (memory-mapped .npy, filled row by row)
+    sidecar = index = None
+    if opts.sidecar:
+        if not opts.mask:
+            raise SystemExit("--sidecar requires --mask")
+        mask = np.asanyarray(nib.load(opts.mask).dataobj).reshape(shape)
+        index = np.flatnonzero(mask.ravel(order="F") > 0)
+        np.save(f"{opts.sidecar}_voxelindex.npy", index)
+        sidecar_file = f"{opts.sidecar}_skeletonvoxels.npy"
+        if plan is None:
+            sidecar = np.lib.format.open_memmap(sidecar_file, mode="w+", dtype=np.float32, shape=(len(order), index.size))
+        else:
+            sidecar = resize_npy(sidecar_file, len(order), index.size)
+        with open(f"{opts.sidecar}_subjects.txt", "w") as f:
+            f.write("\n".join(order) + "\n")
+
+    # Write volumes
+    ###############
+
+    tmp = output.with_name(".tmp_" + output.name)
+
+    if compressed:
+
+        dtype = "<f4" if header.endianness == "<" else ">f4"
+        # Volumes of the previous merge are streamed over unless rewritten
+        previous, n_previous = None, 0
+        if plan is not None:
+            previous, n_previous = gzip.open(output, "rb"), len(manifest["volumes"])
+            previous.seek(352)
+        volume_bytes = 4 * int(np.prod(shape))
+        rewrite = dict(zip(to_write, write_paths))
+
+        with gzip.open(tmp, "wb", compresslevel=1) as f:
+            f.write(header_bytes(header))
+            inputs = volumes(write_paths, shape)
+            for t in range(len(order)):
+                data = previous.read(volume_bytes) if t < n_previous else None
+                if t not in rewrite:
+                    f.write(data)
+                    continue
+                path, vol = next(inputs)
+                print(f"Merging {path} ...")
+                flat = vol.ravel(order="F")
+                f.write(flat.astype(dtype).tobytes())
+                if sidecar is not None:
+                    sidecar[t] = flat[index]
+        if previous is not None:
+            previous.close()
+
+    else:
+
+        # Full merges are written to a temporary file; incremental updates grow the existing image in place
+        target = tmp if plan is None else output
+        with open(target, "wb" if plan is None else "r+b") as f:
+            f.write(header_bytes(header))
+            f.truncate(352 + 4 * int(np.prod(shape)) * len(order))
+        merged = np.memmap(target, mode="r+", offset=352, order="F",
+                           dtype=np.dtype(np.float32).newbyteorder(header.endianness),
+                           shape=shape + (len(order),))
+        for t, (path, vol) in zip(to_write, volumes(write_paths, shape)):
+            print(f"Merging {path} ...")
+            merged[..., t] = vol
+            if sidecar is not None:
+                sidecar[t] = vol.ravel(order="F")[index]
+        merged.flush()
+        del merged
+
+    if plan is None or compressed:
+        os.replace(tmp, output)
+
+    if sidecar is not None:
+        sidecar.flush()
+
+    # Record which subject and file version went into each volume
+    version_of = dict(zip(subjects, versions))
+    write_manifest(manifest_file, {
+        "shape": list(shape),
+        "mask": mask_version,
+        "sidecar": opts.sidecar,
+        "volumes": [{"sub": sub, "version": version_of[sub]} for sub in order]})
+
+
+if __name__ == "__main__":
+    main()
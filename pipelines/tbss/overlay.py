@@ -1,14 +1,185 @@
+# Batch renderer of QC overlays of TBSS skeletons on their masked modality maps
+# Renders seven axial cuts (z = -37 ... 49 mm) of the skeleton (viridis) on the masked map (gray) for all given
+# subjects and modalities in one process. Every worker of the pool sets up one figure with its axes, images and
+# colorbar once and only updates their data per overlay. Overlays newer than both inputs are skipped (--force renders
+# them anyway). Besides the overlay PNG a thumbnail (<overlay>_thumb.png) is written for the HTML report (report.py).
+#
+# Inputs and outputs follow the tbss layout:
+#   <tbss_dir>/<sub>/ses-<ses>/dwi/<sub>_ses-<ses>_space-<space>_desc-eroded_desc-brain_<mod>.nii.gz  (background)
+#   <tbss_dir>/<sub>/ses-<ses>/dwi/<sub>_ses-<ses>_space-<space>_desc-skeleton_<mod>.nii.gz           (skeleton)
+#   <tbss_dir>/<sub>/ses-<ses>/dwi/<sub>_ses-<ses>_space-<space>_desc-skeleton_<mod>_overlay.png      (output)
+#
+# execute e.g. via
+# python overlay.py -d data/tbss_mni --session 1 --space MNI -s sub-001 sub-002 -m desc-DTINoNeg_FA FW [-n 8]
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from multiprocessing import Pool
+from pathlib import Path
 import os
-import sys
+import numpy as np
 import nibabel as nib
-import nilearn.plotting
-import matplotlib as plt
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+CUT_COORDS = (-37, -21, -7, 9, 22, 35, 49)
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Render QC overlays of skeletons on masked modality maps for many subjects and modalities')
+    parser.add_argument(
+        '-d', '--tbss-dir', required=True,
+        help='[required]\n tbss directory, e.g. data/tbss_mni')
+    parser.add_argument(
+        '--session', required=True,
+        help='[required]\n session, e.g. 1')
+    parser.add_argument(
+        '--space', required=True,
+        help='[required]\n space label of the skeletons, e.g. MNI or fodtemplate')
+    parser.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subjects (e.g. sub-001) or a file with one subject per line')
+    parser.add_argument(
+        '-m', '--modalities', required=True, nargs='+',
+        help='[required]\n modalities, e.g. desc-DTINoNeg_FA desc-FWcorrected_FA FW')
+    parser.add_argument(
+        '-n', '--n-procs', type=int, default=1,
+        help='[optional]\n rendering processes; default 1')
+    parser.add_argument(
+        '--width', type=float, default=1600,
+        help='[optional]\n width of overlays in pixels; default 1600')
+    parser.add_argument(
+        '--thumb-width', type=float, default=480,
+        help='[optional]\n width of thumbnails in pixels; default 480')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='[optional]\n render overlays even if they are newer than their inputs')
+    return parser
+
+
+class Renderer:
+    """One figure per process; axes, images and colorbar are created once and updated per overlay."""
+
+    def __init__(self, width, thumb_width):
+        self.fig, axes = plt.subplots(1, len(CUT_COORDS) + 1, figsize=(16, 2.6), facecolor="black",
+                                      gridspec_kw={"width_ratios": [1] * len(CUT_COORDS) + [0.08]})
+        self.axes, cax = axes[:-1], axes[-1]
+        self.dpi, self.thumb_dpi = width / 16, thumb_width / 16
+        self.backgrounds, self.skeletons, self.labels = [], [], []
+        empty = np.zeros((2, 2))
+        for ax, z in zip(self.axes, CUT_COORDS):
+            ax.set_axis_off()
+            self.backgrounds.append(ax.imshow(empty, cmap="gray", origin="lower", interpolation="nearest"))
+            self.skeletons.append(ax.imshow(np.ma.masked_all((2, 2)), cmap=plt.cm.viridis, origin="lower",
+                                            interpolation="nearest"))
+            self.labels.append(ax.set_title(f"z={z}", color="white", fontsize=9))
+        self.colorbar = self.fig.colorbar(self.skeletons[0], cax=cax)
+        self.colorbar.ax.tick_params(colors="white", labelsize=8)
+        self.fig.subplots_adjust(left=0.005, right=0.97, bottom=0.02, top=0.88, wspace=0.02)
+
+    def render(self, background_path, skeleton_path, overlay_path):
+
+        # RAS+ voxel order, so that the slices are axial and displayed alike whatever the orientation of the image
+        background_img = nib.as_closest_canonical(nib.load(background_path))
+        background = np.asanyarray(background_img.dataobj, dtype=np.float32)
+        skeleton = np.asanyarray(nib.as_closest_canonical(nib.load(skeleton_path)).dataobj, dtype=np.float32)
+
+        # Axial slice per cut coordinate (world mm -> voxel)
+        inverse = np.linalg.inv(background_img.affine)
+        slices = [int(np.clip(round((inverse @ [0, 0, z, 1])[2]), 0, background.shape[2] - 1)) for z in CUT_COORDS]
+
+        nonzero = background[background != 0]
+        bg_range = np.percentile(nonzero, (0.5, 99.5)) if nonzero.size else (0, 1)
+        skel_values = skeleton[skeleton != 0]
+        skel_range = (min(0, skel_values.min()), skel_values.max()) if skel_values.size else (0, 1)
+
+        for background_artist, skeleton_artist, k in zip(self.backgrounds, self.skeletons, slices):
+            extent = (0, background.shape[0], 0, background.shape[1])
+            background_artist.set_data(background[:, :, k].T)
+            background_artist.set_clim(*bg_range)
+            background_artist.set_extent(extent)
+            skeleton_artist.set_data(np.ma.masked_equal(skeleton[:, :, k].T, 0))
+            skeleton_artist.set_clim(*skel_range)
+            skeleton_artist.set_extent(extent)
+            skeleton_artist.axes.set_xlim(extent[:2])
+            skeleton_artist.axes.set_ylim(extent[2:])
+        self.colorbar.update_normal(self.skeletons[0])
+
+        # Write under temporary names, so that interrupted renderings are not taken as up to date
+        thumb_path = thumbnail(overlay_path)
+        for path, dpi in ((overlay_path, self.dpi), (thumb_path, self.thumb_dpi)):
+            tmp = path.with_name(".tmp_" + path.name)
+            self.fig.savefig(tmp, dpi=dpi, facecolor="black", format="png")
+            os.replace(tmp, path)
+
+
+def thumbnail(overlay_path):
+    return overlay_path.with_name(overlay_path.stem + "_thumb.png")
+
+
+def up_to_date(inputs, overlay_path):
+    outputs = [overlay_path, thumbnail(overlay_path)]
+    if not all(path.exists() for path in outputs):
+        return False
+    return min(path.stat().st_mtime for path in outputs) >= max(path.stat().st_mtime for path in inputs)
+
+
+renderer = None
+
+
+def init_worker(width, thumb_width):
+    global renderer
+    renderer = Renderer(width, thumb_width)
+
+
+def render(job):
+    try:
+        renderer.render(*job)
+        return None
+    except Exception as error:
+        return f"{job[2]}: {error}"
+
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    subjects = opts.subjects
+    if len(subjects) == 1 and Path(subjects[0]).is_file():
+        subjects = Path(subjects[0]).read_text().split()
+
+    jobs, skipped, missing = [], 0, 0
+    for sub in subjects:
+        prefix = Path(opts.tbss_dir) / sub / f"ses-{opts.session}" / "dwi" / f"{sub}_ses-{opts.session}_space-{opts.space}"
+        for mod in opts.modalities:
+            background = Path(f"{prefix}_desc-eroded_desc-brain_{mod}.nii.gz")
+            skeleton = Path(f"{prefix}_desc-skeleton_{mod}.nii.gz")
+            overlay = Path(f"{prefix}_desc-skeleton_{mod}_overlay.png")
+            if not (background.exists() and skeleton.exists()):
+                missing += 1
+            elif not opts.force and up_to_date([background, skeleton], overlay):
+                skipped += 1
+            else:
+                jobs.append((background, skeleton, overlay))
+
+    print(f"{len(jobs)} overlays to render, {skipped} up to date, {missing} without inputs")
+    if not jobs:
+        return
+
+    if opts.n_procs > 1:
+        with Pool(opts.n_procs, initializer=init_worker, initargs=(opts.width, opts.thumb_width)) as pool:
+            errors = [error for error in pool.imap_unordered(render, jobs, chunksize=8) if error]
+    else:
+        init_worker(opts.width, opts.thumb_width)
+        errors = [error for error in map(render, jobs) if error]
 
-mod_masked = sys.argv[1]
-mod_skel = sys.argv[2]
-overlay = sys.argv[3]
+    for error in errors:
+        print(f"Failed to render {error}")
+    print(f"Rendered {len(jobs) - len(errors)} overlays")
 
-img = nib.load(f"{mod_masked}")
-skel = nib.load(f"{mod_skel}")
 
-nilearn.plotting.plot_stat_map(skel, img, display_mode = 'z', cut_coords = (-37,-21,-7,9,22,35,49), colorbar = True, cmap = plt.cm.viridis, black_bg = True, output_file = f"{overlay}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,90 @@
-from mmap import PAGESIZE
-import os
-import sys
+# HTML QC report of TBSS skeleton overlays for one modality
+# Subjects are shown as a grid of thumbnails (written by overlay.py) which the browser only loads when they are
+# scrolled into view and which link to the full resolution overlay; paths are relative to the report, so the
+# derivatives can be moved together. The PDF export (pdfkit) embeds the full resolution overlays instead of the
+# thumbnails and is only written with --pdf.
+#
+# execute e.g. via
+# python report.py <tbss_dir> <ses> <space> <mod> <histfig> <boxfig> <report.html> [--pdf]
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from html import escape
+from pathlib import Path
 import glob
-import pdfkit
+import os
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Create an HTML report of skeleton overlays with lazily loaded thumbnails')
+    parser.add_argument('tbss_dir', help='[required]\n tbss directory, e.g. data/tbss_mni')
+    parser.add_argument('ses', help='[required]\n session, e.g. 1')
+    parser.add_argument('space', help='[required]\n space label, e.g. MNI')
+    parser.add_argument('mod', help='[required]\n modality, e.g. desc-DTINoNeg_FA')
+    parser.add_argument('histfig', help='[required]\n histogram of skeleton means (group_qc.py)')
+    parser.add_argument('boxfig', help='[required]\n boxplot of skeleton means (group_qc.py)')
+    parser.add_argument('report', help='[required]\n output HTML report')
+    parser.add_argument(
+        '--pdf', action='store_true',
+        help='[optional]\n also convert the report to PDF with all overlays at full resolution (large for big cohorts)')
+    return parser
+
+
+STYLE = """
+body { background: #111; color: #ddd; font-family: sans-serif; }
+.grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(480px, 1fr)); gap: 12px; }
+.grid figure { margin: 0; }
+.grid img { width: 100%; height: auto; aspect-ratio: 16 / 2.6; background: #000; }
+figcaption { font-size: 14px; padding: 2px 0 6px; }
+"""
 
-tbss_dir = sys.argv[1]
-ses = sys.argv[2]
-space = sys.argv[3]
-mod = sys.argv[4]
-histfig = sys.argv[5]
-boxfig = sys.argv[6]
-report = sys.argv[7]
 
-# Create HTML
-#############
+def main():
 
-html = ""
-html += '<p style="font-size:30px">'
-html += f"Report for {tbss_dir} / ses-{ses} / {space} space"
-html += "</p><br>"
+    opts = get_parser().parse_args()
+    report_dir = Path(opts.report).resolve().parent
 
-html += f"<img src='{histfig}'/>"
-html += f"<img src='{boxfig}'/><br>"
-html += "<br>"
+    def link(path):
+        return escape(os.path.relpath(Path(path).resolve(), report_dir))
 
-overlay_paths=glob.glob(f'{tbss_dir}/*/ses-{ses}/dwi/*_ses-{ses}_space-{space}_desc-skeleton_{mod}_overlay.png')
+    overlays = sorted(glob.glob(f'{opts.tbss_dir}/*/ses-{opts.ses}/dwi/*_ses-{opts.ses}_space-{opts.space}_desc-skeleton_{opts.mod}_overlay.png'))
 
-for overlay in overlay_paths:
-    
-    sub = overlay.split("/")[-1].split("_")[0]
+    html = [f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{escape(opts.mod)} ses-{escape(opts.ses)}</title>",
+            f"<style>{STYLE}</style></head><body>",
+            f'<p style="font-size:30px">Report for {escape(opts.tbss_dir)} / ses-{escape(opts.ses)} / {escape(opts.space)} space '
+            f'({len(overlays)} subjects)</p>',
+            f"<img src='{link(opts.histfig)}'/><img src='{link(opts.boxfig)}'/><br><br>",
+            "<div class='grid'>"]
 
-    html += '<p style="font-size:24px">'
-    html += f"<b>{mod} skeleton of {sub} for ses-{ses} in {space} space</b>"
-    html += "</p><br>"
-    html += f"<img src='{overlay}'/><br>"
+    def figures(full_resolution):
+        for overlay in overlays:
+            sub = Path(overlay).name.split("_")[0]
+            thumb = Path(overlay).with_name(Path(overlay).stem + "_thumb.png")
+            src = thumb if thumb.exists() and not full_resolution else overlay
+            yield (f"<figure id='{escape(sub)}'><a href='{link(overlay)}'><img loading='lazy' src='{link(src)}' alt='{escape(sub)}'/></a>"
+                   f"<figcaption><b>{escape(sub)}</b> {escape(opts.mod)} skeleton, ses-{escape(opts.ses)}, {escape(opts.space)} space</figcaption></figure>")
 
-with open(f"{report}", "w") as outputfile:
-	outputfile.write(html)
+    with open(opts.report, "w") as outputfile:
+        outputfile.write("\n".join(html + list(figures(False)) + ["</div></body></html>"]))
+    print(f"Report with {len(overlays)} overlays written to {opts.report}")
 
-# Convert to PDF
-################
+    # Convert to PDF
+    ################
 
-report_pdf = report.split(".")[0]
+    if opts.pdf:
+        import pdfkit
+        report_pdf = str(Path(opts.report).with_suffix(".pdf"))
+        # Same page with the overlays instead of their thumbnails, next to the report so that relative paths resolve
+        pdf_html = Path(opts.report).with_name(".tmp_" + Path(opts.report).name)
+        pdf_html.write_text("\n".join(html + list(figures(True)) + ["</div></body></html>"]))
+        try:
+            pdfkit.from_file(str(pdf_html), report_pdf, options={'page-size': 'A3', 'enable-local-file-access': ''})
+        finally:
+            pdf_html.unlink()
+        print(report_pdf)
 
-print(report_pdf)
 
-pdfkit.from_file(f'{report}', f'{report_pdf}.pdf', options = {'page-size': 'A3'})
\ No newline at end of file
+if __name__ == "__main__":
+    main()
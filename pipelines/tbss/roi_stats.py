@@ -0,0 +1,185 @@
+# Single-pass ROI statistics for TBSS skeletons
+# Loads the JHU ICBM-DTI-81 label volume once and every modality skeleton once and computes
+# count, mean, std and percentiles of all labels in one vectorized pass (replaces per-label fslmaths/fslstats calls).
+# Like `fslstats -M`, only nonzero skeleton voxels enter the statistics.
+#
+# execute e.g. via
+# python roi_stats.py -s sub-01 -p tbssmni -l JHU-ICBM-LUT.txt -a atlas-JHU-ICBM-DTI-81_dseg.nii.gz \
+#     -o sub-01_..._desc-ROIs_means.csv -m FA=sub-01_..._desc-skeleton_desc-DTINoNeg_FA.nii.gz FAt=...
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Compute skeleton ROI statistics for all labels and modalities in one pass')
+    parser.add_argument(
+        '-s', '--subject', required=True,
+        help='[required]\n subject id with sub-, e.g. sub-01')
+    parser.add_argument(
+        '-m', '--modalities', nargs='+', required=True, metavar='NAME=SKELETON',
+        help='[required]\n modality column names and skeleton images, e.g. FA=<..._desc-skeleton_desc-DTINoNeg_FA.nii.gz>'
+             '\n columns are written in the given order')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n output CSV with one row of means (existing *_means.csv layout)')
+    parser.add_argument(
+        '-p', '--prefix', default='tbssmni',
+        help='[optional]\n column prefix, e.g. tbssmni (MNI branch) or tbss (fixel branch); default: tbssmni')
+    parser.add_argument(
+        '-l', '--lut', required=False,
+        help='[optional]\n label lookup table (JHU-ICBM-LUT.txt); required together with --atlas')
+    parser.add_argument(
+        '-a', '--atlas', required=False,
+        help='[optional]\n label volume (dseg) or directory with binary atlas-*_label-<ROI>.nii.gz masks'
+             '\n omit to read out whole-skeleton means only')
+    parser.add_argument(
+        '--stats', required=False,
+        help='[optional]\n long-format CSV with count, mean, std and percentiles per modality and label')
+    return parser
+
+
+def read_lut(lut_path):
+    """Return (index, name) pairs of the lookup table excluding the unclassified label 0."""
+
+    lut = []
+    with open(lut_path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].isdigit() or int(fields[0]) == 0:
+                continue
+            lut.append((int(fields[0]), fields[1]))
+    return lut
+
+
+def load_labels(atlas, lut):
+    """Load the atlas as integer label volume. A directory of binary per-label masks is stacked into one."""
+
+    atlas = Path(atlas)
+
+    if atlas.is_dir():
+        labels = None
+        for index, name in lut:
+            mask_path = next(atlas.glob(f"*_label-{name}.nii*"))
+            mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+            if labels is None:
+                labels = np.zeros(mask.shape, dtype=np.int32)
+            labels[mask] = index
+        return labels
+
+    return np.rint(np.asanyarray(nib.load(atlas).dataobj)).astype(np.int32)
+
+
+def label_stats(values, labels, n_labels, percentiles=PERCENTILES):
+    """Vectorized per-label statistics of nonzero, finite values.
+
+    `labels` holds the label index of each value (0 = background). Returns a dict of arrays of
+    length n_labels + 1 indexed by label; values of labels outside 0 .. n_labels are ignored.
+    """
+
+    valid = np.isfinite(values) & (values != 0) & (labels >= 0) & (labels <= n_labels)
+    values = values[valid].astype(np.float64)
+    labels = labels[valid]
+
+    count = np.bincount(labels, minlength=n_labels + 1)
+    total = np.bincount(labels, weights=values, minlength=n_labels + 1)
+    total_sq = np.bincount(labels, weights=values ** 2, minlength=n_labels + 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = (total_sq - count * mean ** 2) / (count - 1)
+    std = np.sqrt(np.clip(var, 0, None))
+
+    # Percentiles from one sort by (label, value); each label is a contiguous run in the sorted array
+    order = np.lexsort((values, labels))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+
+    stats = {'count': count, 'mean': mean, 'std': std}
+    for q in percentiles:
+        # Linear interpolation between closest ranks (numpy default)
+        pos = starts + (count - 1) * q / 100
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + count - 1)
+        frac = pos - lower
+        pct = np.full(n_labels + 1, np.nan)
+        has = count > 0
+        pct[has] = sorted_values[lower[has]] * (1 - frac[has]) + sorted_values[upper[has]] * frac[has]
+        stats[f'p{q}'] = pct
+
+    return stats
+
+
+def fmt(value):
+    return "" if not np.isfinite(value) else f"{value:.6f}"
+
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    modalities = [m.split("=", 1) for m in opts.modalities]
+    lut = read_lut(opts.lut) if opts.lut else []
+
+    if opts.atlas and not lut:
+        raise SystemExit("--atlas requires --lut")
+
+    # Load label volume once and flatten to the voxel order of the skeletons
+    labels = load_labels(opts.atlas, lut).ravel() if opts.atlas else None
+    n_labels = max([index for index, _ in lut], default=0)
+
+    header = ["sub_id"]
+    row = [opts.subject]
+    stats_rows = []
+
+    for mod, skel_path in modalities:
+
+        # Leave columns of missing modalities empty
+        if not Path(skel_path).exists():
+            print(f"{skel_path} not found. Leaving {mod} columns empty ...")
+            names = [name for _, name in lut] if labels is not None else []
+            header += [f"{opts.prefix}_{name}_mean_{mod}" for name in names + ["skeleton"]]
+            row += [""] * (len(names) + 1)
+            continue
+
+        # Load skeleton once per modality
+        skel = np.asanyarray(nib.load(skel_path).dataobj).ravel()
+
+        if labels is not None:
+
+            if labels.shape != skel.shape:
+                raise SystemExit(f"Label volume and {skel_path} differ in shape")
+
+            roi = label_stats(skel, labels, n_labels)
+
+            for index, name in lut:
+                header.append(f"{opts.prefix}_{name}_mean_{mod}")
+                row.append(fmt(roi['mean'][index]))
+                stats_rows.append([mod, name] + [roi[key][index] for key in roi])
+
+        # Whole skeleton statistics as label 1 of an all-ones label array
+        whole = label_stats(skel, np.ones(skel.shape, dtype=np.int32), 1)
+        header.append(f"{opts.prefix}_skeleton_mean_{mod}")
+        row.append(fmt(whole['mean'][1]))
+        stats_rows.append([mod, "skeleton"] + [whole[key][1] for key in whole])
+
+    with open(opts.output, "w") as f:
+        f.write(",".join(header) + "\n")
+        f.write(",".join(row) + "\n")
+
+    if opts.stats:
+        with open(opts.stats, "w") as f:
+            f.write("sub_id,modality,label,count,mean,std," + ",".join(f"p{q}" for q in PERCENTILES) + "\n")
+            for mod, name, count, *values in stats_rows:
+                f.write(",".join([opts.subject, mod, name, str(int(count))] + [fmt(v) for v in values]) + "\n")
+
+
+if __name__ == "__main__":
+    main()
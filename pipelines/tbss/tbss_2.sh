@@ -313,9 +313,9 @@ CMD_DIST="
 
 $singularity_fsl /bin/bash -c "$CMD_DIST"
 
-########################################################################################
-# Create ROI masks of JHU ICBM-DTI-81 white-matter labels atlas for MNI branch of TBSS #
-########################################################################################
+###################################################################################################
+# Create ROI masks of JHU ICBM-DTI-81 white-matter labels atlas (template space for fixel branch) #
+###################################################################################################
 
 if [ $TBSS_PIPELINE == "mni" ]; then
 
@@ -343,4 +343,40 @@ if [ $TBSS_PIPELINE == "mni" ]; then
 
     done
 
+    # Copy complete label volume for single-pass ROI readout in tbss_3 (roi_stats.py)
+
+    JHU_DSEG=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_dseg.nii.gz
+
+    $singularity_fsl fslmaths $ATLAS $JHU_DSEG -odt int
+
+elif [ $TBSS_PIPELINE == "fixel" ]; then
+
+    # JHU label volume in template space for the ROI readout of the fixel branch (tbss_3) and ROI outlier flags
+    # of group QC (tbss_4): FMRIB58 FA (MNI) is registered nonlinearly to the mean FA of the template and the
+    # labels are warped along
+
+    mkdir -p $DER_DIR/JHU
+
+    # Input
+    ATLAS=/opt/$container_fsl/data/atlases/JHU/JHU-ICBM-labels-1mm.nii.gz
+    FMRIB58=/opt/$container_fsl/data/standard/FMRIB58_FA_1mm.nii.gz
+
+    # Output
+    JHU_MNI=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_space-MNI_dseg.nii.gz
+    FMRIB58_MNI=$DER_DIR/JHU/tpl-FMRIB58_space-MNI_FA.nii.gz
+    MNI2TEMP=$DER_DIR/JHU/from-MNI_to-${SPACE}_
+    JHU_DSEG=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_dseg.nii.gz
+
+    # Define commands
+    [ -z $SLURM_CPUS_PER_TASK ] && SLURM_CPUS_PER_TASK=16
+    CMD_MNI2TEMP="antsRegistrationSyN.sh -d 3 -n $SLURM_CPUS_PER_TASK -f ${FA_MEAN}.nii.gz -m $FMRIB58_MNI -o $MNI2TEMP -t s"
+    CMD_JHU2TEMP="antsApplyTransforms -d 3 -n NearestNeighbor -u int -i $JHU_MNI -r ${FA_MEAN}.nii.gz \
+        -t ${MNI2TEMP}1Warp.nii.gz -t ${MNI2TEMP}0GenericAffine.mat -o $JHU_DSEG"
+
+    # Execute commands
+    $singularity_fsl fslmaths $ATLAS $JHU_MNI -odt int
+    $singularity_fsl fslmaths $FMRIB58 $FMRIB58_MNI
+    $singularity_mrtrix3 $CMD_MNI2TEMP
+    $singularity_mrtrix3 $CMD_JHU2TEMP
+
 fi
\ No newline at end of file
@@ -17,6 +17,7 @@
 #   [container and code]                                                      #
 #       - fsl-6.0.3                                                           #
 #       - overlay.py                                                          #
+#       - roi_stats.py                                                        #
 #       - miniconda-csi                                                       #  
 ###############################################################################
 
@@ -211,195 +212,107 @@ fi
 # Create overlay
 ################
 
-for MOD in $(echo $MODALITIES); do
-
-    # Input for overlay creation and ROI analyses
- 
-    MOD_MASKED=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-eroded_desc-brain_${MOD}.nii.gz
-    MOD_SKEL=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-
-    # Output
+# All modalities in one process; input: *_desc-eroded_desc-brain_<MOD> and *_desc-skeleton_<MOD>,
+# output: *_desc-skeleton_<MOD>_overlay.png and its thumbnail for the report
 
-    OVERLAY=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}_overlay.png
-
-    $singularity_miniconda python $PIPELINE_DIR/overlay.py $MOD_MASKED $MOD_SKEL $OVERLAY
-
-done
+$singularity_miniconda python $PIPELINE_DIR/overlay.py \
+    -d $TBSS_DIR \
+    --session $SESSION \
+    --space $SPACE \
+    -s $1 \
+    -m $MODALITIES
 
 #################
 # Read out ROIs #
 #################
 
-if [ $TBSS_PIPELINE == "mni" ]; then
+# Skeletons of all modalities and the JHU label volume are loaded once by roi_stats.py,
+# which computes the statistics of all labels in one pass and writes the CSV directly
 
-    # Reset MODALITIES omitting one modality (FW) for seperate run (necessary for csv file creation)
-    ################################################################################################
+if [ $TBSS_PIPELINE == "mni" ]; then
 
-    MODALITIES="desc-DTINoNeg_FA desc-FWcorrected_FA desc-DTINoNeg_L1 desc-FWcorrected_L1 desc-DTINoNeg_RD \
-                desc-FWcorrected_RD desc-DTINoNeg_MD desc-FWcorrected_MD"
+    # ROIs of JHU ICBM-DTI-81 white-matter labels atlas (label volume created in tbss_2)
 
+    JHU_DSEG=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_dseg.nii.gz
+    [ ! -f $JHU_DSEG ] && JHU_DSEG=$DER_DIR/JHU
 
-    # Create CSV file
-    #################
+    # Output CSVs for MNI branch (means in existing layout and long-format count/mean/std/percentiles)
 
-    # CSV for MNI branch
-    
     ROI_CSV=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv
-    
-    echo -n "sub_id," > $ROI_CSV
-
-    # ROIs of JHU ICBM-DTI-81 white-matter labels atlas
-
-    for MOD in FA FAt AD ADt RD RDt MD MDt; do
-        
-        echo -en "tbssmni_MI-CP_mean_$MOD,tbssmni_P-CT_mean_$MOD,tbssmni_GCC_mean_$MOD,tbssmni_BCC_mean_$MOD,tbssmni_SCC_mean_$MOD,tbssmni_FX_mean_$MOD,\
-tbssmni_CST-R_mean_$MOD,tbssmni_CST-L_mean_$MOD,tbssmni_ML-R_mean_$MOD,tbssmni_ML-L_mean_$MOD,tbssmni_ICP-R_mean_$MOD,tbssmni_ICP-L_mean_$MOD,\
-tbssmni_SCP-R_mean_$MOD,tbssmni_SCP-L_mean_$MOD,tbssmni_CP-R_mean_$MOD,tbssmni_CP-L_mean_$MOD,tbssmni_ALIC-R_mean_$MOD,tbssmni_ALIC-L_mean_$MOD,\
-tbssmni_PLIC-R_mean_$MOD,tbssmni_PLIC-L_mean_$MOD,tbssmni_RLIC-R_mean_$MOD,tbssmni_RLIC-L_mean_$MOD,tbssmni_ACR-R_mean_$MOD,tbssmni_ACR-L_mean_$MOD,\
-tbssmni_SCR-R_mean_$MOD,tbssmni_SCR-L_mean_$MOD,tbssmni_PCR-R_mean_$MOD,tbssmni_PCR-L_mean_$MOD,tbssmni_PTR-R_mean_$MOD,tbssmni_PTR-L_mean_$MOD,\
-tbssmni_SS-R_mean_$MOD,tbssmni_SS-L_mean_$MOD,tbssmni_EC-R_mean_$MOD,tbssmni_EC-L_mean_$MOD,tbssmni_CGC-R_mean_$MOD,\
-tbssmni_CGC-L_mean_$MOD,tbssmni_CGH-R_mean_$MOD,tbssmni_CGH-L_mean_$MOD,tbssmni_FX_ST-R_mean_$MOD,tbssmni_FX_ST-L_mean_$MOD,tbssmni_SLF-R_mean_$MOD,\
-tbssmni_SLF-L_mean_$MOD,tbssmni_SFO-R_mean_$MOD,tbssmni_SFO-L_mean_$MOD,tbssmni_UNC-R_mean_$MOD,tbssmni_UNC-L_mean_$MOD,\
-tbssmni_TAP-R_mean_$MOD,tbssmni_TAP-L_mean_$MOD,tbssmni_skeleton_mean_$MOD," >> $ROI_CSV
-    done
-
-        echo -e "tbssmni_MI-CP_mean_FW,tbssmni_P-CT_mean_FW,tbssmni_GCC_mean_FW,tbssmni_BCC_mean_FW,tbssmni_SCC_mean_FW,tbssmni_FX_mean_FW,tbssmni_CST-R_mean_FW,\
-tbssmni_CST-L_mean_FW,tbssmni_ML-R_mean_FW,tbssmni_ML-L_mean_FW,tbssmni_ICP-R_mean_FW,tbssmni_ICP-L_mean_FW,tbssmni_SCP-R_mean_FW,tbssmni_SCP-L_mean_FW,\
-tbssmni_CP-R_mean_FW,tbssmni_CP-L_mean_FW,tbssmni_ALIC-R_mean_FW,tbssmni_ALIC-L_mean_FW,tbssmni_PLIC-R_mean_FW,tbssmni_PLIC-L_mean_FW,\
-tbssmni_RLIC-R_mean_FW,tbssmni_RLIC-L_mean_FW,tbssmni_ACR-R_mean_FW,tbssmni_ACR-L_mean_FW,tbssmni_SCR-R_mean_FW,tbssmni_SCR-L_mean_FW,\
-tbssmni_PCR-R_mean_FW,tbssmni_PCR-L_mean_FW,tbssmni_PTR-R_mean_FW,tbssmni_PTR-L_mean_FW,tbssmni_SS-R_mean_FW,tbssmni_SS-L_mean_FW,tbssmni_EC-R_mean_FW,\
-tbssmni_EC-L_mean_FW,tbssmni_CGC-R_mean_FW,tbssmni_CGC-L_mean_FW,tbssmni_CGH-R_mean_FW,tbssmni_CGH-L_mean_FW,tbssmni_FX_ST-R_mean_FW,\
-tbssmni_FX_ST-L_mean_FW,tbssmni_SLF-R_mean_FW,tbssmni_SLF-L_mean_FW,tbssmni_SFO-R_mean_FW,tbssmni_SFO-L_mean_FW,tbssmni_UNC-R_mean_FW,\
-tbssmni_UNC-L_mean_FW,tbssmni_TAP-R_mean_FW,tbssmni_TAP-L_mean_FW,tbssmni_skeleton_mean_FW" >> $ROI_CSV
-
-    # Iterate across modalities to extract JHU ROIs and mean across entire skeleton
-    ###############################################################################
-
-    echo -n "$1," >>  $ROI_CSV
-
-    for MOD in $(echo $MODALITIES); do
-
-        # Calculate mean for each ROI
-
-        for ROI in $(awk '{print $2}' $CODE_DIR/pipelines/tbss/JHU-ICBM-LUT.txt | tail -n +2 ); do
-
-            # Input 
-            MOD_SKEL=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-            JHU_ROI=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_label-${ROI}.nii.gz
-
-            # Output skeleton (masked by ROI)
-            MOD_SKEL_ROI=$TMP_OUT/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-JHU_label-${ROI}_${MOD}.nii.gz
-
-            CMD_ROI="fslmaths $JHU_ROI -mul $MOD_SKEL $MOD_SKEL_ROI"
-            CMD_ROI_MEAN="fslstats $MOD_SKEL_ROI -M"
-
-            $singularity_fsl $CMD_ROI
-            mean_roi=`$singularity_fsl $CMD_ROI_MEAN | tail -n 1`
-            echo -n "$mean_roi," >> $ROI_CSV
-                
-        done
-
-        # Calculate mean across entire skeleton
-
-        CMD_MEAN="fslstats $MOD_SKEL -M"
-        mean=`$singularity_fsl $CMD_MEAN | tail -n 1`
-        echo -n "$mean," >> $ROI_CSV
-
-    done
-
-    # Repeat computations for FW (last echo call without -n option so next subject gets appended to new line) 
-        
-    MOD="FW"
- 
-    # Calculate mean for each ROI
-
-    for ROI in $(awk '{print $2}' $CODE_DIR/pipelines/tbss/JHU-ICBM-LUT.txt | tail -n +2 ); do
-
-        # Input 
-        MOD_SKEL=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-        JHU_ROI=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_label-${ROI}.nii.gz
-
-        # Output skeleton (masked by ROI)
-        MOD_SKEL_ROI=$TMP_OUT/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-JHU_label-${ROI}_${MOD}.nii.gz
-
-        CMD_ROI="fslmaths $JHU_ROI -mul $MOD_SKEL $MOD_SKEL_ROI"
-        CMD_ROI_MEAN="fslstats $MOD_SKEL_ROI -M"
-
-        $singularity_fsl $CMD_ROI
-        mean_roi=`$singularity_fsl $CMD_ROI_MEAN | tail -n 1`
-        echo -n "$mean_roi," >> $ROI_CSV
-    
-    done
-
-
-        # Calculate mean across entire skeleton
-
-        CMD_MEAN="fslstats $MOD_SKEL -M"
-        mean=`$singularity_fsl $CMD_MEAN | tail -n 1`
-        echo "$mean" >> $ROI_CSV
+    ROI_STATS_CSV=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_stats.csv
+
+    SKEL_PREFIX=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton
+
+    $singularity_miniconda python $PIPELINE_DIR/roi_stats.py \
+        -s $1 \
+        -p tbssmni \
+        -l $CODE_DIR/pipelines/tbss/JHU-ICBM-LUT.txt \
+        -a $JHU_DSEG \
+        -o $ROI_CSV \
+        --stats $ROI_STATS_CSV \
+        -m FA=${SKEL_PREFIX}_desc-DTINoNeg_FA.nii.gz \
+           FAt=${SKEL_PREFIX}_desc-FWcorrected_FA.nii.gz \
+           AD=${SKEL_PREFIX}_desc-DTINoNeg_L1.nii.gz \
+           ADt=${SKEL_PREFIX}_desc-FWcorrected_L1.nii.gz \
+           RD=${SKEL_PREFIX}_desc-DTINoNeg_RD.nii.gz \
+           RDt=${SKEL_PREFIX}_desc-FWcorrected_RD.nii.gz \
+           MD=${SKEL_PREFIX}_desc-DTINoNeg_MD.nii.gz \
+           MDt=${SKEL_PREFIX}_desc-FWcorrected_MD.nii.gz \
+           FW=${SKEL_PREFIX}_FW.nii.gz
 
 elif [ $TBSS_PIPELINE == "fixel" ]; then
 
-    # Reset MODALITIES omitting one modality (desc-voxelmap_complexity) for seperate run (necessary for csv file creation)
-    ######################################################################################################################
+    # Output CSV for fixel branch (mean across entire skeleton)
 
-    MODALITIES="desc-DTINoNeg_FA desc-FWcorrected_FA desc-DTINoNeg_L1 desc-FWcorrected_L1 desc-DTINoNeg_RD \
-                desc-FWcorrected_RD desc-DTINoNeg_MD desc-FWcorrected_MD FW desc-voxelmap_fd desc-voxelmap_fdc \
-                desc-voxelmap_logfc"
-
-    # Create CSV file
-    #################
-    
-    # Output CSV for fixel branch
     MEAN_CSV=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_means.csv
-    
-    echo -e "sub_id,tbss_skeleton_mean_FA,tbss_skeleton_mean_FAt,tbss_skeleton_mean_AD,tbss_skeleton_mean_ADt,tbss_skeleton_mean_RD,\
-tbss_skeleton_mean_RDt,tbss_skeleton_mean_MD,tbss_skeleton_mean_MDt,tbss_skeleton_mean_FW,tbss_skeleton_mean_fd,tbss_skeleton_mean_fdc,\
-tbss_skeleton_mean_logfc,tbss_skeleton_mean_complexity" > $MEAN_CSV
-
-    # Iterate across modalities to extract mean across entire skeleton
-    ##################################################################
-
-    echo -n "$1," >>  $MEAN_CSV
-
-    for MOD in $(echo $MODALITIES); do
-
-        # Input skeleton
-        MOD_SKEL=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-            
-        CMD_MEAN="fslstats $MOD_SKEL -M"
-        mean=`$singularity_fsl $CMD_MEAN | tail -n 1`
-
-        if [ $mean == "https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Licence" ]; then
-
-            echo -n "," >> $MEAN_CSV
-
-        else
-            
-            echo -n "$mean," >> $MEAN_CSV
-        
-        fi
-        
-    done
-
-    # Repeat computations for desc-voxelmap_complexity (last echo call without -n option so next subject gets appended to new line)
-
-    MOD="desc-voxelmap_complexity"
-
-    # Input skeleton
-    MOD_SKEL=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-
-    CMD_MEAN="fslstats $MOD_SKEL -M"
-    mean=`$singularity_fsl $CMD_MEAN | tail -n 1`
-
-    if [ $mean == "https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Licence" ]; then
-
-        echo "" >> $MEAN_CSV
-    
-    else
-
-        echo "$mean" >> $MEAN_CSV
-
-    fi
+    MEAN_STATS_CSV=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_stats.csv
+
+    SKEL_PREFIX=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton
+
+    $singularity_miniconda python $PIPELINE_DIR/roi_stats.py \
+        -s $1 \
+        -p tbss \
+        -o $MEAN_CSV \
+        --stats $MEAN_STATS_CSV \
+        -m FA=${SKEL_PREFIX}_desc-DTINoNeg_FA.nii.gz \
+           FAt=${SKEL_PREFIX}_desc-FWcorrected_FA.nii.gz \
+           AD=${SKEL_PREFIX}_desc-DTINoNeg_L1.nii.gz \
+           ADt=${SKEL_PREFIX}_desc-FWcorrected_L1.nii.gz \
+           RD=${SKEL_PREFIX}_desc-DTINoNeg_RD.nii.gz \
+           RDt=${SKEL_PREFIX}_desc-FWcorrected_RD.nii.gz \
+           MD=${SKEL_PREFIX}_desc-DTINoNeg_MD.nii.gz \
+           MDt=${SKEL_PREFIX}_desc-FWcorrected_MD.nii.gz \
+           FW=${SKEL_PREFIX}_FW.nii.gz \
+           fd=${SKEL_PREFIX}_desc-voxelmap_fd.nii.gz \
+           fdc=${SKEL_PREFIX}_desc-voxelmap_fdc.nii.gz \
+           logfc=${SKEL_PREFIX}_desc-voxelmap_logfc.nii.gz \
+           complexity=${SKEL_PREFIX}_desc-voxelmap_complexity.nii.gz
+
+    # ROIs of JHU ICBM-DTI-81 labels registered to template space (tbss_2) for ROI outlier flags of group QC
+
+    JHU_DSEG=$DER_DIR/JHU/atlas-JHU-ICBM-DTI-81_dseg.nii.gz
+    ROI_CSV=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv
+    ROI_STATS_CSV=$TBSS_SUBDIR/${1}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_stats.csv
+
+    [ -f $JHU_DSEG ] && $singularity_miniconda python $PIPELINE_DIR/roi_stats.py \
+        -s $1 \
+        -p tbss \
+        -l $CODE_DIR/pipelines/tbss/JHU-ICBM-LUT.txt \
+        -a $JHU_DSEG \
+        -o $ROI_CSV \
+        --stats $ROI_STATS_CSV \
+        -m FA=${SKEL_PREFIX}_desc-DTINoNeg_FA.nii.gz \
+           FAt=${SKEL_PREFIX}_desc-FWcorrected_FA.nii.gz \
+           AD=${SKEL_PREFIX}_desc-DTINoNeg_L1.nii.gz \
+           ADt=${SKEL_PREFIX}_desc-FWcorrected_L1.nii.gz \
+           RD=${SKEL_PREFIX}_desc-DTINoNeg_RD.nii.gz \
+           RDt=${SKEL_PREFIX}_desc-FWcorrected_RD.nii.gz \
+           MD=${SKEL_PREFIX}_desc-DTINoNeg_MD.nii.gz \
+           MDt=${SKEL_PREFIX}_desc-FWcorrected_MD.nii.gz \
+           FW=${SKEL_PREFIX}_FW.nii.gz \
+           fd=${SKEL_PREFIX}_desc-voxelmap_fd.nii.gz \
+           fdc=${SKEL_PREFIX}_desc-voxelmap_fdc.nii.gz \
+           logfc=${SKEL_PREFIX}_desc-voxelmap_logfc.nii.gz \
+           complexity=${SKEL_PREFIX}_desc-voxelmap_complexity.nii.gz
 
-fi
\ No newline at end of file
+fi
@@ -17,8 +17,10 @@
 #       - tbss_3                                                              #
 #   [containers and code]                                                     #
 #       - fsl-6.0.3                                                           #
-#       - stats.py                                                            #
+#       - group_qc.py                                                         #
 #       - report.py                                                           #
+#       - merge_skeletons.py                                                  #
+#       - merge_csvs.py                                                       #
 #       - csi-miniconda                                                       #  
 ###############################################################################
 
@@ -115,12 +117,32 @@ if [ $files_complete == "n" ]; then
     exit
 fi
 
+# Incremental mode ($MODIFIER == y) rewrites merged skeletons (.nii.gz) only if subjects were added or changed, copying
+# the volumes of unchanged subjects; full and incremental runs write the same files. CSVs of previous runs are updated
+# in place.
+######################################################################################################################
+
+[ -z $MODIFIER ] && MODIFIER=n
+
+# Uncompressed working copies of earlier incremental runs
+[ -d $DER_DIR/.incremental ] && rm -rvf $DER_DIR/.incremental
+
+if [ $MODIFIER == "y" ]; then
+
+    MERGE_FLAGS="--incremental"
+
+else
+
+    MERGE_FLAGS=""
+
+fi
+
 # Remove output of previous runs
 ################################
 
 FA_SKEL_MERGED=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-DTINoNeg_FA.nii.gz
 
-if [ -f $FA_SKEL_MERGED ]; then
+if [ -f $FA_SKEL_MERGED ] && [ $MODIFIER != "y" ]; then
     
     echo ""
     echo "TBSS Part 4 (tbss_4.sh) has already been run for merge list "$TBSS_MERGE_LIST". Removing output of previous run first ..."
@@ -145,180 +167,68 @@ fi
 # Merging skeletons for each modality #
 #######################################
 
+# Skeletons are merged one volume at a time by merge_skeletons.py, so RAM usage is independent of the number of
+# subjects and no intermediate batch merges are necessary. Additionally, a compact sidecar containing skeleton
+# voxels only (subjects x skeleton voxels; float32 .npy) with the corresponding voxel index is written.
+
+SKELETON_MASK=$TBSS_DIR/derivatives/sub-all/ses-${SESSION}/dwi/sub-all_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-meanFA_mask.nii.gz
+
 for MOD in $(echo $MODALITIES); do
 
     echo ""
     echo $MOD
     echo ""
 
-    if [ $TBSS_MERGE_LIST == "all" ]; then
-    
-        # If more than 700 skeletons are to be merged, intermediate merges are necessary for RAM reasons
-        ################################################################################################
-
-        # Count number of subjects
-        ##########################
-
-        subj_batch_array=($(ls $TBSS_DIR/sub-* -d))
-        subj_array_length=${#subj_batch_array[@]}
-        echo $subj_array_length
-        
-        if [ $subj_array_length -gt 700 ]; then
-
-            # Define number of subjects to be merged in one intermediate 4D image
-            #####################################################################
-
-            subj_per_batch=700
-            batch_amount=$(($subj_array_length / $subj_per_batch))
-            export START=1
-
-            # If modulo of subject array length and subj_per_batch is not 0 -> add one iteration to make sure all subjects will be processed
-            
-            [ ! $(( $subj_array_length % $subj_per_batch )) -eq 0 ] && batch_amount=$(($batch_amount + 1))
-
-            # Loop through subject batches
-            ##############################
-
-            for batch in $(seq -w $batch_amount); do
-
-                echo ""
-                echo "Merging batch $batch ..."
-                echo ""
-
-                # Define end of batch
-                
-                export END=$(($subj_per_batch * $batch))
-
-                # Define output
-
-                MOD_SKEL_MERGED_INTERMEDIATE=$TMP_OUT/batch-${batch}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-
-                # Define commands
-
-                CMD_MERGE_INTERMEDIATE="fslmerge -t $MOD_SKEL_MERGED_INTERMEDIATE $(ls $TBSS_DIR/sub-*/ses-${SESSION}/dwi/*desc-skeleton*${MOD}.nii.gz | sed -n "$START,${END}p")"
-                
-                # Execute commands for batch
-
-                $singularity_fsl $CMD_MERGE_INTERMEDIATE
-
-                # Increase START by subj_per_batch
-
-                export START=$(($START + $subj_per_batch))
-
-            done
-
-            # Merge batches to final 4D image
-            #################################
-
-            # Define output
-
-            MOD_SKEL_MERGED=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-
-            # Command
+    # Output
 
-            $singularity_fsl fslmerge \
-                -t $MOD_SKEL_MERGED \
-                $TMP_OUT/batch-*_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-            
-        else
+    MOD_SKEL_MERGED=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
+    MOD_SKEL_SIDECAR=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}
+    MERGE_LIST_MOD=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}_mergelist.txt
 
-            MOD_SKEL_MERGED=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
+    # Create list of paths to skeletons to be merged
+    ################################################
 
-            $singularity_fsl fslmerge \
-                -t $MOD_SKEL_MERGED \
-                $TBSS_DIR/sub-*/ses-${SESSION}/dwi/*desc-skeleton*${MOD}.nii.gz
-        
-        fi
-        
-    elif [ $TBSS_MERGE_LIST =! "all" ]; then
+    if [ $TBSS_MERGE_LIST == "all" ]; then
 
-        # Define output
+        ls $TBSS_DIR/sub-*/ses-${SESSION}/dwi/*desc-skeleton*${MOD}.nii.gz > $MERGE_LIST_MOD
 
-        MERGE_LIST_MOD=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}_mergelist.txt
+    else
 
-        # Create list of paths to skeletons to be merged
-        ################################################
+        [ -f $MERGE_LIST_MOD ] && rm $MERGE_LIST_MOD
 
-        for sub in $(echo $TBSS_DIR/code/merge_${TBSS_MERGE_LIST}.txt); do
+        for sub in $(cat $TBSS_DIR/code/merge_${TBSS_MERGE_LIST}.txt); do
             
             MOD_SKEL=$TBSS_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
             echo $MOD_SKEL >> $MERGE_LIST_MOD
         
         done
 
-        # Count number of subjects
-        ##########################
-
-        subj_array_length=$(cat $MERGE_LIST_MOD | wc -l)
-        echo $subj_array_length
-
-        if [ $subj_array_length -gt 700 ]; then
-
-            # Define number of subjects to be merged in one intermediate 4D image
-            #####################################################################
-
-            subj_per_batch=700
-            batch_amount=$(($subj_array_length / $subj_per_batch))
-            export START=1
-
-            # If modulo of subject array length and subj_per_batch is not 0 -> add one iteration to make sure all subjects will be processed
-            
-            [ ! $(( $subj_array_length % $subj_per_batch )) -eq 0 ] && batch_amount=$(($batch_amount + 1))
-
-            # Loop through subject batches
-            ##############################
-
-            for batch in $(seq -w $batch_amount); do
-
-                echo ""
-                echo "Merging batch $batch ..."
-                echo ""
-
-                # Define end of batch
-                
-                export END=$(($subj_per_batch * $batch))
-
-                # Define output
-
-                MOD_SKEL_MERGED_INTERMEDIATE=$TMP_OUT/batch-${batch}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-
-                # Define commands
-
-                CMD_MERGE_INTERMEDIATE="fslmerge -t $MOD_SKEL_MERGED_INTERMEDIATE $(cat $MERGE_LIST_MOD) | sed -n "$START,${END}p")"
-                
-                # Execute commands for batch
-
-                $singularity_fsl $CMD_MERGE_INTERMEDIATE
-
-                # Increase START by subj_per_batch
-
-                export START=$(($START + $subj_per_batch))
-
-            done
+    fi
 
-            # Merge batches to final 4D image
-            #################################
+    echo "Merging $(cat $MERGE_LIST_MOD | wc -l) skeletons ..."
 
-            # Define output
+    # Merge skeletons
+    #################
 
-            MOD_SKEL_MERGED=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
+    CMD_MERGE="
+        python $PIPELINE_DIR/merge_skeletons.py \
+            -l $MERGE_LIST_MOD \
+            -o $MOD_SKEL_MERGED \
+            -m $SKELETON_MASK \
+            --sidecar $MOD_SKEL_SIDECAR \
+            $MERGE_FLAGS"
 
-            # Command
+    $singularity_miniconda $CMD_MERGE
 
-            $singularity_fsl fslmerge \
-                -t $MOD_SKEL_MERGED \
-                $TMP_OUT/batch-*_ses-${SESSION}_space-${SPACE}_desc-skeleton_${MOD}.nii.gz
-            
-        else
+    # Uncompressed merges written to $DER_DIR by earlier incremental runs
+    [ $MODIFIER == "y" ] && [ -f ${MOD_SKEL_MERGED%.gz} ] && rm -v ${MOD_SKEL_MERGED%.gz}
 
-            $singularity_fsl fslmerge \
-                -t $MOD_SKEL_MERGED \
-                $(cat $MERGE_LIST_MOD)
-        fi
+done
 
-    fi
+# In incremental mode the subject order of the merged skeletons of this merge list defines the order of its merged CSVs;
+# the shared caselist of all subjects is left unchanged
 
-done
+[ $MODIFIER == "y" ] && CASELIST=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-DTINoNeg_FA_subjects.txt
 
 ###########################
 # Combine individual CSVs #
@@ -345,14 +255,25 @@ if [ $TBSS_PIPELINE == "mni" ]; then
     # Create CSV
     ############
 
-    head -n 1 $ROI_CSV_RAND > $ROI_CSV_MERGED
+    if [ $MODIFIER == "y" ]; then
 
-    for sub in $(cat $CASELIST); do
+        $singularity_miniconda python $PIPELINE_DIR/merge_csvs.py \
+            -s $CASELIST \
+            -t "$TBSS_DIR/{sub}/ses-${SESSION}/dwi/{sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv" \
+            -o $ROI_CSV_MERGED
 
-        ROI_CSV=$TBSS_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv
-        tail -n 1 $ROI_CSV >> $ROI_CSV_MERGED
-    
-    done
+    else
+
+        head -n 1 $ROI_CSV_RAND > $ROI_CSV_MERGED
+
+        for sub in $(cat $CASELIST); do
+
+            ROI_CSV=$TBSS_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv
+            tail -n 1 $ROI_CSV >> $ROI_CSV_MERGED
+        
+        done
+
+    fi
 
 elif [ $TBSS_PIPELINE == "fixel" ]; then
 
@@ -369,14 +290,39 @@ elif [ $TBSS_PIPELINE == "fixel" ]; then
     # Create CSV
     ############
 
-    head -n 1 $MEAN_CSV_RAND > $MEAN_CSV_MERGED
+    if [ $MODIFIER == "y" ]; then
 
-    for sub in $(cat $CASELIST); do
-    
-        MEAN_CSV=$TBSS_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_means.csv
-        tail -n 1 $MEAN_CSV >> $MEAN_CSV_MERGED
-    
-    done
+        $singularity_miniconda python $PIPELINE_DIR/merge_csvs.py \
+            -s $CASELIST \
+            -t "$TBSS_DIR/{sub}/ses-${SESSION}/dwi/{sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_means.csv" \
+            -o $MEAN_CSV_MERGED
+
+    else
+
+        head -n 1 $MEAN_CSV_RAND > $MEAN_CSV_MERGED
+
+        for sub in $(cat $CASELIST); do
+        
+            MEAN_CSV=$TBSS_DIR/$sub/ses-${SESSION}/dwi/${sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_means.csv
+            tail -n 1 $MEAN_CSV >> $MEAN_CSV_MERGED
+        
+        done
+
+    fi
+
+    # ROI means of JHU labels in template space (tbss_2/tbss_3), if read out
+
+    ROI_CSV_RAND=$TBSS_DIR/$RAND_SUB/ses-${SESSION}/dwi/${RAND_SUB}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv
+    ROI_CSV_MERGED=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv
+
+    if [ -f $ROI_CSV_RAND ]; then
+
+        $singularity_miniconda python $PIPELINE_DIR/merge_csvs.py \
+            -s $CASELIST \
+            -t "$TBSS_DIR/{sub}/ses-${SESSION}/dwi/{sub}_ses-${SESSION}_space-${SPACE}_desc-skeleton_label-JHU_desc-ROIs_means.csv" \
+            -o $ROI_CSV_MERGED
+
+    fi
 
 fi
 
@@ -390,26 +336,30 @@ if [ $TBSS_PIPELINE == "fixel" ]; then
                 desc-FWcorrected_RD desc-DTINoNeg_MD desc-FWcorrected_MD FW desc-voxelmap_fd desc-voxelmap_fdc \
                 desc-voxelmap_logfc desc-voxelmap_complexity"
     CSV=$MEAN_CSV_MERGED
+    [ -f $ROI_CSV_RAND ] && CSV="$CSV $ROI_CSV_MERGED"
 
-    # Create stats figures
-    ######################
+    # Create stats figures and group QC
+    ###################################
 
-    for MOD in FA FAt AD ADt RD RDt MD MDt FW fd fdc logfc complexity; do
+    # Robust statistics and outlier flags of all modalities and ROIs in one pass; figures of all modalities in parallel
+    # Output: *_desc-mean<MOD>_histogram.png, *_desc-mean<MOD>_boxplot.png, *_desc-groupqc_summary.csv,
+    #         *_desc-groupqc_outliers.tsv and *_desc-groupqc_flagged.txt (subjects to check, re-queue or exclude)
 
-        # Stats output
+    $singularity_miniconda python $PIPELINE_DIR/group_qc.py \
+        -c $CSV \
+        -o $DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton \
+        -n $SLURM_CPUS_PER_TASK
 
-        HISTFIG=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-mean${MOD}_histogram.png
-        BOXFIG=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-mean${MOD}_boxplot.png
-        
-        # Command 
+    # Render missing or outdated overlays of all subjects (tbss_3 renders them per subject) in one process pool
 
-        $singularity_miniconda python $PIPELINE_DIR/stats.py "" $MOD $CSV $HISTFIG $BOXFIG
-
-    done
+    $singularity_miniconda python $PIPELINE_DIR/overlay.py -d $TBSS_DIR --session $SESSION --space $SPACE \
+        -s $CASELIST -m $MODALITIES -n $SLURM_CPUS_PER_TASK
 
     # Create HTML report
     ####################
 
+    # Overlays are embedded as lazily loaded thumbnails; add --pdf to report.py for a PDF with all overlays
+
     for MODALITY in $(echo $MODALITIES); do
 
         [ $MODALITY == "desc-DTINoNeg_FA" ] && MOD="FA"
@@ -445,25 +395,28 @@ elif [ $TBSS_PIPELINE == "mni" ]; then
                 desc-FWcorrected_RD desc-DTINoNeg_MD desc-FWcorrected_MD FW"
     CSV=$ROI_CSV_MERGED
 
-    # Create stats figures
-    ######################
+    # Create stats figures and group QC
+    ###################################
 
-    for MOD in FA FAt AD ADt RD RDt MD MDt FW; do
+    # Robust statistics and outlier flags of all modalities and ROIs in one pass; figures of all modalities in parallel
+    # Output: *_desc-mean<MOD>_histogram.png, *_desc-mean<MOD>_boxplot.png, *_desc-groupqc_summary.csv,
+    #         *_desc-groupqc_outliers.tsv and *_desc-groupqc_flagged.txt (subjects to check, re-queue or exclude)
 
-        # Stats output
+    $singularity_miniconda python $PIPELINE_DIR/group_qc.py \
+        -c $CSV \
+        -o $DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton \
+        -n $SLURM_CPUS_PER_TASK
 
-        HISTFIG=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-mean${MOD}_histogram.png
-        BOXFIG=$DER_DIR/sub-${TBSS_MERGE_LIST}_ses-${SESSION}_space-${SPACE}_desc-skeleton_desc-mean${MOD}_boxplot.png
-
-        # Command
+    # Render missing or outdated overlays of all subjects (tbss_3 renders them per subject) in one process pool
 
-        $singularity_miniconda python $PIPELINE_DIR/stats.py $TBSS_PIPELINE $MOD $CSV $HISTFIG $BOXFIG
-
-    done
+    $singularity_miniconda python $PIPELINE_DIR/overlay.py -d $TBSS_DIR --session $SESSION --space $SPACE \
+        -s $CASELIST -m $MODALITIES -n $SLURM_CPUS_PER_TASK
 
     # Create HTML report
     ####################
 
+    # Overlays are embedded as lazily loaded thumbnails; add --pdf to report.py for a PDF with all overlays
+
     for MODALITY in $(echo $MODALITIES); do
 
         [ $MODALITY == "desc-DTINoNeg_FA" ] && MOD="FA"
@@ -0,0 +1,164 @@
+# Overlap evaluation of WMH segmentations against manual masks (replaces mri_seg_overlap for Dice and Jaccard)
+# Both masks are loaded once per subject and Dice, Jaccard, volume difference, lesion-wise detection and
+# (95th percentile) Hausdorff distance are computed from them. Subjects are processed in a process pool.
+#
+# execute e.g. via
+# python overlap_eval.py -s sub-001 sub-002 -m '<MAN_DIR>/{sub}/anat/{sub}_DC_FLAIR_label3.nii.gz' \
+#     -i '<DATA_DIR>/wmh/{sub}/ses-1/anat/lpa/{sub}_ses-1_space-FLAIR_desc-masked_desc-wmh_desc-lpa_mask.nii.gz' \
+#     -o <derivatives/lpa/metrics_lpa.csv> --dice <derivatives/lpa/diceindex_lpa.csv> --jaccard <derivatives/lpa/jaccardindex_lpa.csv>
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from multiprocessing import Pool
+from pathlib import Path
+import os
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+
+COLUMNS = ["sub", "dice", "jaccard", "volume_mm3", "volume_manual_mm3", "volume_difference_mm3", "volume_difference_percent",
+           "lesions_manual", "lesions_detected", "detection_rate", "lesions", "lesions_false_positive",
+           "hausdorff_mm", "hausdorff95_mm"]
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Evaluate WMH segmentations against manual masks')
+    parser.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subject ids')
+    parser.add_argument(
+        '-m', '--manual', required=True,
+        help='[required]\n path template of manual segmentations containing {sub}')
+    parser.add_argument(
+        '-i', '--input', required=True,
+        help='[required]\n path template of segmentations to evaluate containing {sub}')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n CSV with all metrics, one row per subject')
+    parser.add_argument(
+        '--dice', required=False,
+        help='[optional]\n CSV with sub,dice (no header)')
+    parser.add_argument(
+        '--jaccard', required=False,
+        help='[optional]\n CSV with sub,jaccard (no header)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())),
+        help='[optional]\n number of worker processes; default $SLURM_CPUS_PER_TASK')
+    return parser
+
+
+###########
+# Metrics #
+###########
+
+STRUCTURE = ndimage.generate_binary_structure(3, 3)
+
+
+def lesion_detection(reference, segmentation):
+    """Number of lesions in `reference` and how many of them overlap `segmentation` (26-connectivity)."""
+
+    labels, n = ndimage.label(reference, STRUCTURE)
+    hit = np.unique(labels[segmentation & reference])
+    return n, int(np.count_nonzero(hit))
+
+
+def surface_distances(a, b, zooms):
+    """Distances (mm) from the surface voxels of `a` to the surface of `b` and vice versa."""
+
+    # Nearest surface points lie within the bounding box of both masks
+    box = ndimage.find_objects((a | b).astype(np.uint8))[0]
+    a, b = a[box], b[box]
+    surface_a = a & ~ndimage.binary_erosion(a, STRUCTURE)
+    surface_b = b & ~ndimage.binary_erosion(b, STRUCTURE)
+    to_b = ndimage.distance_transform_edt(~surface_b, sampling=zooms)
+    to_a = ndimage.distance_transform_edt(~surface_a, sampling=zooms)
+    return np.concatenate([to_b[surface_a], to_a[surface_b]])
+
+
+def load(path):
+    img = nib.load(path)
+    return np.asanyarray(img.dataobj) > 0, img.header.get_zooms()[:3]
+
+
+def fmt(value):
+    return "" if value is None or not np.isfinite(value) else f"{value:.6f}"
+
+
+def evaluate(sub, opts):
+    """Return metric row of subject `sub` or None if inputs are missing."""
+
+    manual_path = opts.manual.format(sub=sub)
+    seg_path = opts.input.format(sub=sub)
+
+    missing = [p for p in (seg_path, manual_path) if not Path(p).exists()]
+    if missing:
+        print(f"{' '.join(missing)} not found. Skipping {sub} ...")
+        return None
+
+    manual, zooms = load(manual_path)
+    seg, _ = load(seg_path)
+    if seg.shape != manual.shape:
+        print(f"{seg_path} has shape {seg.shape}, manual mask {manual.shape}. Skipping {sub} ...")
+        return None
+    voxel_volume = float(np.prod(zooms))
+
+    tp = np.count_nonzero(manual & seg)
+    n_seg, n_man = np.count_nonzero(seg), np.count_nonzero(manual)
+    dice = 2 * tp / (n_seg + n_man) if n_seg + n_man else np.nan
+    jaccard = tp / (n_seg + n_man - tp) if n_seg + n_man else np.nan
+
+    vol, vol_man = n_seg * voxel_volume, n_man * voxel_volume
+    vol_diff_percent = 100 * (vol - vol_man) / vol_man if vol_man else np.nan
+
+    lesions_man, detected = lesion_detection(manual, seg)
+    lesions, true_lesions = lesion_detection(seg, manual)
+
+    if n_seg and n_man:
+        distances = surface_distances(seg, manual, zooms)
+        hausdorff, hausdorff95 = distances.max(), np.percentile(distances, 95)
+    else:
+        hausdorff = hausdorff95 = np.nan
+
+    return [sub, fmt(dice), fmt(jaccard), fmt(vol), fmt(vol_man), fmt(vol - vol_man), fmt(vol_diff_percent),
+            lesions_man, detected, fmt(detected / lesions_man if lesions_man else np.nan), lesions, lesions - true_lesions,
+            fmt(hausdorff), fmt(hausdorff95)]
+
+
+def run(args):
+    sub, opts = args
+    return evaluate(sub, opts)
+
+
+def write_csv(path, lines):
+    path = Path(path)
+    tmp = path.with_name(".tmp_" + path.name)
+    with open(tmp, "w") as f:
+        f.writelines(",".join(map(str, line)) + "\n" for line in lines)
+    os.replace(tmp, path)
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    with Pool(max(1, min(opts.jobs, len(opts.subjects)))) as pool:
+        rows = [row for row in pool.map(run, [(sub, opts) for sub in opts.subjects], chunksize=1) if row is not None]
+
+    write_csv(opts.output, [COLUMNS] + rows)
+    if opts.dice:
+        write_csv(opts.dice, [[row[0], row[1]] for row in rows])
+    if opts.jaccard:
+        write_csv(opts.jaccard, [[row[0], row[2]] for row in rows])
+
+    print(f"Evaluated {len(rows)} of {len(opts.subjects)} subjects. Written to {opts.output}")
+
+
+if __name__ == "__main__":
+    main()
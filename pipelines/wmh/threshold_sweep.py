@@ -0,0 +1,208 @@
+# Threshold sweep of WMH segmentations against manual masks (replaces per-threshold fslmaths/fslstats/mri_seg_overlap)
+# Every probability map and manual mask is loaded once. Each voxel is assigned the number of thresholds it survives
+# (after optional cluster-size filtering and ribbon masking), so TP/FP/FN of all thresholds follow from one
+# histogram of these levels inside and outside the manual mask. For two algorithms the union of both thresholded
+# masks is evaluated for all threshold pairs from a cumulative 2D histogram.
+# Subjects are processed in a process pool; results are written as one tidy CSV (one row per subject and threshold).
+#
+# execute e.g. via
+# python threshold_sweep.py -s sub-001 sub-002 -m '<MAN_DIR>/{sub}/anat/{sub}_DC_FLAIR_label4.nii.gz' \
+#     -p bianca='<DIR>/{sub}_bianca_output.nii.gz' --cluster-size bianca=3 --ribbon bianca='<ANAT_DIR>/{sub}_..._mask.nii.gz' \
+#     -o <derivatives/bianca/thresholds/bianca_desc-thresholdsweep.csv>
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from multiprocessing import Pool
+from pathlib import Path
+import os
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+
+THRESHOLDS = [round(0.05 * i, 2) for i in range(1, 20)]
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Evaluate WMH segmentations against manual masks for all thresholds at once')
+    parser.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subject ids')
+    parser.add_argument(
+        '-m', '--manual', required=True,
+        help='[required]\n path template of manual segmentations containing {sub}')
+    parser.add_argument(
+        '-p', '--prob', required=True, nargs='+', metavar='NAME=TEMPLATE',
+        help='[required]\n one or two algorithms and path templates of their probability maps containing {sub}'
+             '\n with two algorithms the union of both thresholded masks is evaluated for all threshold pairs')
+    parser.add_argument(
+        '--binary', nargs='+', default=[], metavar='NAME',
+        help='[optional]\n algorithms whose maps are binary masks (e.g. LOCATE); these are not thresholded')
+    parser.add_argument(
+        '--cluster-size', nargs='+', default=[], metavar='NAME=N',
+        help='[optional]\n remove clusters (26-connectivity) smaller than N voxels after thresholding (like cluster --osize; fslmaths -thr N)')
+    parser.add_argument(
+        '--ribbon', nargs='+', default=[], metavar='NAME=TEMPLATE',
+        help='[optional]\n path template of a mask (e.g. brain without ribbon) applied after thresholding')
+    parser.add_argument(
+        '-t', '--thresholds', nargs='+', type=float, default=THRESHOLDS,
+        help='[optional]\n ascending thresholds; default 0.05 ... 0.95')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n tidy CSV with columns sub, threshold_<NAME> ..., tp, fp, fn, dice, jaccard, fp_mm3, fn_mm3')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())),
+        help='[optional]\n number of worker processes; default $SLURM_CPUS_PER_TASK')
+    return parser
+
+
+def split_pairs(pairs):
+    return dict(pair.split("=", 1) for pair in pairs)
+
+
+##########
+# Levels #
+##########
+
+def levels(prob, thresholds, min_cluster=None, ribbon=None):
+    """Number of thresholds each voxel survives (0 ... len(thresholds)).
+
+    A voxel surviving a threshold also survives all lower thresholds, as its cluster there is a superset;
+    the level is therefore enough to reconstruct the mask of every threshold (level > threshold index).
+    """
+
+    prob = np.nan_to_num(prob)
+    level = np.searchsorted(thresholds, prob, side="right").astype(np.uint8)
+
+    if min_cluster and level.any():
+
+        # Restrict labelling to the bounding box of suprathreshold voxels
+        box = ndimage.find_objects((level > 0).astype(np.uint8))[0]
+        sub_level = level[box]
+        filtered = np.zeros_like(sub_level)
+        structure = ndimage.generate_binary_structure(3, 3)
+        for i in range(len(thresholds)):
+            passing = sub_level > i
+            if not passing.any():
+                break
+            labels, _ = ndimage.label(passing, structure)
+            sizes = np.bincount(labels.ravel())
+            sizes[0] = 0
+            filtered += sizes[labels] >= min_cluster
+        level[box] = filtered
+
+    if ribbon is not None:
+        level[ribbon <= 0] = 0
+
+    return level
+
+
+#########
+# Sweep #
+#########
+
+def load(path):
+    img = nib.load(path)
+    return np.asanyarray(img.dataobj, dtype=np.float32), float(np.prod(img.header.get_zooms()[:3]))
+
+
+def evaluate(sub, opts):
+    """Return tidy rows of subject `sub` or None if inputs are missing."""
+
+    manual_path = opts.manual.format(sub=sub)
+    paths = {name: template.format(sub=sub) for name, template in opts.prob.items()}
+    ribbons = {name: template.format(sub=sub) for name, template in opts.ribbon.items() if name in paths}
+
+    missing = [p for p in [manual_path, *paths.values(), *ribbons.values()] if not Path(p).exists()]
+    if missing:
+        print(f"{' '.join(missing)} not found. Skipping {sub} ...")
+        return None
+
+    manual, voxel_volume = load(manual_path)
+    manual = manual > 0
+
+    level_maps, thresholds = [], []
+    for name, path in paths.items():
+        prob, _ = load(path)
+        if prob.shape != manual.shape:
+            print(f"{path} has shape {prob.shape}, manual mask {manual.shape}. Skipping {sub} ...")
+            return None
+        if name in opts.binary:
+            thresh = [None]
+            level = (prob > 0).astype(np.uint8)
+        else:
+            thresh = opts.thresholds
+            min_cluster = int(opts.cluster_size[name]) if name in opts.cluster_size else None
+            ribbon = load(ribbons[name])[0] if name in ribbons else None
+            level = levels(prob, np.asarray(thresh), min_cluster, ribbon)
+        level_maps.append(level.ravel())
+        thresholds.append(thresh)
+
+    # Histogram of (combined) levels inside and outside the manual mask
+    shape = tuple(len(t) + 1 for t in thresholds)
+    flat = np.ravel_multi_index(level_maps, shape)
+    inside = np.bincount(flat[manual.ravel()], minlength=np.prod(shape)).reshape(shape)
+    outside = np.bincount(flat[~manual.ravel()], minlength=np.prod(shape)).reshape(shape)
+
+    # Voxels not in the (union) mask at threshold indices (i, j): all levels <= i (and <= j)
+    def positives(hist):
+        cum = hist
+        for axis in range(hist.ndim):
+            cum = cum.cumsum(axis=axis)
+        return hist.sum() - cum[tuple(slice(0, n - 1) for n in shape)]
+
+    tp = positives(inside)
+    fp = positives(outside)
+    fn = inside.sum() - tp
+
+    rows = []
+    for index in np.ndindex(tp.shape):
+        t_p, f_p, f_n = int(tp[index]), int(fp[index]), int(fn[index])
+        dice = 2 * t_p / (2 * t_p + f_p + f_n) if t_p + f_p + f_n else np.nan
+        jaccard = t_p / (t_p + f_p + f_n) if t_p + f_p + f_n else np.nan
+        rows.append([sub] + ["" if thresh[i] is None else f"{thresh[i]:g}" for thresh, i in zip(thresholds, index)]
+                    + [t_p, f_p, f_n, f"{dice:.6f}", f"{jaccard:.6f}",
+                       f"{f_p * voxel_volume:.6f}", f"{f_n * voxel_volume:.6f}"])
+    return rows
+
+
+def run(args):
+    sub, opts = args
+    return evaluate(sub, opts)
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    opts.prob = split_pairs(opts.prob)
+    opts.cluster_size = split_pairs(opts.cluster_size)
+    opts.ribbon = split_pairs(opts.ribbon)
+    opts.thresholds = sorted(opts.thresholds)
+
+    if not 1 <= len(opts.prob) <= 2:
+        raise SystemExit("Specify one or two algorithms via --prob")
+
+    with Pool(max(1, min(opts.jobs, len(opts.subjects)))) as pool:
+        results = pool.map(run, [(sub, opts) for sub in opts.subjects], chunksize=1)
+
+    output = Path(opts.output)
+    tmp = output.with_name(".tmp_" + output.name)
+    with open(tmp, "w") as f:
+        f.write(",".join(["sub"] + [f"threshold_{name}" for name in opts.prob]
+                         + ["tp", "fp", "fn", "dice", "jaccard", "fp_mm3", "fn_mm3"]) + "\n")
+        for rows in results:
+            for row in rows or []:
+                f.write(",".join(map(str, row)) + "\n")
+    os.replace(tmp, output)
+
+    print(f"Evaluated {sum(r is not None for r in results)} of {len(opts.subjects)} subjects. Written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,9 @@
 #       - fmriprep 
 #       - wmh_01_prep
 #       - wmh_02_segment                                                                                                   
-#   [container]                                                                                                   
-#       - fsl-6.0.3.sif
-#       - freesurfer-7.1.1.sif     
-#       - mrtrix3-3.0.2    
-#       - antsrnet
+#   [container and code]                                                                                                   
+#       - miniconda-csi
+#       - overlap_eval.py
 #                                                                           
 ###################################################################################################################
 
@@ -30,18 +28,14 @@ TMP_OUT=$TMP_DIR/output;               [ ! -d $TMP_OUT ] && mkdir -p $TMP_OUT
 # Pipeline-specific environment
 ##################################
 # Singularity container version and command
-container_freesurfer=freesurfer-7.1.1
-singularity_freesurfer="singularity run --cleanenv --userns \
+container_miniconda=miniconda-csi
+singularity_miniconda="singularity run --cleanenv --userns \
     -B $PROJ_DIR/../ \
     -B $(readlink -f $ENV_DIR) \
     -B $TMP_DIR/:/tmp \
     -B $TMP_IN:/tmp_in \
     -B $TMP_OUT:/tmp_out \
-    $ENV_DIR/$container_freesurfer" 
-
-# $MRTRIX_TMPFILE_DIR should be big and writable
-export MRTRIX_TMPFILE_DIR=/tmp
-
+    $ENV_DIR/$container_miniconda" 
 
 ###################################################################################################################
 # Pipeline execution
@@ -54,34 +48,24 @@ OUT_DIR_der=$DATA_DIR/$PIPELINE/derivatives/$ALGORITHM
 dice_indexfile=$OUT_DIR_der/diceindex_${ALGORITHM}.csv
 jaccard_indexfile=$OUT_DIR_der/jaccardindex_${ALGORITHM}.csv
 
-[ -f $dice_indexfile ] && rm $dice_indexfile
-[ -f $jaccard_indexfile ] && rm $jaccard_indexfile
-
-for sub in $(ls $DATA_DIR/$PIPELINE/sub-* -d | xargs -n 1 basename); do 
-
-    # Set output directories
-    ALGORITHM_OUT_DIR=$DATA_DIR/$PIPELINE/$sub/ses-${SESSION}/anat/$ALGORITHM
-    OUT_DIR=$ALGORITHM_OUT_DIR/eval
-    [ ! -d $OUT_DIR ] && mkdir -p $OUT_DIR
-    
-    # Define inputs
-    SEGMENTATION=$ALGORITHM_OUT_DIR/${sub}_ses-${SESSION}_space-FLAIR_desc-masked_desc-wmh_desc-${ALGORITHM}_mask.nii.gz
-    SEGMENTATION_MAN=$MAN_SEGMENTATION_DIR/$sub/anat/${sub}_DC_FLAIR_label3.nii.gz
-            
-    # Define outputs
-    JSON_FILE_DICE=$OUT_DIR/${sub}_ses-${SESSION}_desc-diceindex_desc-${ALGORITHM}.txt
-    JSON_FILE_JACCARD=$OUT_DIR/${sub}_ses-${SESSION}_desc-jaccardindex_desc-${ALGORITHM}.txt
-    
+metrics_file=$OUT_DIR_der/metrics_${ALGORITHM}.csv
 
-    # Define commands
-    CMD_CALCULATE_DICE="mri_seg_overlap -x $SEGMENTATION $SEGMENTATION_MAN -o $JSON_FILE_DICE"
-    CMD_CALCULATE_JACCARD="mri_seg_overlap -x -m jaccard $SEGMENTATION $SEGMENTATION_MAN -o $JSON_FILE_JACCARD"
+# Define inputs
+# Templates are filled with each subject id by overlap_eval.py
+SUBJECTS=$(ls $DATA_DIR/$PIPELINE/sub-* -d | xargs -n 1 basename)
+SEGMENTATION="$DATA_DIR/$PIPELINE/{sub}/ses-${SESSION}/anat/$ALGORITHM/{sub}_ses-${SESSION}_space-FLAIR_desc-masked_desc-wmh_desc-${ALGORITHM}_mask.nii.gz"
+SEGMENTATION_MAN="$MAN_SEGMENTATION_DIR/{sub}/anat/{sub}_DC_FLAIR_label3.nii.gz"
 
-    # Execute
-    $singularity_freesurfer /bin/bash -c "$CMD_CALCULATE_DICE; $CMD_CALCULATE_JACCARD"
-    dice_value=$(cat $JSON_FILE_DICE| grep '"mean":' | awk '{print $2}')
-    jaccard_value=$(cat $JSON_FILE_JACCARD| grep '"mean":' | awk '{print $2}')
-    echo "$sub,$dice_value" >> $dice_indexfile
-    echo "$sub,$jaccard_value" >> $jaccard_indexfile
+# Define commands
+# Dice, Jaccard, volume difference, lesion-wise detection and Hausdorff distance of all subjects in one process pool
+CMD_EVAL="python $PIPELINE_DIR/overlap_eval.py \
+    -s $SUBJECTS \
+    -m $SEGMENTATION_MAN \
+    -i $SEGMENTATION \
+    -o $metrics_file \
+    --dice $dice_indexfile \
+    --jaccard $jaccard_indexfile \
+    -j $SLURM_CPUS_PER_TASK"
 
-done
\ No newline at end of file
+# Execute
+$singularity_miniconda $CMD_EVAL
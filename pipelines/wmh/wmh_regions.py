@@ -0,0 +1,197 @@
+# Periventricular/deep split, NAWM masks and WMH volumes of wmh_04_postproc in FLAIR, T1 and MNI space
+#
+# split:   for one subject, loads the WMH segmentation, white matter, periventricular and deep white matter masks of
+#          every space once, binarizes the segmentations registered to T1 and MNI space and writes the wmhperi, wmhdeep
+#          and nawm masks (formerly one fslmaths call each). WMH, periventricular, deep WMH and NAWM volumes of all
+#          spaces are written as one row to <sub>_ses-<ses>_desc-wmh_desc-<ALGORITHM>_volumes.csv (replaces fslstats -V)
+# combine: gathers the rows of the given subjects (those of the group level job) into one group CSV
+#
+# Inputs and outputs follow the wmh layout, <wmh_dir>/<sub>/ses-<ses>/anat/:
+#   <sub>_ses-<ses>_space-<space>_desc-{wm,wmperi,wmdeep}_mask.nii.gz                                  (01_prep)
+#   <ALGORITHM>/<sub>_ses-<ses>_space-<space>_desc-masked_desc-wmh_desc-<ALGORITHM>_mask.nii.gz
+#   <ALGORITHM>/<sub>_ses-<ses>_space-<space>_desc-masked_desc-{wmhperi,wmhdeep,nawm}_desc-<ALGORITHM>_mask.nii.gz
+#
+# execute e.g. via
+# python wmh_regions.py split -d data/wmh --sub sub-001 --ses 1 -a LOCATE
+# python wmh_regions.py combine -d data/wmh --ses 1 -a LOCATE -s sub-001 sub-002 -o data/wmh/derivatives/ses-1_desc-wmh_desc-LOCATE_volumes.csv
+# with a python environment containing numpy and nibabel
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import csv
+import os
+import numpy as np
+import nibabel as nib
+
+SPACES = ("FLAIR", "T1", "MNI")
+REGIONS = ("wmh", "wmhperi", "wmhdeep", "nawm")
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Split WMH into periventricular and deep WMH, create NAWM masks and read out volumes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split = subparsers.add_parser(
+        'split', formatter_class=RawTextHelpFormatter,
+        help='masks and volumes of one subject in all spaces')
+    combine = subparsers.add_parser(
+        'combine', formatter_class=RawTextHelpFormatter,
+        help='group CSV of the volumes of all subjects')
+
+    for subparser in (split, combine):
+        subparser.add_argument(
+            '-d', '--wmh-dir', required=True,
+            help='[required]\n wmh directory, e.g. data/wmh')
+        subparser.add_argument(
+            '--ses', required=True,
+            help='[required]\n session, e.g. 1')
+        subparser.add_argument(
+            '-a', '--algorithm', required=True,
+            help='[required]\n segmentation algorithm (directory), e.g. LOCATE or lpaXLOCATE')
+
+    split.add_argument(
+        '--sub', required=True,
+        help='[required]\n subject, e.g. sub-001')
+    split.add_argument(
+        '--spaces', nargs='+', default=list(SPACES), choices=SPACES,
+        help='[optional]\n spaces; default FLAIR T1 MNI')
+    combine.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subjects (e.g. sub-001) or a file with one subject per line')
+    combine.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n group CSV')
+    return parser
+
+
+def volume_csv(wmh_dir, sub, ses, algorithm):
+    return Path(wmh_dir) / sub / f"ses-{ses}" / "anat" / algorithm / f"{sub}_ses-{ses}_desc-wmh_desc-{algorithm}_volumes.csv"
+
+
+def write_csv(path, header, rows):
+    tmp = path.with_name(".tmp_" + path.name)
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp, path)
+
+
+#########
+# Split #
+#########
+
+def load_mask(path):
+    """Mask (> 0) and image of a NIfTI, or None if it does not exist."""
+
+    if not path.exists():
+        print(f"{path} not found")
+        return None, None
+    img = nib.load(path)
+    return np.asanyarray(img.dataobj) > 0, img
+
+
+def save_mask(mask, img, path):
+    header = img.header.copy()
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1, 0)
+    tmp = path.with_name(".tmp_" + path.name)
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), img.affine, header), tmp)
+    os.replace(tmp, path)
+
+
+def split_space(anat_dir, prefix, algorithm, space):
+    """Region masks and volumes (mm3) of one space; volumes are None for missing inputs."""
+
+    def mask_path(desc):
+        return anat_dir / f"{prefix}_space-{space}_desc-{desc}_mask.nii.gz"
+
+    def wmh_path(desc):
+        return anat_dir / algorithm / f"{prefix}_space-{space}_desc-masked_desc-{desc}_desc-{algorithm}_mask.nii.gz"
+
+    wmh, img = load_mask(wmh_path("wmh"))
+    if wmh is None:
+        return dict.fromkeys(REGIONS)
+    masks = {"wmh": wmh}
+    # Segmentations registered to T1 and MNI space (antsApplyTransforms) are binarized in place, as fslmaths -bin
+    if space != "FLAIR":
+        save_mask(wmh, img, wmh_path("wmh"))
+
+    for region, desc in (("wmhperi", "wmperi"), ("wmhdeep", "wmdeep"), ("nawm", "wm")):
+        mask, _ = load_mask(mask_path(desc))
+        if mask is None:
+            continue
+        masks[region] = wmh & mask if region != "nawm" else mask & ~wmh
+        save_mask(masks[region], img, wmh_path(region))
+
+    voxel_volume = abs(np.linalg.det(img.affine[:3, :3]))
+    return {region: np.count_nonzero(masks[region]) * voxel_volume if region in masks else None for region in REGIONS}
+
+
+def split(opts):
+
+    anat_dir = Path(opts.wmh_dir) / opts.sub / f"ses-{opts.ses}" / "anat"
+    prefix = f"{opts.sub}_ses-{opts.ses}"
+
+    header, row = ["sub_id"], [opts.sub]
+    for space in opts.spaces:
+        volumes = split_space(anat_dir, prefix, opts.algorithm, space)
+        for region, volume in volumes.items():
+            header.append(f"{region}_{space}_volume")
+            row.append("" if volume is None else f"{volume:.6g}")
+
+    output = volume_csv(opts.wmh_dir, opts.sub, opts.ses, opts.algorithm)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    write_csv(output, header, [row])
+    print(f"Region masks and volumes of {opts.sub} written to {output}")
+
+
+###########
+# Combine #
+###########
+
+def combine(opts):
+
+    subjects = opts.subjects
+    if len(subjects) == 1 and Path(subjects[0]).is_file():
+        subjects = Path(subjects[0]).read_text().split()
+
+    paths = [volume_csv(opts.wmh_dir, sub, opts.ses, opts.algorithm) for sub in subjects]
+    missing = [path for path in paths if not path.exists()]
+    paths = [path for path in paths if path.exists()]
+    if not paths:
+        raise SystemExit(f"No volumes of {opts.algorithm} in {opts.wmh_dir}; run the subject level first")
+    if missing:
+        print(f"No volumes of {len(missing)} subjects, e.g. {missing[0]}")
+
+    header, rows = ["sub_id"], []
+    for path in paths:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                header += [column for column in row if column not in header]
+                rows.append(row)
+
+    output = Path(opts.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    write_csv(output, header, [[row.get(column, "") for column in header] for row in rows])
+    print(f"WMH volumes of {len(rows)} subjects written to {output}")
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+    if opts.command == "split":
+        split(opts)
+    elif opts.command == "combine":
+        combine(opts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+# Node-local cache of read-only assets (container images, templates, atlases)
+# Assets on the shared filesystem ($ENV_DIR images, $ENV_DIR/standard, atlases in pipelines/) are staged once per node
+# into $ASSET_CACHE_DIR, which outlives the job (unlike $SCRATCH_DIR), so all concurrent and following jobs of the user
+# on the node read the local copy. Copies are verified against the checksum computed while reading the source; an
+# entry is restaged when size or mtime of its source change.
+# Staging is serialized per asset by file locks, the index (index.json) by a cache-wide lock. If the cache exceeds
+# $ASSET_CACHE_QUOTA_GB, least recently used entries are evicted, except for those pinned by running jobs
+# (pins/<jobid>, removed via `release` at job end). If an asset cannot be cached (no space, ASSET_CACHE=n), its source
+# path is used.
+#
+# 02_pipelines_batch.sh exports ASSET_PATH="python3 <this script> path", so pipeline scripts can resolve assets, e.g.
+#   [ -n "$ASSET_PATH" ] && SKELETON_MASK=$($ASSET_PATH $SKELETON_MASK)
+# utils/container_instances.sh resolves container images through the cache and binds $ASSET_CACHE_DIR.
+#
+# execute e.g. via
+# python3 asset_cache.py path $ENV_DIR/fsl-6.0.3 $ENV_DIR/standard/FMRIB58_FA_1mm.nii.gz
+# python3 asset_cache.py prefetch --script pipelines/psmd/psmd_csi.sh
+# python3 asset_cache.py status | verify | release
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from contextlib import contextmanager
+from pathlib import Path
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+
+CACHE_DIR = Path(os.environ.get("ASSET_CACHE_DIR", f"/scratch/{os.environ.get('USER', 'user')}.asset_cache"))
+ENV_DIR = Path(os.environ.get("ENV_DIR", Path(__file__).resolve().parents[2] / "envs"))
+# Pins of jobs killed before their release are ignored after the maximum walltime
+PIN_TTL = 7 * 24 * 3600
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Stage read-only assets into a node-local cache and resolve their paths')
+    parser.add_argument(
+        '--cache-dir', default=str(CACHE_DIR),
+        help='[optional]\n cache directory; default $ASSET_CACHE_DIR or /scratch/$USER.asset_cache')
+    parser.add_argument(
+        '--quota', type=float, default=float(os.environ.get("ASSET_CACHE_QUOTA_GB", 50)),
+        help='[optional]\n cache size in GB before least recently used entries are evicted; default $ASSET_CACHE_QUOTA_GB or 50')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    path = commands.add_parser('path', formatter_class=RawTextHelpFormatter, help='print cached paths of assets, staging them if needed')
+    path.add_argument(
+        'assets', nargs='+',
+        help='[required]\n files or directories on the shared filesystem')
+
+    prefetch = commands.add_parser('prefetch', formatter_class=RawTextHelpFormatter, help='stage assets without printing paths')
+    prefetch.add_argument(
+        'assets', nargs='*',
+        help='[optional]\n files or directories on the shared filesystem')
+    prefetch.add_argument(
+        '--script',
+        help='[optional]\n processing script whose container images (container_<name>=<image>) are staged')
+
+    commands.add_parser('status', help='print cached entries, least recently used first')
+    commands.add_parser('verify', help='recompute checksums of all entries and drop corrupt ones')
+    commands.add_parser('release', help='unpin the entries used by this job ($SLURM_JOBID)')
+    return parser
+
+
+#########
+# Locks #
+#########
+
+@contextmanager
+def locked(path, blocking=True):
+    """Exclusive flock on `path`; yields False if not blocking and the lock is held elsewhere."""
+
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Cache:
+
+    def __init__(self, cache_dir, quota_gb):
+        self.dir = Path(cache_dir)
+        self.quota = quota_gb * 1024 ** 3
+        (self.dir / "pins").mkdir(parents=True, exist_ok=True)
+        self.index_path = self.dir / "index.json"
+        self.lock_path = self.dir / ".lock"
+
+    def read_index(self):
+        if not self.index_path.exists():
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def write_index(self, index):
+        tmp = self.index_path.with_name(".tmp_" + self.index_path.name)
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    @contextmanager
+    def index(self):
+        """Index for reading and modifying under the cache-wide lock."""
+
+        with locked(self.lock_path):
+            index = self.read_index()
+            yield index
+            self.write_index(index)
+
+    ########
+    # Pins #
+    ########
+
+    def pin(self, key):
+        job = os.environ.get("SLURM_JOBID")
+        if job:
+            with open(self.dir / "pins" / job, "a") as f:
+                f.write(key + "\n")
+
+    def pinned(self):
+        keys = set()
+        for pin in (self.dir / "pins").iterdir():
+            if time.time() - pin.stat().st_mtime > PIN_TTL:
+                pin.unlink(missing_ok=True)
+                continue
+            keys.update(pin.read_text().split())
+        return keys
+
+    def release(self):
+        job = os.environ.get("SLURM_JOBID")
+        if job:
+            (self.dir / "pins" / job).unlink(missing_ok=True)
+
+    ###########
+    # Staging #
+    ###########
+
+    def resolve(self, source):
+        """Path of the cached copy of `source`; `source` itself if it cannot be cached."""
+
+        source = Path(source).resolve()
+        if not source.exists():
+            return source
+
+        key = hashlib.sha1(str(source).encode()).hexdigest()[:16]
+        entry_dir = self.dir / key
+        target = entry_dir / source.name
+        state = source_state(source)
+
+        with locked(self.dir / f"{key}.lock"):
+            with self.index() as index:
+                entry = index.get(key)
+                if entry and entry["state"] == state and target.exists():
+                    entry["accessed"] = time.time()
+                    self.pin(key)
+                    return target
+                if not self.make_room(index, state["size"], keep=key):
+                    print(f"Not enough space in {self.dir} to cache {source}. Using shared copy.", file=sys.stderr)
+                    return source
+                index.pop(key, None)
+
+            # Copy outside the cache-wide lock; other assets are staged concurrently
+            start = time.time()
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            entry_dir.mkdir(parents=True)
+            tmp = entry_dir / (".tmp_" + source.name)
+            try:
+                checksum = copy(source, tmp)
+                if digest(tmp) != checksum:
+                    raise OSError(f"checksum mismatch of copy of {source}")
+                os.replace(tmp, target)
+            except OSError as error:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                print(f"Cannot cache {source} ({error}). Using shared copy.", file=sys.stderr)
+                return source
+
+            with self.index() as index:
+                index[key] = {"source": str(source), "path": str(target), "state": state, "checksum": checksum,
+                              "staged": time.time(), "accessed": time.time()}
+            self.pin(key)
+            print(f"Staged {source} ({state['size'] / 1024 ** 2:.0f} MB) in {time.time() - start:.0f} s", file=sys.stderr)
+        return target
+
+    def make_room(self, index, size, keep):
+        """Evict least recently used, unpinned entries until `size` bytes fit; False if impossible."""
+
+        if size > self.quota:
+            return False
+        used = sum(entry["state"]["size"] for other, entry in index.items() if other != keep)
+        pinned = self.pinned()
+        for key in sorted(index, key=lambda key: index[key]["accessed"]):
+            if used + size <= self.quota:
+                break
+            if key == keep or key in pinned:
+                continue
+            with locked(self.dir / f"{key}.lock", blocking=False) as free:
+                if not free:
+                    continue
+                shutil.rmtree(self.dir / key, ignore_errors=True)
+                entry = index.pop(key)
+                used -= entry["state"]["size"]
+                print(f"Evicted {entry['source']} from asset cache", file=sys.stderr)
+        return used + size <= self.quota and shutil.disk_usage(self.dir).free > size
+
+
+#############
+# Checksums #
+#############
+
+def files_of(path):
+    if path.is_file():
+        return [path]
+    return sorted(p for p in path.rglob("*") if p.is_file())
+
+
+def source_state(source):
+    files = files_of(source)
+    return {"size": sum(f.stat().st_size for f in files), "mtime_ns": max((f.stat().st_mtime_ns for f in files), default=0),
+            "files": len(files)}
+
+
+def digest(path):
+    """sha1 over relative paths and contents of all files of `path`."""
+
+    sha = hashlib.sha1()
+    for f in files_of(path):
+        sha.update(str(f.relative_to(path)).encode() if f != path else b"")
+        with open(f, "rb") as handle:
+            for block in iter(lambda: handle.read(2 ** 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def copy(source, target):
+    """Copy `source` (file or directory) to `target`; checksum of the source as read."""
+
+    if source.is_dir():
+        shutil.copytree(source, target, symlinks=False)
+        return digest(source)
+
+    sha = hashlib.sha1()
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        for block in iter(lambda: src.read(2 ** 20), b""):
+            sha.update(block)
+            dst.write(block)
+    shutil.copystat(source, target)
+    return sha.hexdigest()
+
+
+############
+# Commands #
+############
+
+def main():
+
+    opts = get_parser().parse_args()
+    try:
+        cache = Cache(opts.cache_dir, opts.quota)
+    except OSError as error:
+        print(f"Asset cache {opts.cache_dir} not available ({error}). Using shared copies.", file=sys.stderr)
+        cache = None
+
+    if cache is None or os.environ.get("ASSET_CACHE") == "n":
+        if opts.command == "path":
+            print("\n".join(str(Path(asset).resolve()) for asset in opts.assets))
+
+    elif opts.command == "path":
+        for asset in opts.assets:
+            print(cache.resolve(asset))
+
+    elif opts.command == "prefetch":
+        assets = list(opts.assets)
+        if opts.script:
+            script = Path(opts.script).read_text() if Path(opts.script).exists() else ""
+            assets += [ENV_DIR / image for image in sorted(set(re.findall(r"^\s*container_\w+=(\S+)", script, re.M)))]
+        for asset in assets:
+            cache.resolve(asset)
+
+    elif opts.command == "status":
+        index = cache.read_index()
+        pinned = cache.pinned()
+        total = sum(entry["state"]["size"] for entry in index.values())
+        print(f"{cache.dir}: {len(index)} entries, {total / 1024 ** 3:.1f} of {opts.quota:.0f} GB")
+        for key in sorted(index, key=lambda key: index[key]["accessed"]):
+            entry = index[key]
+            print(f"  {time.strftime('%d.%m.%Y %H:%M', time.localtime(entry['accessed']))}  "
+                  f"{entry['state']['size'] / 1024 ** 2:9.0f} MB  {'pinned' if key in pinned else '      '}  {entry['source']}")
+
+    elif opts.command == "verify":
+        with cache.index() as index:
+            for key in list(index):
+                with locked(cache.dir / f"{key}.lock", blocking=False) as free:
+                    if free and (not Path(index[key]["path"]).exists() or digest(Path(index[key]["path"])) != index[key]["checksum"]):
+                        print(f"Dropping corrupt entry {index[key]['source']}")
+                        shutil.rmtree(cache.dir / key, ignore_errors=True)
+                        del index[key]
+
+    elif opts.command == "release":
+        cache.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# Cached completion index of the dataset (replaces shell-glob scans of qa_missings and diff -q of missing_outputs)
+# Directory listings of data/ are cached together with directory mtimes; later runs only stat directories and
+# re-read those whose mtime changed. Completion of outputs is derived from the cached listings and stored as a
+# per-session, per-subject, per-pipeline matrix in the index.
+#
+# execute e.g. via
+# python3 completion_index.py qa --session 1      (writes data/raw_bids/derivatives/qa-raw_bids.csv and missing lists)
+# python3 completion_index.py missing --datasets fmriprep --template raw_bids [--search dwi.nii.gz]
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from fnmatch import fnmatch
+from pathlib import Path
+import json
+import os
+import time
+
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+CODE_DIR = SCRIPT_DIR.parent
+DATA_DIR = Path(os.environ.get("DATA_DIR", CODE_DIR.parent / "data"))
+
+# Outputs checked by qa_missings; paths relative to data/ with {sub} (without "sub-") and {ses}
+CHECKS = [
+    ("missing_flair", "raw_bids/sub-{sub}/ses-{ses}/anat/sub-{sub}_ses-{ses}_FLAIR.nii.gz"),
+    ("missing_t1", "raw_bids/sub-{sub}/ses-{ses}/anat/sub-{sub}_ses-{ses}_T1w.nii.gz"),
+    ("missing_t2", "raw_bids/sub-{sub}/ses-{ses}/anat/sub-{sub}_ses-{ses}_T2w.nii.gz"),
+    ("missing_dwi", "raw_bids/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_acq-AP_dwi.nii.gz"),
+    ("missing_func", "raw_bids/sub-{sub}/ses-{ses}/func/sub-{sub}_ses-{ses}_task-rest_bold.nii.gz"),
+    ("missing_asl", "raw_bids/sub-{sub}/ses-{ses}/perf/sub-{sub}_ses-{ses}_asl.nii.gz"),
+    ("missing_m0", "raw_bids/sub-{sub}/ses-{ses}/perf/sub-{sub}_ses-{ses}_m0scan.nii.gz"),
+    ("missing_aslprep", "aslprep/sub-{sub}/ses-{ses}/perf/sub-{sub}_ses-{ses}_space-MNI152NLin2009cAsym_desc-basil_cbf.nii.gz"),
+    ("missing_cat", "cat12/sub-{sub}/surf/rh.thickness.T1"),
+    ("missing_conn_struc", "connectomics/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_*_sc_sift_connectomics.csv"),
+    ("missing_conn_func", "connectomics/sub-{sub}/ses-{ses}/func/sub-{sub}_ses-{ses}_*_connectomics.csv"),
+    ("missing_fba", "fba/derivatives/fdc_smooth/sub-{sub}.mif"),
+    ("missing_fmriprep_struc", "fmriprep/sub-{sub}/ses-{ses}/anat/sub-{sub}_ses-{ses}_desc-preproc_T1w.nii.gz"),
+    ("missing_fmriprep_func", "fmriprep/sub-{sub}/ses-{ses}/func/sub-{sub}_ses-{ses}_task-rest_desc-preproc_bold.nii.gz"),
+    ("missing_freesurfer", "freesurfer/sub-{sub}/stats/aseg.stats"),
+    ("missing_freewater", "freewater/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_space-MNI_FW.nii.gz"),
+    ("missing_mriqcstruc", "mriqc/sub-{sub}/ses-{ses}/anat/sub-{sub}_ses-{ses}_T1w.json"),
+    ("missing_mriqcfunc", "mriqc/sub-{sub}/ses-{ses}/func/sub-{sub}_ses-{ses}_task-rest_bold.json"),
+    ("missing_obseg", "obseg/sub-{sub}/stats/segmentation_stats.csv"),
+    ("missing_psmd", "psmd*/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_psmd.csv"),
+    ("missing_qsiprep", "qsiprep/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_acq-AP_space-T1w_desc-preproc_dwi.nii.gz"),
+    ("missing_qsirecon", "qsirecon/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_acq-AP_space-T1w_desc-preproc_space-T1w_dhollanderconnectome.mat"),
+    ("missing_tbss", "tbss_*/sub-{sub}/ses-{ses}/dwi/sub-{sub}_ses-{ses}_space-MNI_desc-eroded_desc-DTINoNeg_FA.nii.gz"),
+    ("missing_wmh", "wmh/sub-{sub}/ses-{ses}/anat/sub-{sub}_ses-{ses}_space-FLAIR_desc-masked_desc-wmhperi_desc-*_mask.nii.gz"),
+    ("missing_xcpengine", "xcpengine/sub-{sub}/fcon/schaefer400x7/sub-{sub}_schaefer400x7_network.txt"),
+]
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Find missing raw data and pipeline outputs from a cached index of data/')
+    parser.add_argument(
+        '--data-dir', default=str(DATA_DIR),
+        help='[optional]\n data directory; default $DATA_DIR')
+    parser.add_argument(
+        '--index', default=str(CODE_DIR / "log" / "completion_index.json"),
+        help='[optional]\n index file with cached directory listings; default code/log/completion_index.json')
+    parser.add_argument(
+        '--rescan', action='store_true',
+        help='[optional]\n ignore cached listings and read all directories again')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    qa = commands.add_parser('qa', formatter_class=RawTextHelpFormatter, help='completion matrix of raw data and pipeline outputs')
+    qa.add_argument(
+        '--session', required=True,
+        help='[required]\n session (e.g. 1)')
+    qa.add_argument(
+        '--participants',
+        help='[optional]\n subject list; default data/raw_bids/sourcedata/participants.tsv')
+    qa.add_argument(
+        '--output',
+        help='[optional]\n completion CSV; default data/raw_bids/derivatives/qa-raw_bids.csv')
+    qa.add_argument(
+        '--missing-dir', default=str(CODE_DIR / "log" / "missing"),
+        help='[optional]\n directory for subject lists per missing output; default code/log/missing')
+
+    missing = commands.add_parser('missing', formatter_class=RawTextHelpFormatter, help='subjects missing in subdatasets')
+    missing.add_argument(
+        '--datasets', required=True, nargs='+',
+        help='[required]\n subdatasets in data/ to look for missing outputs (e.g. fmriprep mriqc)')
+    missing.add_argument(
+        '--template', default='raw_bids',
+        help='[optional]\n subdataset in data/ to read subject names from; default raw_bids')
+    missing.add_argument(
+        '--search',
+        help='[optional]\n string a file within the subject directory has to contain; without only subject directories are compared')
+    missing.add_argument(
+        '--output', required=True,
+        help='[required]\n subject list')
+    return parser
+
+
+#########
+# Index #
+#########
+
+class Index:
+    """Directory listings of data/ cached by directory mtime."""
+
+    def __init__(self, data_dir, path, rescan=False):
+        self.data_dir = Path(data_dir)
+        self.path = Path(path)
+        self.state = {"dirs": {}, "completion": {}}
+        if self.path.exists() and not rescan:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        self.seen = {}
+        self.scanned = self.reused = 0
+
+    def listing(self, rel):
+        """Entries of directory `rel` (relative to data/) as {name: 'd'|'f'|'o'}; re-read only if its mtime changed."""
+
+        if rel in self.seen:
+            return self.seen[rel]
+
+        try:
+            mtime = os.stat(self.data_dir / rel).st_mtime_ns
+        except OSError:
+            self.state["dirs"].pop(rel, None)
+            self.seen[rel] = {}
+            return {}
+
+        cached = self.state["dirs"].get(rel)
+        if cached is not None and cached[0] == mtime:
+            self.reused += 1
+            entries = cached[1]
+        else:
+            self.scanned += 1
+            entries = {}
+            with os.scandir(self.data_dir / rel) as it:
+                for entry in it:
+                    try:
+                        entries[entry.name] = "d" if entry.is_dir() else "f" if entry.is_file() else "o"
+                    except OSError:
+                        entries[entry.name] = "o"
+            # Directories modified within the last seconds may change again within the same mtime; re-read next time
+            recent = time.time_ns() - mtime < 2 * 10 ** 9
+            self.state["dirs"][rel] = [None if recent else mtime, entries]
+
+        self.seen[rel] = entries
+        return entries
+
+    def glob(self, pattern):
+        """First file matching `pattern` (relative to data/, glob characters allowed in every component) or None."""
+
+        parts = pattern.split("/")
+        matches = [""]
+        for depth, part in enumerate(parts):
+            last = depth == len(parts) - 1
+            next_matches = []
+            for rel in matches:
+                entries = self.listing(rel)
+                if any(c in part for c in "*?["):
+                    names = sorted(name for name in entries if fnmatch(name, part))
+                else:
+                    names = [part] if part in entries else []
+                wanted = "f" if last else "d"
+                next_matches += [f"{rel}/{name}".lstrip("/") for name in names if entries[name] == wanted]
+            matches = next_matches
+            if not matches:
+                return None
+        return matches[0]
+
+    def walk(self, rel):
+        """All files below directory `rel`."""
+
+        for name, kind in self.listing(rel).items():
+            path = f"{rel}/{name}"
+            if kind == "d":
+                yield from self.walk(path)
+            elif kind == "f":
+                yield path
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(".tmp_" + self.path.name)
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+        print(f"Index: read {self.scanned} directories, reused {self.reused} unchanged listings ({self.path})")
+
+
+def subjects_in(index, dataset):
+    return sorted(name for name, kind in index.listing(dataset).items() if kind == "d" and name.startswith("sub-"))
+
+
+############
+# Commands #
+############
+
+def qa(opts, index):
+
+    bids_dir = Path(opts.data_dir) / "raw_bids"
+    participants = Path(opts.participants or bids_dir / "sourcedata" / "participants.tsv")
+    output = Path(opts.output or bids_dir / "derivatives" / "qa-raw_bids.csv")
+    ses = opts.session
+
+    with open(participants) as f:
+        subjects = [token[4:] if token.startswith("sub-") else token for token in f.read().split()]
+
+    completion = index.state["completion"].setdefault(f"ses-{ses}", {})
+    rows = []
+    for sub in subjects:
+        missing = {column: int(index.glob(pattern.format(sub=sub, ses=ses)) is None) for column, pattern in CHECKS}
+        completion[f"sub-{sub}"] = {column[len("missing_"):]: 1 - value for column, value in missing.items()}
+        rows.append([f"sub-{sub}", f"ses-{ses}"] + [str(missing[column]) for column, _ in CHECKS])
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        f.write(" ".join(["subjectID", "SESSION"] + [column for column, _ in CHECKS]) + "\n")
+        f.writelines(" ".join(row) + "\n" for row in rows)
+    print(f"Completion of {len(subjects)} subjects written to {output}")
+
+    # Subject lists per missing output, ready to be passed to 01_pipelines_submission.sh
+    missing_dir = Path(opts.missing_dir)
+    missing_dir.mkdir(parents=True, exist_ok=True)
+    for i, (column, _) in enumerate(CHECKS):
+        missing_subjects = [row[0] for row in rows if row[2 + i] == "1"]
+        with open(missing_dir / f"{column}_ses-{ses}.txt", "w") as f:
+            f.writelines(sub + "\n" for sub in missing_subjects)
+        print(f"  {column:25s} {len(missing_subjects):6d}")
+    print(f"Subject lists written to {missing_dir}; resubmit e.g. via 'bash 01_pipelines_submission.sh $(cat {missing_dir}/missing_qsiprep_ses-{ses}.txt)'")
+
+
+def missing(opts, index):
+
+    template = subjects_in(index, opts.template)
+    result = set()
+
+    for dataset in opts.datasets:
+        present = set(subjects_in(index, dataset))
+        if opts.search:
+            present = {sub for sub in present if any(opts.search in path for path in index.walk(f"{dataset}/{sub}"))}
+        result |= set(template) - present
+
+    with open(opts.output, "w") as f:
+        f.writelines(sub + "\n" for sub in sorted(result))
+    print(f"{len(result)} of {len(template)} subjects missing in {' '.join(opts.datasets)}. Written to {opts.output}")
+
+
+def main():
+
+    opts = get_parser().parse_args()
+    index = Index(opts.data_dir, opts.index, opts.rescan)
+    {"qa": qa, "missing": missing}[opts.command](opts, index)
+    index.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env bash
+
+###################################################################################################################
+# Persistent singularity instances per container image and node
+#
+# Instead of paying the container startup for every tool call, one instance per image is started on first use
+# and shared by all subjects processed on the node. Instances are stopped at the end of the job.
+#
+# Usage:
+#   container_instances.sh run <container> [command ...]    e.g. container_instances.sh run fsl-6.0.3 fslstats ...
+#   container_instances.sh report                           startup time saved (requires CONTAINER_TIMING=y)
+#   container_instances.sh stop                             stop all instances of this job
+#
+# 02_pipelines_batch.sh exports CONTAINER_RUN="<this script> run", so pipeline scripts can define e.g.
+#   singularity_fsl="$CONTAINER_RUN $container_fsl"
+#
+# Instances bind $PROJ_DIR, $ENV_DIR and $SCRATCH_DIR at their host paths; /tmp is a job-wide directory on
+# $SCRATCH_DIR. Every call runs with a clean environment, as `singularity run --cleanenv`, and with TMPDIR and
+# MRTRIX_TMPFILE_DIR set to the scratch directory of the calling subject ($TMP_DIR on $SCRATCH_DIR, else a directory
+# of its own), so parallel subjects do not share temporary files. Calls relying on subject specific bind targets
+# (/tmp_in, /tmp_out) must keep using `singularity run` with their own binds.
+# With CONTAINER_INSTANCES=n (or if an instance cannot be started) calls fall back to `singularity run`.
+###################################################################################################################
+
+INSTANCE_DIR=$SCRATCH_DIR/container_instances; [ ! -d $INSTANCE_DIR/tmp ] && mkdir -p $INSTANCE_DIR/tmp
+TIMING_LOG=$INSTANCE_DIR/timing.log
+
+singularity_binds="--cleanenv --no-home --userns \
+    -B $PROJ_DIR \
+    -B $(readlink -f $ENV_DIR) \
+    -B $SCRATCH_DIR"
+
+# Assets resolved through the node-local cache (utils/asset_cache.py) are read from $ASSET_CACHE_DIR
+[ "$ASSET_CACHE" != "n" ] && [ -d "$ASSET_CACHE_DIR" ] && singularity_binds="$singularity_binds -B $ASSET_CACHE_DIR"
+
+# Container image, from the node-local cache if available
+image() {
+    local container=$1
+    if [ "$ASSET_CACHE" != "n" ]; then
+        python3 $CODE_DIR/utils/asset_cache.py path $ENV_DIR/$container
+    else
+        echo $ENV_DIR/$container
+    fi
+}
+
+instance_name() {
+    local container=$1
+    echo ${SLURM_JOBID:-local}_${container//[^A-Za-z0-9]/_}
+}
+
+# Start instance of container once per node; concurrent subjects wait for the first one to start it
+start_instance() {
+    local container=$1
+    local name=$(instance_name $container)
+
+    (
+        flock 9
+        if [ ! -f $INSTANCE_DIR/$name.started ] && [ ! -f $INSTANCE_DIR/$name.failed ]; then
+            singularity instance start $singularity_binds -B $INSTANCE_DIR/tmp:/tmp $(image $container) $name \
+                && touch $INSTANCE_DIR/$name.started \
+                || touch $INSTANCE_DIR/$name.failed
+        fi
+    ) 9>$INSTANCE_DIR/$name.lock
+
+    [ -f $INSTANCE_DIR/$name.started ]
+}
+
+run() {
+    local container=$1; shift
+    local name=$(instance_name $container)
+    local mode=cold
+    local start=$(date +%s.%N)
+
+    # Scratch directory of the calling subject, visible at its host path through the $SCRATCH_DIR bind
+    local tmp=$TMP_DIR own_tmp=
+    if [ -z "$tmp" ] || [[ "$(readlink -f $tmp)" != "$(readlink -f $SCRATCH_DIR)"* ]]; then
+        tmp=$(mktemp -d $INSTANCE_DIR/tmp/call_XXXXXX); own_tmp=$tmp
+    fi
+    export SINGULARITYENV_TMPDIR=$tmp SINGULARITYENV_MRTRIX_TMPFILE_DIR=$tmp
+
+    if [ "$CONTAINER_INSTANCES" != "n" ] && start_instance $container; then
+        mode=instance
+        singularity run --cleanenv instance://$name "$@"
+    else
+        singularity run $singularity_binds $(image $container) "$@"
+    fi
+    local exit_code=$?
+
+    [ -n "$own_tmp" ] && rm -rf $own_tmp
+
+    [ "$CONTAINER_TIMING" == "y" ] && echo "$container $mode $start $(date +%s.%N)" >> $TIMING_LOG
+
+    return $exit_code
+}
+
+# Compare startup overhead of a fresh container and of an instance and extrapolate to the number of calls
+report() {
+    [ ! -f $TIMING_LOG ] && echo "No container calls recorded. Set CONTAINER_TIMING=y to record calls." && return 0
+
+    echo "Container startup overhead (mean of 3 no-op calls each):"
+    printf "%-30s %8s %10s %12s %10s\n" container calls "cold [s]" "instance [s]" "saved [s]"
+
+    for container in $(awk '{print $1}' $TIMING_LOG | sort -u); do
+
+        name=$(instance_name $container)
+        calls=$(awk -v c=$container '$1 == c' $TIMING_LOG | wc -l)
+
+        cold=0; warm=0
+        for i in 1 2 3; do
+            t0=$(date +%s.%N); singularity run $singularity_binds $ENV_DIR/$container true &> /dev/null; t1=$(date +%s.%N)
+            cold=$(awk "BEGIN {print $cold + ($t1 - $t0) / 3}")
+            if [ -f $INSTANCE_DIR/$name.started ]; then
+                t0=$(date +%s.%N); singularity run instance://$name true &> /dev/null; t1=$(date +%s.%N)
+                warm=$(awk "BEGIN {print $warm + ($t1 - $t0) / 3}")
+            else
+                warm=$cold
+            fi
+        done
+
+        printf "%-30s %8d %10.2f %12.2f %10.0f\n" $container $calls $cold $warm $(awk "BEGIN {print $calls * ($cold - $warm)}")
+
+    done
+}
+
+stop() {
+    for started in $(ls $INSTANCE_DIR/*.started 2> /dev/null); do
+        singularity instance stop $(basename $started .started)
+        rm -f $started
+    done
+}
+
+command=$1; shift
+case $command in
+    run)    run "$@" ;;
+    report) report ;;
+    stop)   stop ;;
+    *)      echo "Usage: $0 run <container> [command ...] | report | stop" && exit 1 ;;
+esac
@@ -0,0 +1,270 @@
+# Pack subjects into SLURM jobs based on runtimes and memory of previous runs
+# Per-subject runtimes and peak memory are read from the telemetry table (log/telemetry.csv, see telemetry.py);
+# for subjects without telemetry records runtimes come from GNU parallel joblogs (log/parallel_runtask.log) and
+# peak memory from SLURM accounting (sacct). Subjects are sorted by expected runtime and packed first-fit-decreasing into node allocations:
+# each node runs SUBJS_PER_NODE subjects concurrently (GNU parallel -j), further subjects start as slots free up.
+# A node is filled as long as its simulated makespan stays below the longest single subject and the concurrently
+# running subjects fit into memory. The --time of every job is derived from its makespan plus a safety margin.
+#
+# Writes one line per job: <time> <sub> <sub> ...
+# Exits with code 1 without output if there is no runtime history for the pipeline.
+#
+# execute e.g. via
+# python3 pack_jobs.py -p qsiprep -n 4 --mem 64000 -t log/telemetry.csv -j log/parallel_runtask.log -o packing.txt \
+#     -s sub-001 sub-002 ...
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import csv
+import heapq
+import math
+import re
+import subprocess
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Pack subjects into SLURM jobs by runtime history')
+    parser.add_argument(
+        '-p', '--pipeline', required=True,
+        help='[required]\n pipeline including suffix, i.e. name of the processing script without .sh (e.g. tbss_1)')
+    parser.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subjects to submit')
+    parser.add_argument(
+        '-n', '--subjs-per-node', required=True, type=int,
+        help='[required]\n subjects processed concurrently per node ($SUBJS_PER_NODE)')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n packing file, one line per job: <time> <subjects>')
+    parser.add_argument(
+        '-j', '--joblog', nargs='+', default=[],
+        help='[optional]\n GNU parallel joblogs to learn runtimes from')
+    parser.add_argument(
+        '-t', '--telemetry',
+        help='[optional]\n telemetry table (log/telemetry.csv) with per-subject runtime and peak memory')
+    parser.add_argument(
+        '--mem', type=int, default=64000,
+        help='[optional]\n memory per node in MB ($HPC_MEM); default 64000')
+    parser.add_argument(
+        '--no-sacct', action='store_true',
+        help='[optional]\n do not query SLURM accounting for peak memory')
+    parser.add_argument(
+        '--sacct-start', default='now-180days',
+        help='[optional]\n start of the accounting period to query; default now-180days')
+    parser.add_argument(
+        '--percentile', type=float, default=90,
+        help='[optional]\n percentile of observed runtimes used as estimate; default 90')
+    parser.add_argument(
+        '--margin', type=float, default=1.25,
+        help='[optional]\n factor applied to the estimated makespan for --time; default 1.25')
+    parser.add_argument(
+        '--min-time', type=int, default=15,
+        help='[optional]\n minimum --time in minutes; default 15')
+    return parser
+
+
+###########
+# History #
+###########
+
+def percentile(values, q):
+    """Linear interpolation percentile as numpy.percentile (stdlib only, runs on the login node)."""
+
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    low, high = math.floor(pos), math.ceil(pos)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def read_joblogs(joblogs, pipeline):
+    """Runtimes (s) of successful runs per subject from GNU parallel joblogs."""
+
+    runtimes = {}
+    script = re.compile(r"/{}\.sh\s+(\S+)\s*$".format(re.escape(pipeline)))
+
+    for joblog in joblogs:
+        if not Path(joblog).exists():
+            continue
+        with open(joblog) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 9 or fields[0] == "Seq":
+                    continue
+                match = script.search(fields[8])
+                if match is None or fields[6] != "0" or fields[7] != "0":
+                    continue
+                runtimes.setdefault(match.group(1), []).append(float(fields[3]))
+
+    return runtimes
+
+
+def read_telemetry(table, pipeline):
+    """Runtimes (s) and peak RSS (MB) of successful runs per subject from the telemetry table."""
+
+    runtimes, memory = {}, {}
+    if table is None or not Path(table).exists():
+        return runtimes, memory
+
+    with open(table, newline="") as f:
+        for row in csv.DictReader(f):
+            if row["pipeline"] + row["suffix"] != pipeline or row["exit_code"] != "0":
+                continue
+            runtimes.setdefault(row["sub"], []).append(float(row["wall_s"]))
+            memory.setdefault(row["sub"], []).append(float(row["peak_rss_mb"]))
+
+    return runtimes, memory
+
+
+def parse_mem(value):
+    """sacct memory (e.g. 1234K, 2.5G) in MB."""
+
+    match = re.match(r"([\d.]+)([KMGT]?)", value or "")
+    if match is None:
+        return None
+    factor = {"": 1 / 1024 ** 2, "K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 ** 2}[match.group(2)]
+    return float(match.group(1)) * factor
+
+
+def read_sacct(pipeline, subjs_per_node, start):
+    """Peak memory (MB) per subject, estimated as job MaxRSS shared by its concurrently running subjects."""
+
+    try:
+        out = subprocess.run(
+            ["sacct", "-n", "-P", "-S", start, "--name", pipeline, "--format=JobIDRaw,JobName,State,MaxRSS,SubmitLine"],
+            capture_output=True, text=True, timeout=60).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return {}
+
+    jobs = {}
+    for line in out.splitlines():
+        fields = line.split("|")
+        if len(fields) < 5:
+            continue
+        job_id, _, state, max_rss, submit_line = fields[:5]
+        job = jobs.setdefault(job_id.split(".")[0], {"subjects": [], "mem": 0, "state": None})
+        if "." not in job_id:
+            job["state"] = state
+            job["subjects"] = submit_line.split("02_pipelines_batch.sh", 1)[-1].split() if "02_pipelines_batch.sh" in submit_line else []
+        mem = parse_mem(max_rss)
+        if mem:
+            job["mem"] = max(job["mem"], mem)
+
+    memory = {}
+    for job in jobs.values():
+        if job["state"] != "COMPLETED" or not job["subjects"] or not job["mem"]:
+            continue
+        share = job["mem"] / min(len(job["subjects"]), subjs_per_node)
+        for sub in job["subjects"]:
+            memory.setdefault(sub, []).append(share)
+
+    return memory
+
+
+###########
+# Packing #
+###########
+
+def estimate(subjects, history, q):
+    """Per-subject estimate from own history, else the pipeline-wide percentile."""
+
+    pooled = [v for values in history.values() for v in values]
+    if not pooled:
+        return None
+    fallback = percentile(pooled, q)
+    return {sub: percentile(history[sub], q) if sub in history else fallback for sub in subjects}
+
+
+class Node:
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.subjects = []
+        self.ends = [0.0] * slots
+        self.mems = []
+
+    def makespan_with(self, runtime):
+        """Makespan if `runtime` is started in the earliest free slot (list scheduling as GNU parallel)."""
+        return max(max(self.ends), min(self.ends) + runtime)
+
+    def peak_mem_with(self, mem):
+        return sum(sorted(self.mems + [mem], reverse=True)[:self.slots])
+
+    def add(self, sub, runtime, mem):
+        heapq.heapreplace(self.ends, self.ends[0] + runtime)
+        self.subjects.append(sub)
+        self.mems.append(mem)
+
+    @property
+    def makespan(self):
+        return max(self.ends)
+
+
+def pack(runtimes, memory, slots, node_mem):
+    """First-fit decreasing into nodes whose makespan stays within the longest single subject."""
+
+    order = sorted(runtimes, key=runtimes.get, reverse=True)
+    limit = runtimes[order[0]]
+    nodes = []
+
+    for sub in order:
+        mem = memory.get(sub, 0)
+        for node in nodes:
+            if node.makespan_with(runtimes[sub]) <= limit and node.peak_mem_with(mem) <= node_mem:
+                break
+        else:
+            node = Node(slots)
+            nodes.append(node)
+        node.add(sub, runtimes[sub], mem)
+
+    return nodes
+
+
+def slurm_time(seconds):
+    minutes = math.ceil(seconds / 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return (f"{days}-" if days else "") + f"{hours:02d}:{minutes:02d}:00"
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    # Telemetry records take precedence over joblog and accounting
+    runtime_history, memory_telemetry = read_telemetry(opts.telemetry, opts.pipeline)
+    runtime_history = {**read_joblogs(opts.joblog, opts.pipeline), **runtime_history}
+    runtimes = estimate(opts.subjects, runtime_history, opts.percentile)
+
+    if runtimes is None:
+        print(f"No runtime history for {opts.pipeline}. Using equally sized jobs ...")
+        raise SystemExit(1)
+
+    memory_history = {} if opts.no_sacct else read_sacct(opts.pipeline, opts.subjs_per_node, opts.sacct_start)
+    memory_history.update(memory_telemetry)
+    memory = estimate(opts.subjects, memory_history, opts.percentile) or {}
+
+    nodes = pack(runtimes, memory, opts.subjs_per_node, opts.mem)
+
+    known = sum(sub in runtime_history for sub in opts.subjects)
+    print(f"Runtime history of {opts.pipeline}: {known} of {len(opts.subjects)} subjects, "
+          f"{len(memory_history)} subjects with memory records")
+    print(f"Packed {len(opts.subjects)} subjects into {len(nodes)} jobs:")
+
+    with open(opts.output, "w") as f:
+        for node in nodes:
+            time = slurm_time(max(node.makespan * opts.margin, opts.min_time * 60))
+            peak = node.peak_mem_with(0)
+            print(f"  {len(node.subjects):4d} subjects  expected {node.makespan / 3600:6.2f} h  --time {time}"
+                  + (f"  peak memory {peak:.0f} MB" if peak else ""))
+            f.write(" ".join([time] + node.subjects) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+# Dependency graph of pipelines and chained SLURM submission
+# Stages, their analysis level, resources, required parameters, the stages they need and the outputs marking them as
+# complete are defined in pipeline_dag.json. For a target stage the submitter determines which stages every subject
+# still needs (missing outputs, checked via the cached completion index, outputs whose inputs changed since they were
+# processed, see provenance.py, or an upstream stage being rerun) and submits all of them at once through
+# 02_pipelines_batch.sh.
+# Subject level stages are submitted in batches of SUBJS_PER_NODE subjects in cohort order; a batch only depends
+# (afterok) on the upstream jobs containing its own subjects, so subjects move on as soon as their own inputs are done.
+# Group level stages depend on all upstream jobs and, if rerun, trigger all downstream subject level stages.
+#
+# Parameters otherwise asked for by 01_pipelines_submission.sh are set with --set VAR=value; VAR=value is used by all
+# stages declaring VAR, STAGE:VAR=value only by STAGE (e.g. for MODIFIER, which means different things per pipeline).
+# Input and output templates use {sub} (incl. "sub-"), {ses} and parameters, e.g. {TBSS_PIPELINE};
+# session 'all' matches any session.
+#
+# execute e.g. via
+# python3 pipeline_dag.py show [-t tbss_4]
+# python3 pipeline_dag.py submit -t tbss_4 --session 1 --set TBSS_PIPELINE=mni [--dry-run] [-s sub-001 sub-002 ...]
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import json
+import os
+import re
+import subprocess
+import time
+
+from completion_index import Index, subjects_in, CODE_DIR, DATA_DIR
+from provenance import stale
+
+
+GRAPH = Path(__file__).resolve().parent / "pipeline_dag.json"
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Show the pipeline dependency graph and submit target stages with all stages they need')
+    parser.add_argument(
+        '--graph', default=str(GRAPH),
+        help='[optional]\n dependency graph; default utils/pipeline_dag.json')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    show = commands.add_parser('show', formatter_class=RawTextHelpFormatter, help='print stages and their dependencies')
+    show.add_argument(
+        '-t', '--target', nargs='+',
+        help='[optional]\n restrict to target stages and the stages they need')
+    show.add_argument(
+        '--set', nargs='+', default=[], metavar='[STAGE:]VAR=value',
+        help='[optional]\n parameters resolving conditional dependencies')
+
+    submit = commands.add_parser('submit', formatter_class=RawTextHelpFormatter, help='submit target stages and the stages they need')
+    submit.add_argument(
+        '-t', '--target', required=True, nargs='+',
+        help='[required]\n target stages, e.g. tbss_4')
+    submit.add_argument(
+        '--session', required=True,
+        help='[required]\n session to process (e.g. 1) or all')
+    submit.add_argument(
+        '-s', '--subjects', nargs='+',
+        help='[optional]\n subjects (e.g. sub-001); default all subjects in raw_bids')
+    submit.add_argument(
+        '--set', nargs='+', default=[], metavar='[STAGE:]VAR=value',
+        help='[optional]\n pipeline parameters, e.g. TBSS_PIPELINE=fixel wmh_04_postproc:ALGORITHM=lpa')
+    submit.add_argument(
+        '--assume-done', nargs='+', default=[], metavar='STAGE',
+        help='[optional]\n stages to treat as complete for all subjects (e.g. processed elsewhere)')
+    submit.add_argument(
+        '--time', nargs='+', default=[], metavar='STAGE=TIME',
+        help='[optional]\n override the time to allocate per job of a stage, e.g. tbss_3=06:00:00')
+    submit.add_argument(
+        '--partition',
+        help='[optional]\n partition for all jobs; default per stage')
+    submit.add_argument(
+        '--sbatch-flags', default='',
+        help="[optional]\n additional flags for every sbatch call, e.g. '--begin=16:00'")
+    submit.add_argument(
+        '--dry-run', action='store_true',
+        help='[optional]\n print the jobs without submitting them')
+    submit.add_argument(
+        '--data-dir', default=str(DATA_DIR),
+        help='[optional]\n data directory; default $DATA_DIR')
+    submit.add_argument(
+        '--index', default=str(CODE_DIR / "log" / "completion_index.json"),
+        help='[optional]\n index file with cached directory listings; default code/log/completion_index.json')
+    return parser
+
+
+#########
+# Graph #
+#########
+
+class Stage:
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.pipeline = spec["pipeline"]
+        self.suffix = spec.get("suffix", "")
+        self.level = spec["level"]
+        self.subjs_per_node = spec.get("subjs_per_node")
+        self.batch_size = spec.get("batch_size")
+        self.batch_env = spec.get("batch_env")
+        self.time = spec["time"]
+        self.partition = spec["partition"]
+        self.needs_spec = spec.get("needs", [])
+        self.inputs_spec = spec.get("inputs", [])
+        self.defaults = spec.get("params", {})
+        self.outputs_spec = spec["outputs"]
+        self.outputs = [item for item in self.outputs_spec if " if " not in item]
+        self.description = spec.get("description", "")
+        self.params = {}
+        self.needs = []
+        self.inputs = []
+
+    @property
+    def batched(self):
+        """Processed in batches of subjects (subject level or group level with batch_size)."""
+        return self.level == "subject" or self.batch_size is not None
+
+    @property
+    def script(self):
+        return CODE_DIR / "pipelines" / self.pipeline / f"{self.pipeline}{self.format(self.suffix)}.sh"
+
+    def resolve(self, settings):
+        """Parameters from defaults, global and stage specific settings; dependencies, inputs and outputs whose
+        condition holds."""
+
+        self.params = {var: settings.get((self.name, var), settings.get((None, var), default))
+                       for var, default in self.defaults.items()}
+
+        def conditional(items):
+            for item in items:
+                item, _, condition = item.partition(" if ")
+                if condition:
+                    var, negate, value = re.match(r"(\w+)(!?)=(.*)", condition).groups()
+                    if (self.params.get(var, settings.get((None, var), "")) == value) == bool(negate):
+                        continue
+                yield item
+
+        self.needs = list(conditional(self.needs_spec))
+        self.inputs = list(conditional(self.inputs_spec))
+        self.outputs = list(conditional(self.outputs_spec))
+
+    def missing_params(self):
+        return [var for var, value in self.params.items() if value is None]
+
+    def format(self, template, **fields):
+        return template.format(**fields, **self.params)
+
+
+def read_settings(items):
+    settings = {}
+    for item in items:
+        match = re.match(r"(?:(\w+):)?(\w+)=(.*)$", item)
+        if match is None:
+            raise SystemExit(f"Cannot parse --set {item}; expected [STAGE:]VAR=value")
+        stage, var, value = match.groups()
+        settings[(stage, var)] = value
+    return settings
+
+
+def load_graph(path, settings):
+
+    with open(path) as f:
+        stages = {name: Stage(name, spec) for name, spec in json.load(f).items()}
+
+    for stage in stages.values():
+        stage.resolve(settings)
+        unknown = [need for need in stage.needs if need not in stages]
+        if unknown:
+            raise SystemExit(f"{stage.name} needs unknown stages {' '.join(unknown)} ({path})")
+    for stage, var in settings:
+        if stage is not None and stage not in stages:
+            raise SystemExit(f"--set {stage}:{var}: unknown stage {stage}")
+
+    return stages
+
+
+def closure(stages, targets):
+    """Target stages and everything they need in topological order (needed stages first)."""
+
+    order, state = [], {}
+
+    def visit(name, path):
+        if name not in stages:
+            raise SystemExit(f"Unknown stage {name}. Choose from: {' '.join(stages)}")
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise SystemExit(f"Cyclic dependency: {' -> '.join(path + [name])}")
+        state[name] = "visiting"
+        for need in stages[name].needs:
+            visit(need, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for target in targets:
+        visit(target, [])
+    return order
+
+
+############
+# Planning #
+############
+
+def completion(stage, subjects, session, index):
+    """Subjects whose outputs of `stage` exist."""
+
+    ses = "*" if session == "all" else session
+    done = set(subjects)
+    for template in stage.outputs:
+        if "{sub}" in template:
+            done &= {sub for sub in done if index.glob(stage.format(template, sub=sub, ses=ses)) is not None}
+        elif index.glob(stage.format(template, ses=ses)) is None:
+            return set()
+    return done
+
+
+def plan(stages, order, subjects, session, index, assume_done):
+    """Subjects to (re)run per stage: missing or stale outputs or rerun upstream."""
+
+    run = {}
+    for name in order:
+        stage = stages[name]
+        if name in assume_done:
+            run[name] = set()
+            continue
+
+        upstream = set()
+        for need in stage.needs:
+            upstream |= set(subjects) if run[need] and not stages[need].batched else run[need]
+
+        done = completion(stage, subjects, session, index)
+        done -= stale(stage, [sub for sub in subjects if sub in done], session, index.data_dir)
+        todo = set(subjects) - done | upstream
+        # Group stages process the whole cohort
+        run[name] = todo if stage.batched or not todo else set(subjects)
+    return run
+
+
+class Job:
+
+    def __init__(self, stage, subjects, iteration):
+        self.stage = stage
+        self.subjects = subjects
+        self.iteration = iteration
+        self.depends = []
+        self.job_id = None
+
+
+def build_jobs(stages, order, subjects, run):
+    """Jobs per stage with dependencies on the upstream jobs processing the same subjects."""
+
+    jobs, position = {}, {}
+    for name in order:
+        stage = stages[name]
+        selected = [sub for sub in subjects if sub in run[name]]
+        if not selected:
+            jobs[name] = []
+            continue
+
+        # Batch subjects by the last upstream job they wait for; subjects with complete inputs start right away
+        def ready(sub):
+            return max((position[id(job)] for need in stage.needs for job in jobs[need]
+                        if not job.stage.batched or sub in job.subjects), default=-1)
+        if stage.batched:
+            selected.sort(key=ready)
+
+        size = stage.batch_size or stage.subjs_per_node if stage.batched else len(selected)
+        jobs[name] = [Job(stage, selected[i:i + size], i) for i in range(0, len(selected), size)]
+
+        for job in jobs[name]:
+            for need in stage.needs:
+                for upstream in jobs[need]:
+                    if not stage.batched or not upstream.stage.batched or set(upstream.subjects) & set(job.subjects):
+                        job.depends.append(upstream)
+            position[id(job)] = len(position)
+    return jobs
+
+
+##############
+# Submission #
+##############
+
+def submit_job(job, opts, times, date):
+
+    stage = job.stage
+    suffix = stage.format(stage.suffix)
+    job_time = times.get(stage.name, stage.time)
+    dependency = ":".join(upstream.job_id for upstream in job.depends)
+
+    env = dict(os.environ, **{var: value for var, value in stage.params.items()})
+    env.update(
+        SCRIPT_DIR=str(CODE_DIR),
+        PIPELINE=stage.pipeline,
+        PIPELINE_SUFFIX=suffix,
+        SESSION=opts.session,
+        SUBJS_PER_NODE=str(min(stage.subjs_per_node or len(job.subjects), len(job.subjects))),
+        ITER=str(job.iteration),
+        ANALYSIS_LEVEL=stage.level)
+    if stage.batch_env:
+        env[stage.batch_env] = " ".join(job.subjects)
+
+    log = CODE_DIR / "log" / f"%A-{stage.pipeline}-{job.iteration}-{date}"
+    cmd = (["sbatch", "--parsable", "--job-name", stage.pipeline + suffix, "--time", job_time,
+            "--partition", opts.partition or stage.partition] + opts.sbatch_flags.split()
+           + ([f"--dependency=afterok:{dependency}", "--kill-on-invalid-dep=yes"] if dependency else [])
+           + ["--output", f"{log}.out", "--error", f"{log}.err", str(CODE_DIR / "02_pipelines_batch.sh")]
+           + job.subjects)
+
+    if opts.dry_run:
+        job.job_id = f"{stage.name}#{job.iteration}"
+    else:
+        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise SystemExit(f"sbatch failed for {stage.name} ({' '.join(job.subjects[:3])} ...): {result.stderr.strip()}")
+        job.job_id = result.stdout.strip().split(";")[0]
+
+    print(f"  {job.job_id:>16s}  {stage.name:20s} {len(job.subjects):5d} subjects  --time {job_time:>11s}"
+          + (f"  after {dependency}" if dependency else ""))
+    return job_time
+
+
+############
+# Commands #
+############
+
+def show(opts):
+
+    stages = load_graph(opts.graph, read_settings(opts.set))
+    names = closure(stages, opts.target) if opts.target else list(stages)
+
+    print(f"{'stage':20s} {'level':8s} {'time':>11s} {'partition':9s} needs")
+    for name in names:
+        stage = stages[name]
+        level = stage.level + (f"/{stage.batch_size}" if stage.batch_size else "")
+        print(f"{name:20s} {level:8s} {stage.time:>11s} {stage.partition:9s} {' '.join(stage.needs) or '-'}")
+        print(f"{'':20s} {stage.description}")
+    return 0
+
+
+def submit(opts):
+
+    stages = load_graph(opts.graph, read_settings(opts.set))
+    order = closure(stages, opts.target)
+
+    missing = {name: stages[name].missing_params() for name in order if name not in opts.assume_done}
+    missing = {name: params for name, params in missing.items() if params}
+    if missing:
+        raise SystemExit("Parameters need to be set (--set [STAGE:]VAR=value): "
+                         + ", ".join(f"{name}: {' '.join(params)}" for name, params in missing.items()))
+
+    times = dict(item.split("=", 1) for item in opts.time)
+    index = Index(opts.data_dir, opts.index)
+    subjects = opts.subjects or subjects_in(index, "raw_bids")
+    if not subjects:
+        raise SystemExit("No subjects to process")
+
+    run = plan(stages, order, subjects, opts.session, index, set(opts.assume_done))
+    index.save()
+    jobs = build_jobs(stages, order, subjects, run)
+
+    print(f"Stages needed for {' '.join(opts.target)} (session {opts.session}, {len(subjects)} subjects):")
+    for name in order:
+        print(f"  {name:20s} {len(run[name]):5d} subjects to run, {len(jobs[name]):4d} jobs")
+
+    if not any(jobs.values()):
+        print("All outputs exist. Nothing to submit.")
+        return 0
+
+    print("Dry run, jobs that would be submitted:" if opts.dry_run else "Submitting:")
+    date = time.strftime("%d%m%Y")
+    manifest = CODE_DIR / "log" / f"{time.strftime('%d%m%Y%H%M%S')}-dag-{'-'.join(opts.target)}.tsv"
+    rows = []
+    for name in order:
+        for job in jobs[name]:
+            job_time = submit_job(job, opts, times, date)
+            rows.append([job.job_id, name, job_time, " ".join(upstream.job_id for upstream in job.depends),
+                         " ".join(job.subjects)])
+
+    if not opts.dry_run:
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest, "w") as f:
+            f.write("job_id\tstage\ttime\tdepends_on\tsubjects\n")
+            f.writelines("\t".join(row) + "\n" for row in rows)
+        print(f"Submitted {len(rows)} jobs. Manifest written to {manifest}")
+    return 0
+
+
+def main():
+
+    opts = get_parser().parse_args()
+    raise SystemExit({"show": show, "submit": submit}[opts.command](opts))
+
+
+if __name__ == "__main__":
+    main()
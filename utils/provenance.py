@@ -0,0 +1,318 @@
+# Input fingerprints of pipeline stages to skip subjects whose outputs are current
+# A fingerprint covers the inputs of a stage for one subject (paths, sizes and mtimes of all files matched by the
+# input templates in pipeline_dag.json, or their content hashes with --content), the container images the processing
+# script uses and the stage parameters (e.g. MODIFIER, ALGORITHM, OUTPUT_SPACES, TBSS_PIPELINE).
+# 02_pipelines_batch.sh fingerprints the inputs before processing and records the fingerprints of successful subjects
+# in log/provenance.tsv. Subjects whose outputs exist and whose recorded fingerprint matches the current one are
+# dropped at submission (01_pipelines_submission.sh, pipeline_dag.py). Without a record (outputs of runs before
+# fingerprints were recorded), outputs are stale if an input is newer than the oldest output.
+# Group level stages are fingerprinted over the inputs of all subjects (sub-all).
+#
+# The stage is identified by PIPELINE, PIPELINE_SUFFIX and ANALYSIS_LEVEL of the environment; pipelines without
+# an entry in pipeline_dag.json are always processed.
+#
+# execute e.g. via
+# python3 provenance.py fingerprint -s sub-001 sub-002 -o log/provenance/<jobid>.tsv
+# python3 provenance.py record --fingerprints log/provenance/<jobid>.tsv --telemetry log/telemetry/<jobid>.csv
+# python3 provenance.py filter -s sub-001 sub-002 ...      (prints subjects to process)
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from contextlib import redirect_stdout
+from glob import glob
+from pathlib import Path
+import csv
+import fcntl
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+from completion_index import Index, CODE_DIR, DATA_DIR
+
+
+TABLE = CODE_DIR / "log" / "provenance.tsv"
+ENV_DIR = Path(os.environ.get("ENV_DIR", CODE_DIR.parent / "envs"))
+COLUMNS = ["stage", "session", "sub", "mode", "fingerprint", "recorded", "job_id"]
+GROUP = "sub-all"
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Fingerprint stage inputs, record them for processed subjects and filter current subjects')
+    parser.add_argument(
+        '--table', default=str(TABLE),
+        help='[optional]\n table of recorded fingerprints; default code/log/provenance.tsv')
+    parser.add_argument(
+        '--data-dir', default=str(DATA_DIR),
+        help='[optional]\n data directory; default $DATA_DIR')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fingerprint = commands.add_parser('fingerprint', formatter_class=RawTextHelpFormatter, help='fingerprint inputs before processing')
+    fingerprint.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subjects of the job')
+    fingerprint.add_argument(
+        '-o', '--output', required=True,
+        help='[required]\n per-job fingerprint file')
+    fingerprint.add_argument(
+        '--content', action='store_true', default=os.environ.get("PROVENANCE_CONTENT") == "y",
+        help='[optional]\n hash file contents instead of sizes and mtimes; default $PROVENANCE_CONTENT == y')
+
+    record = commands.add_parser('record', formatter_class=RawTextHelpFormatter, help='record fingerprints of successful subjects')
+    record.add_argument(
+        '--fingerprints', required=True,
+        help='[required]\n per-job fingerprint file')
+    record.add_argument(
+        '--telemetry',
+        help='[optional]\n per-job telemetry record; subjects with exit code 0 are recorded')
+    record.add_argument(
+        '--exit-code', type=int,
+        help='[optional]\n exit code of a group level job; all subjects are recorded if 0 and the declared outputs exist')
+
+    filter_ = commands.add_parser('filter', formatter_class=RawTextHelpFormatter, help='print subjects with missing or stale outputs')
+    filter_.add_argument(
+        '-s', '--subjects', required=True, nargs='+',
+        help='[required]\n subjects to submit')
+    filter_.add_argument(
+        '--index', default=str(CODE_DIR / "log" / "completion_index.json"),
+        help='[optional]\n index file with cached directory listings; default code/log/completion_index.json')
+    return parser
+
+
+################
+# Fingerprints #
+################
+
+def expand(template, data_dir):
+    """Files matched by an input template (relative to data/); directories are included recursively."""
+
+    files = []
+    for match in sorted(glob(str(Path(data_dir) / template))):
+        if os.path.isdir(match):
+            for root, dirs, names in os.walk(match):
+                dirs.sort()
+                files += [os.path.join(root, name) for name in sorted(names)]
+        else:
+            files.append(match)
+    return files
+
+
+def input_files(stage, subjects, session, data_dir):
+    ses = "*" if session == "all" else session
+    files = []
+    for template in stage.inputs:
+        if "{sub}" in template:
+            for sub in subjects:
+                files += expand(stage.format(template, sub=sub, ses=ses), data_dir)
+        else:
+            files += expand(stage.format(template, ses=ses), data_dir)
+    return files
+
+
+def containers(script):
+    """Container images assigned in a processing script (container_<name>=<image>)."""
+
+    if not script.exists():
+        return []
+    return sorted(set(re.findall(r"^\s*container_\w+=(\S+)", script.read_text(), re.M)))
+
+
+def file_state(path, content):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not content:
+        return [stat.st_size, stat.st_mtime_ns]
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return [stat.st_size, digest.hexdigest()]
+
+
+def fingerprint(stage, subjects, session, data_dir, content=False):
+    """Hash of input files, container images and parameters of `stage` for `subjects`."""
+
+    state = {
+        "inputs": [[os.path.relpath(path, data_dir), file_state(path, content)]
+                   for path in input_files(stage, subjects, session, data_dir)],
+        # Images are large; their size and mtime identify them
+        "containers": [[image, file_state(ENV_DIR / image, False)] for image in containers(stage.script)],
+        "params": stage.params,
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+###########
+# Records #
+###########
+
+def read_records(table):
+    """Latest recorded (mode, fingerprint) per stage, session and subject."""
+
+    records = {}
+    if not Path(table).exists():
+        return records
+    with open(table, newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            records[(row["stage"], row["session"], row["sub"])] = (row["mode"], row["fingerprint"])
+    return records
+
+
+def append_records(table, rows):
+    table = Path(table)
+    table.parent.mkdir(parents=True, exist_ok=True)
+    with open(table, "a", newline="") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        # Header only if the table is still empty once the lock is held
+        if os.fstat(f.fileno()).st_size == 0:
+            writer.writerow(COLUMNS)
+        writer.writerows(rows)
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def newest(paths):
+    return max((os.stat(path).st_mtime_ns for path in paths if os.path.exists(path)), default=None)
+
+
+def stale(stage, subjects, session, data_dir, table=TABLE):
+    """Subjects among `subjects` (whose outputs exist) with changed inputs, containers or parameters."""
+
+    if not stage.inputs or not subjects:
+        return set()
+
+    records = read_records(table)
+    ses = "*" if session == "all" else session
+    keys = {sub: [sub] for sub in subjects} if stage.batched else {GROUP: list(subjects)}
+    changed = set()
+
+    for key, subs in keys.items():
+        record = records.get((stage.name, session, key))
+        if record is not None:
+            mode, recorded = record
+            if fingerprint(stage, subs, session, data_dir, content=mode == "content") != recorded:
+                changed.update(subs)
+            continue
+
+        # No record: compare input and output mtimes
+        outputs = [path for template in stage.outputs
+                   for path in glob(str(Path(data_dir) / stage.format(template, sub=subs[0], ses=ses)))[:1]]
+        input_mtime, outputs_mtime = newest(input_files(stage, subs, session, data_dir)), None
+        if outputs:
+            outputs_mtime = min(os.stat(path).st_mtime_ns for path in outputs)
+        if input_mtime is not None and outputs_mtime is not None and input_mtime > outputs_mtime:
+            changed.update(subs)
+
+    return changed
+
+
+def stage_from_env():
+    """Stage of pipeline_dag.json processed by PIPELINE, PIPELINE_SUFFIX and ANALYSIS_LEVEL with parameters from the environment."""
+
+    from pipeline_dag import load_graph, GRAPH
+
+    stages = load_graph(GRAPH, {(None, var): value for var, value in os.environ.items()})
+    for stage in stages.values():
+        if (stage.pipeline == os.environ.get("PIPELINE") and stage.format(stage.suffix) == os.environ.get("PIPELINE_SUFFIX", "")
+                and stage.level == os.environ.get("ANALYSIS_LEVEL")):
+            return stage
+    return None
+
+
+############
+# Commands #
+############
+
+def fingerprint_job(opts):
+
+    stage = stage_from_env()
+    session = os.environ.get("SESSION", "")
+    output = Path(opts.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    if stage is None or not stage.inputs:
+        print(f"No inputs of {os.environ.get('PIPELINE')}{os.environ.get('PIPELINE_SUFFIX', '')} declared in pipeline_dag.json. "
+              "Fingerprints are not recorded.")
+        output.write_text("")
+        return 0
+
+    mode = "content" if opts.content else "stat"
+    keys = {sub: [sub] for sub in opts.subjects} if stage.batched else {GROUP: opts.subjects}
+    with open(output, "w") as f:
+        for key, subs in keys.items():
+            f.write("\t".join([stage.name, session, key, mode, fingerprint(stage, subs, session, opts.data_dir, opts.content)]) + "\n")
+    print(f"Fingerprinted inputs of {stage.name} for {len(keys)} {'subjects' if stage.batched else 'group'}")
+    return 0
+
+
+def record(opts):
+
+    if not Path(opts.fingerprints).exists():
+        return 0
+    with open(opts.fingerprints) as f:
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+    if opts.telemetry:
+        succeeded = set()
+        if Path(opts.telemetry).exists():
+            with open(opts.telemetry, newline="") as f:
+                succeeded = {row["sub"] for row in csv.DictReader(f) if row["exit_code"] == "0"}
+        rows = [row for row in rows if row[2] in succeeded]
+    elif opts.exit_code != 0:
+        rows = []
+    else:
+        # A zero status of a group script may come from its last command only; require its declared outputs as well
+        stage = stage_from_env()
+        ses = "*" if os.environ.get("SESSION", "") == "all" else os.environ.get("SESSION", "")
+        missing = [template for template in (stage.outputs if stage is not None else [])
+                   if not glob(str(Path(opts.data_dir) / stage.format(template, sub="*", ses=ses)))]
+        if missing:
+            print(f"Outputs {' '.join(missing)} of {stage.name} missing; fingerprints are not recorded")
+            rows = []
+
+    recorded = time.strftime("%Y-%m-%dT%H:%M:%S")
+    append_records(opts.table, [row + [recorded, os.environ.get("SLURM_JOBID", "")] for row in rows])
+    print(f"Recorded input fingerprints of {len(rows)} processed subjects in {opts.table}")
+    return 0
+
+
+def filter_subjects(opts):
+
+    stage = stage_from_env()
+    if stage is None or not stage.inputs:
+        print(" ".join(opts.subjects))
+        return 0
+
+    from pipeline_dag import completion
+
+    session = os.environ.get("SESSION", "")
+    index = Index(opts.data_dir, opts.index)
+    done = completion(stage, opts.subjects, session, index)
+    # stdout carries the subject list only
+    with redirect_stdout(sys.stderr):
+        index.save()
+    current = done - stale(stage, [sub for sub in opts.subjects if sub in done], session, opts.data_dir, opts.table)
+
+    todo = [sub for sub in opts.subjects if sub not in current]
+    if not stage.batched and todo:
+        todo = opts.subjects
+    print(f"{stage.name}: outputs of {len(current)} of {len(opts.subjects)} subjects are current, "
+          f"{len(done) - len(current)} stale, {len(opts.subjects) - len(done)} missing", file=sys.stderr)
+    print(" ".join(todo))
+    return 0
+
+
+def main():
+
+    opts = get_parser().parse_args()
+    raise SystemExit({"fingerprint": fingerprint_job, "record": record, "filter": filter_subjects}[opts.command](opts))
+
+
+if __name__ == "__main__":
+    main()
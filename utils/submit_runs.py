@@ -0,0 +1,332 @@
+# Non-interactive submission of run specs as SLURM job arrays
+# A run spec (TOML; YAML if PyYAML is installed) lists runs of pipelines for one or several sessions, see
+# utils/run_spec_example.toml. A run refers to a stage of pipeline_dag.json (level, resources, parameters, outputs) or
+# defines pipeline, suffix, level, subjs_per_node, time and partition itself; keys of [defaults] apply to all runs.
+# Every run and session is submitted as one job array: the subject batches (one line per array task) are written to a
+# manifest and pipeline and parameters to an env file under log/manifests/. 02_pipelines_batch.sh reads them via
+# $MANIFEST, $RUN_ENV and $SLURM_ARRAY_TASK_ID instead of subjects on the command line and variables in --export.
+# Subjects whose outputs are current are skipped (see provenance.py). With runtime history subject level batches are
+# packed as by pack_jobs.py and the --time of the array is that of its longest batch.
+# A run waits for the runs it needs (needs = ["name"]): afterok on their array of the same session, else all arrays.
+# Subjects submitted by a needed run are submitted again by the runs needing it, even if their outputs are current.
+#
+# execute e.g. via
+# python3 submit_runs.py run_spec_example.toml [--dry-run] [--only qsiprep tbss_1]
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+import os
+import shlex
+import subprocess
+import time
+
+from completion_index import Index, subjects_in, CODE_DIR, DATA_DIR
+from pipeline_dag import Stage, load_graph, completion, GRAPH
+from pack_jobs import read_joblogs, read_telemetry, estimate, pack, slurm_time
+from provenance import stale
+
+
+MANIFEST_DIR = CODE_DIR / "log" / "manifests"
+KEYS = {"name", "stage", "pipeline", "suffix", "level", "session", "sessions", "subjects", "subject_file", "exclude_file",
+        "params", "subjs_per_node", "time", "partition", "max_parallel", "sbatch_flags", "needs", "skip_current", "pack"}
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Submit the runs of a run spec, one SLURM job array per run and session')
+    parser.add_argument(
+        'spec',
+        help='[required]\n run spec (.toml, or .yaml/.yml with PyYAML installed)')
+    parser.add_argument(
+        '--only', nargs='+', metavar='NAME',
+        help='[optional]\n submit only these runs of the spec')
+    parser.add_argument(
+        '--sbatch-flags', default='',
+        help="[optional]\n additional flags for every sbatch call, e.g. '--begin=16:00'")
+    parser.add_argument(
+        '--max-array-size', type=int, default=1001,
+        help='[optional]\n MaxArraySize of the cluster; default 1001')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='[optional]\n print the job arrays without writing manifests or submitting them')
+    parser.add_argument(
+        '--graph', default=str(GRAPH),
+        help='[optional]\n dependency graph with stage definitions; default utils/pipeline_dag.json')
+    parser.add_argument(
+        '--data-dir', default=str(DATA_DIR),
+        help='[optional]\n data directory; default $DATA_DIR')
+    parser.add_argument(
+        '--index', default=str(CODE_DIR / "log" / "completion_index.json"),
+        help='[optional]\n index file with cached directory listings; default code/log/completion_index.json')
+    return parser
+
+
+########
+# Spec #
+########
+
+def read_spec(path):
+
+    path = Path(path)
+    if path.suffix == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise SystemExit("Reading TOML run specs needs python >= 3.11 or tomli")
+        with open(path, "rb") as f:
+            spec = tomllib.load(f)
+    elif path.suffix in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit("Reading YAML run specs needs PyYAML (pip install pyyaml); TOML specs need no extra package")
+        with open(path) as f:
+            spec = yaml.safe_load(f) or {}
+    else:
+        raise SystemExit(f"Unknown run spec format {path.suffix}; use .toml, .yaml or .yml")
+
+    defaults = spec.get("defaults", {})
+    entries = []
+    for entry in spec.get("run", []):
+        entry = {**defaults, **entry, "params": {**defaults.get("params", {}), **entry.get("params", {})}}
+        unknown = set(entry) - KEYS
+        if unknown:
+            raise SystemExit(f"Unknown keys in run {entry.get('name', entry.get('stage', ''))}: {' '.join(sorted(unknown))}")
+        if "stage" not in entry and "pipeline" not in entry:
+            raise SystemExit(f"Run {entry.get('name', '')} needs either a stage of pipeline_dag.json or a pipeline")
+        entry.setdefault("name", entry.get("stage") or entry["pipeline"] + entry.get("suffix", ""))
+        entries.append(entry)
+
+    names = [entry["name"] for entry in entries]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise SystemExit(f"Run names need to be unique (set name = ...): {' '.join(sorted(duplicates))}")
+    return entries
+
+
+class Run:
+
+    def __init__(self, entry, graph):
+        self.name = entry["name"]
+        self.params = {var: str(value) for var, value in entry["params"].items()}
+        settings = {(None, var): value for var, value in self.params.items()}
+
+        if "stage" in entry:
+            stages = load_graph(graph, settings)
+            if entry["stage"] not in stages:
+                raise SystemExit(f"Run {self.name}: unknown stage {entry['stage']}. Choose from: {' '.join(stages)}")
+            self.stage = stages[entry["stage"]]
+        else:
+            self.stage = Stage(self.name, {"pipeline": entry["pipeline"], "suffix": entry.get("suffix", ""),
+                                           "level": entry.get("level", "subject"), "time": entry.get("time"),
+                                           "partition": entry.get("partition"), "outputs": []})
+            self.stage.resolve(settings)
+
+        missing = self.stage.missing_params()
+        if missing:
+            raise SystemExit(f"Run {self.name}: parameters need to be set in params: {' '.join(missing)}")
+        # Parameters not declared by the stage (e.g. CONTAINER_TIMING) are passed on as well
+        self.params.update(self.stage.params)
+
+        self.subjs_per_node = entry.get("subjs_per_node", self.stage.subjs_per_node)
+        self.time = entry.get("time")
+        self.partition = entry.get("partition", self.stage.partition)
+        if self.stage.level == "subject" and not self.subjs_per_node:
+            raise SystemExit(f"Run {self.name}: set subjs_per_node")
+        if not (self.time or self.stage.time) or not self.partition:
+            raise SystemExit(f"Run {self.name}: set time and partition")
+
+        sessions = entry.get("sessions", entry.get("session"))
+        if sessions is None:
+            raise SystemExit(f"Run {self.name}: set session(s)")
+        self.sessions = [str(ses) for ses in (sessions if isinstance(sessions, list) else [sessions])]
+        self.subjects = entry.get("subjects", "all")
+        self.subject_file = entry.get("subject_file")
+        self.exclude_file = entry.get("exclude_file")
+        self.max_parallel = entry.get("max_parallel")
+        self.sbatch_flags = entry.get("sbatch_flags", "")
+        self.needs = entry.get("needs", [])
+        self.skip_current = entry.get("skip_current", os.environ.get("SKIP_CURRENT", "y") != "n")
+        self.pack = entry.get("pack", True)
+
+    def cohort(self, index):
+        if self.subject_file:
+            with open(self.subject_file) as f:
+                subjects = [line.strip() for line in f if line.strip()]
+        elif self.subjects == "all":
+            subjects = subjects_in(index, "raw_bids")
+        else:
+            subjects = list(self.subjects)
+        if self.exclude_file:
+            with open(self.exclude_file) as f:
+                excluded = {line.strip() for line in f if line.strip()}
+            subjects = [sub for sub in subjects if sub not in excluded]
+        return subjects
+
+
+###########
+# Batches #
+###########
+
+def select(run, subjects, session, index, upstream=()):
+    """Subjects without current outputs or reprocessed by a needed run (`upstream`); group stages process the whole
+    cohort, as pipeline_dag.py plan."""
+
+    stage = run.stage
+    if not run.skip_current or not stage.outputs:
+        return subjects
+
+    done = completion(stage, subjects, session, index)
+    current = done - stale(stage, [sub for sub in subjects if sub in done], session, index.data_dir) - set(upstream)
+    todo = [sub for sub in subjects if sub not in current]
+    return todo if stage.batched or not todo else subjects
+
+
+def batches(run, subjects):
+    """Subject batches (one per array task) and the --time of the array."""
+
+    stage = run.stage
+    if not stage.batched:
+        return [subjects], run.time or stage.time
+    if stage.batch_size:
+        return [subjects[i:i + stage.batch_size] for i in range(0, len(subjects), stage.batch_size)], run.time or stage.time
+
+    size = run.subjs_per_node
+    pipeline = stage.pipeline + stage.format(stage.suffix)
+    history, memory = read_telemetry(CODE_DIR / "log" / "telemetry.csv", pipeline)
+    history = {**read_joblogs([CODE_DIR / "log" / "parallel_runtask.log"], pipeline), **history}
+    runtimes = estimate(subjects, history, 90) if run.pack else None
+    if runtimes is None:
+        return [subjects[i:i + size] for i in range(0, len(subjects), size)], run.time or stage.time
+
+    nodes = pack(runtimes, estimate(subjects, memory, 90) or {}, size, int(os.environ.get("HPC_MEM", 64000)))
+    makespan = max(node.makespan for node in nodes)
+    return [node.subjects for node in nodes], run.time or slurm_time(max(makespan * 1.25, 15 * 60))
+
+
+##############
+# Submission #
+##############
+
+def write_manifest(base, run, session, tasks):
+
+    stage = run.stage
+    MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+    manifest, run_env = base.with_suffix(".subjects"), base.with_suffix(".env")
+    manifest.write_text("".join(" ".join(batch) + "\n" for batch in tasks))
+
+    env = {"PIPELINE": stage.pipeline,
+           "PIPELINE_SUFFIX": stage.format(stage.suffix),
+           "SESSION": session,
+           "SUBJS_PER_NODE": str(run.subjs_per_node or max(len(batch) for batch in tasks)),
+           "ANALYSIS_LEVEL": stage.level,
+           **run.params}
+    if stage.batch_env:
+        env["BATCH_ENV"] = stage.batch_env
+    run_env.write_text("".join(f"export {var}={shlex.quote(value)}\n" for var, value in env.items()))
+    return manifest, run_env
+
+
+def submit_array(run, session, tasks, job_time, dependency, opts, stamp):
+
+    stage = run.stage
+    suffix = stage.format(stage.suffix)
+    base = MANIFEST_DIR / f"{stamp}-{run.name}-ses-{session}"
+    array = f"0-{len(tasks) - 1}" + (f"%{run.max_parallel}" if run.max_parallel else "")
+
+    log = CODE_DIR / "log" / f"%A_%a-{stage.pipeline}-{time.strftime('%d%m%Y')}"
+    cmd = (["sbatch", "--parsable", f"--array={array}", "--job-name", stage.pipeline + suffix, "--time", job_time,
+            "--partition", run.partition] + opts.sbatch_flags.split() + run.sbatch_flags.split()
+           + ([f"--dependency=afterok:{dependency}", "--kill-on-invalid-dep=yes"] if dependency else [])
+           + ["--output", f"{log}.out", "--error", f"{log}.err", str(CODE_DIR / "02_pipelines_batch.sh")])
+
+    if opts.dry_run:
+        return f"{run.name}#{session}", base
+
+    manifest, run_env = write_manifest(base, run, session, tasks)
+    env = dict(os.environ, SCRIPT_DIR=str(CODE_DIR), MANIFEST=str(manifest), RUN_ENV=str(run_env))
+    result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"sbatch failed for {run.name} session {session}: {result.stderr.strip()}")
+    return result.stdout.strip().split(";")[0], base
+
+
+########
+# Main #
+########
+
+def main():
+
+    opts = get_parser().parse_args()
+
+    entries = read_spec(opts.spec)
+    if opts.only:
+        unknown = set(opts.only) - {entry["name"] for entry in entries}
+        if unknown:
+            raise SystemExit(f"--only: unknown runs {' '.join(sorted(unknown))}")
+        entries = [entry for entry in entries if entry["name"] in opts.only]
+    runs = [Run(entry, opts.graph) for entry in entries]
+
+    index = Index(opts.data_dir, opts.index)
+    stamp = time.strftime("%d%m%Y%H%M%S")
+    submitted, selected, rows = {}, {}, []
+
+    print("Dry run, job arrays that would be submitted:" if opts.dry_run else "Submitting:")
+    for run in runs:
+        for need in run.needs:
+            if need not in submitted and need in {entry["name"] for entry in entries}:
+                raise SystemExit(f"Run {run.name} needs {need}, which has to be listed before it")
+        cohort = run.cohort(index)
+        submitted[run.name], selected[run.name] = {}, {}
+
+        for session in run.sessions:
+            # Subjects reprocessed by a needed run have stale outputs here, whatever their current state on disk;
+            # a needed group run reprocesses the whole cohort
+            upstream = set()
+            for need in run.needs:
+                for ses, (batched, subs) in selected.get(need, {}).items():
+                    if ses == session or session not in selected[need]:
+                        upstream |= set(subs) if batched else set(cohort)
+            subjects = select(run, cohort, session, index, upstream)
+            selected[run.name][session] = (run.stage.batched, subjects)
+            if not subjects:
+                print(f"  {'-':>16s}  {run.name:20s} ses-{session:4s} outputs of all {len(cohort)} subjects are current")
+                continue
+
+            tasks, job_time = batches(run, subjects)
+            if len(tasks) > opts.max_array_size:
+                raise SystemExit(f"Run {run.name} session {session}: {len(tasks)} array tasks exceed MaxArraySize "
+                                 f"{opts.max_array_size}; raise subjs_per_node or split the run")
+
+            # Runs of a needed stage in the same session, else all of its arrays
+            depends = []
+            for need in run.needs:
+                arrays = submitted.get(need, {})
+                depends += [arrays[session]] if session in arrays else list(arrays.values())
+            dependency = ":".join(depends)
+
+            job_id, base = submit_array(run, session, tasks, job_time, dependency, opts, stamp)
+            submitted[run.name][session] = job_id
+            rows.append([job_id, run.name, session, str(len(tasks)), str(len(subjects)), job_time, dependency,
+                         str(base.with_suffix(".subjects"))])
+            print(f"  {job_id:>16s}  {run.name:20s} ses-{session:4s} {len(subjects):5d} subjects in {len(tasks):4d} tasks"
+                  f"  --time {job_time:>11s}" + (f"  after {dependency}" if dependency else ""))
+
+    index.save()
+    if not rows:
+        print("Nothing to submit.")
+    elif not opts.dry_run:
+        summary = MANIFEST_DIR / f"{stamp}-{Path(opts.spec).stem}.tsv"
+        with open(summary, "w") as f:
+            f.write("job_id\trun\tsession\ttasks\tsubjects\ttime\tdepends_on\tmanifest\n")
+            f.writelines("\t".join(row) + "\n" for row in rows)
+        print(f"Submitted {len(rows)} job arrays. Summary written to {summary}")
+
+
+if __name__ == "__main__":
+    main()
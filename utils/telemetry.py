@@ -0,0 +1,259 @@
+# Per-subject resource telemetry of pipeline tasks
+# `run` wraps one subject task (as launched by 02_pipelines_batch.sh via GNU parallel), samples the task's process
+# tree while it runs and appends one record to a per-job CSV: wall time, CPU time, peak RSS, peak scratch usage,
+# exit code, pipeline, suffix, session, node and SLURM job ID.
+# `merge` appends a per-job CSV to the project-level table (log/telemetry.csv), `report` summarizes the table.
+#
+# execute e.g. via
+# python3 telemetry.py run --record log/telemetry/<jobid>.csv -- pipelines/qsiprep/qsiprep.sh sub-001
+# python3 telemetry.py merge --record log/telemetry/<jobid>.csv --table log/telemetry.csv
+# python3 telemetry.py report --table log/telemetry.csv [--pipeline qsiprep] [--top 10]
+
+from argparse import ArgumentParser, RawTextHelpFormatter, REMAINDER
+from pathlib import Path
+import csv
+import fcntl
+import os
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import time
+
+
+COLUMNS = ["job_id", "node", "pipeline", "suffix", "session", "sub", "start",
+           "wall_s", "cpu_s", "peak_rss_mb", "peak_scratch_mb", "exit_code"]
+
+
+def get_parser():
+
+    parser = ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        description='Record, merge and report per-subject resource usage of pipeline tasks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', formatter_class=RawTextHelpFormatter, help='run and record one subject task')
+    run.add_argument(
+        '--record', required=True,
+        help='[required]\n per-job CSV the record is appended to')
+    run.add_argument(
+        '--interval', type=float, default=10,
+        help='[optional]\n sampling interval of memory in seconds; default 10')
+    run.add_argument(
+        '--scratch-interval', type=float, default=60,
+        help='[optional]\n sampling interval of scratch usage ($SCRATCH_DIR/<sub>) in seconds; default 60')
+    run.add_argument(
+        'task', nargs=REMAINDER,
+        help='-- <processing script> <subject>')
+
+    merge = commands.add_parser('merge', formatter_class=RawTextHelpFormatter, help='append a per-job CSV to the project table')
+    merge.add_argument(
+        '--record', required=True,
+        help='[required]\n per-job CSV')
+    merge.add_argument(
+        '--table', required=True,
+        help='[required]\n project-level table (e.g. log/telemetry.csv)')
+
+    report = commands.add_parser('report', formatter_class=RawTextHelpFormatter, help='summarize the project table')
+    report.add_argument(
+        '--table', required=True,
+        help='[required]\n project-level table (e.g. log/telemetry.csv)')
+    report.add_argument(
+        '--pipeline',
+        help='[optional]\n restrict to pipeline (with or without suffix, e.g. tbss or tbss_1)')
+    report.add_argument(
+        '--job',
+        help='[optional]\n restrict to SLURM job ID')
+    report.add_argument(
+        '--top', type=int, default=10,
+        help='[optional]\n number of slowest subjects and memory hogs to list; default 10')
+    return parser
+
+
+############
+# Sampling #
+############
+
+PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def process_tree(root):
+    """PIDs of `root` and all its descendants from /proc."""
+
+    children = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                # comm may contain spaces; fields after the closing parenthesis are fixed
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    tree, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def rss_mb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return total * PAGE_MB
+
+
+def disk_usage_mb(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                continue
+    return total / 1024 ** 2
+
+
+def append_rows(path, rows):
+    """Append rows to a CSV shared by concurrent writers (header written once)."""
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", newline="") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        writer = csv.writer(f)
+        # Size after the lock; the position of an append handle is taken at open, before concurrent writers finished
+        if os.fstat(f.fileno()).st_size == 0:
+            writer.writerow(COLUMNS)
+        writer.writerows(rows)
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run(opts):
+
+    task = opts.task[1:] if opts.task[:1] == ["--"] else opts.task
+    if not task:
+        raise SystemExit("No task given")
+
+    sub = task[-1]
+    script = Path(task[0]).stem
+    pipeline = os.environ.get("PIPELINE", script)
+    scratch = Path(os.environ.get("SCRATCH_DIR", "/tmp")) / sub
+
+    start = time.time()
+    proc = subprocess.Popen(task)
+
+    # Forward termination (e.g. by GNU parallel --timeout or scancel) to the task
+    def forward(signum, frame):
+        proc.send_signal(signum)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    peak_rss = peak_scratch = 0.0
+    last_scratch = 0.0
+    while proc.poll() is None:
+        peak_rss = max(peak_rss, rss_mb(process_tree(proc.pid)))
+        if time.time() - last_scratch >= opts.scratch_interval and scratch.exists():
+            peak_scratch = max(peak_scratch, disk_usage_mb(scratch))
+            last_scratch = time.time()
+        try:
+            proc.wait(timeout=opts.interval)
+        except subprocess.TimeoutExpired:
+            pass
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    append_rows(opts.record, [[
+        os.environ.get("SLURM_JOBID", ""), socket.gethostname(), pipeline, os.environ.get("PIPELINE_SUFFIX", ""),
+        os.environ.get("SESSION", ""), sub, time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+        f"{time.time() - start:.0f}", f"{usage.ru_utime + usage.ru_stime:.0f}", f"{peak_rss:.0f}", f"{peak_scratch:.0f}",
+        proc.returncode]])
+
+    # Keep the task's exit code for GNU parallel's joblog
+    return proc.returncode if proc.returncode >= 0 else 128 - proc.returncode
+
+
+#########
+# Merge #
+#########
+
+def read_table(path):
+    if not Path(path).exists():
+        return []
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def merge(opts):
+
+    rows = read_table(opts.record)
+    append_rows(opts.table, [[row[column] for column in COLUMNS] for row in rows])
+    print(f"Added {len(rows)} records of {opts.record} to {opts.table}")
+    return 0
+
+
+##########
+# Report #
+##########
+
+def report(opts):
+
+    rows = read_table(opts.table)
+    if opts.pipeline:
+        rows = [r for r in rows if opts.pipeline in (r["pipeline"], r["pipeline"] + r["suffix"])]
+    if opts.job:
+        rows = [r for r in rows if r["job_id"] == opts.job]
+    if not rows:
+        print("No records found")
+        return 0
+
+    for row in rows:
+        for column in ("wall_s", "cpu_s", "peak_rss_mb", "peak_scratch_mb"):
+            row[column] = float(row[column] or 0)
+        row["task"] = row["pipeline"] + row["suffix"]
+
+    def hours(seconds):
+        return f"{seconds / 3600:7.2f}"
+
+    print("Per pipeline:")
+    print(f"{'pipeline':25s} {'tasks':>6s} {'failed':>6s} {'wall h p50':>10s} {'wall h p90':>10s} {'cpu/wall':>8s} "
+          f"{'rss MB p90':>10s} {'rss MB max':>10s} {'scratch MB p90':>14s} {'scratch MB max':>14s}")
+    for task in sorted({r["task"] for r in rows}):
+        sub_rows = [r for r in rows if r["task"] == task]
+        wall = [r["wall_s"] for r in sub_rows]
+        rss = [r["peak_rss_mb"] for r in sub_rows]
+        scratch = [r["peak_scratch_mb"] for r in sub_rows]
+        p90 = (lambda values: statistics.quantiles(values, n=10)[-1] if len(values) > 1 else values[0])
+        print(f"{task:25s} {len(sub_rows):6d} {sum(r['exit_code'] != '0' for r in sub_rows):6d} "
+              f"{hours(statistics.median(wall)):>10s} {hours(p90(wall)):>10s} "
+              f"{sum(r['cpu_s'] for r in sub_rows) / max(sum(wall), 1):8.1f} "
+              f"{p90(rss):10.0f} {max(rss):10.0f} {p90(scratch):14.0f} {max(scratch):14.0f}")
+
+    def listing(title, key, fmt):
+        print(f"\n{title}:")
+        for r in sorted(rows, key=lambda r: r[key], reverse=True)[:opts.top]:
+            print(f"  {r['task']:25s} {r['sub']:20s} {fmt(r[key]):>10s}  job {r['job_id']} on {r['node']} (exit {r['exit_code']})")
+
+    listing("Slowest subjects (wall hours)", "wall_s", hours)
+    listing("Memory hogs (peak RSS MB)", "peak_rss_mb", lambda v: f"{v:.0f}")
+    listing("Scratch pressure (peak scratch MB)", "peak_scratch_mb", lambda v: f"{v:.0f}")
+    return 0
+
+
+def main():
+
+    opts = get_parser().parse_args()
+    raise SystemExit({"run": run, "merge": merge, "report": report}[opts.command](opts))
+
+
+if __name__ == "__main__":
+    main()